@@ -1,5 +1,7 @@
 from .layer_freezer import LayerFreezer
 from .lr_finder import LearningRateFinderCallback
+from .gradual_unfreezing import GradualUnfreezingCallback
+from .activation_cache import FrozenPrefixCache, FrozenPrefixTrainer
 from .hyper_tuner import HyperparameterTuner
 from .autotrainer import AutoTrainer
 from .t5customdataset import (
@@ -7,6 +9,12 @@ from .t5customdataset import (
     T5TextGenerationDataset, T5SummarizationDataset, T5NERDataset, 
     T5TranslationDataset
 )
+from .t5streamingdataset import (
+    T5StreamingRegressionDataset, T5StreamingClassificationDataset, T5StreamingQADataset,
+    T5StreamingTextGenerationDataset, T5StreamingSummarizationDataset, T5StreamingNERDataset,
+    T5StreamingTranslationDataset
+)
+from .batching import T5DataCollator, LengthBucketSampler
 from .evaluators.correctness_evaluator import CorrectnessEvaluator
 from .evaluators.faithfulness_evaluator import FaithfulnessEvaluator
 from .evaluators.relevancy_evaluator import RelevancyEvaluator
@@ -32,11 +40,17 @@ class Intellithing:
 __all__ = [
     'LayerFreezer',
     'LearningRateFinderCallback',
+    'GradualUnfreezingCallback',
+    'FrozenPrefixCache', 'FrozenPrefixTrainer',
     'HyperparameterTuner',
     'AutoTrainer',
     'T5RegressionDataset', 'T5ClassificationDataset', 'T5QADataset',
     'T5TextGenerationDataset', 'T5SummarizationDataset', 'T5NERDataset', 
     'T5TranslationDataset',
+    'T5StreamingRegressionDataset', 'T5StreamingClassificationDataset', 'T5StreamingQADataset',
+    'T5StreamingTextGenerationDataset', 'T5StreamingSummarizationDataset', 'T5StreamingNERDataset',
+    'T5StreamingTranslationDataset',
+    'T5DataCollator', 'LengthBucketSampler',
     'CorrectnessEvaluator',
     'FaithfulnessEvaluator',
     'RelevancyEvaluator',
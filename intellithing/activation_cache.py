@@ -0,0 +1,233 @@
+import json
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from transformers import Trainer
+from transformers.modeling_outputs import BaseModelOutput
+
+from intellithing.batching import LengthBucketSampler, T5DataCollator, dataset_lengths
+from intellithing.token_cache import TokenCache
+
+
+_DTYPES = {'float32': np.float32, 'float16': np.float16}
+
+
+def _run_encoder_blocks(encoder, hidden_states, attention_mask, blocks):
+    """Run `blocks` of a T5 encoder stack on `hidden_states` with the stack's mask and relative position bias."""
+    seq_len = hidden_states.shape[1]
+    extended_mask = encoder.get_extended_attention_mask(attention_mask, attention_mask.shape)
+    # Every block reuses the bias computed by the first one, see T5Stack.forward
+    position_bias = encoder.block[0].layer[0].SelfAttention.compute_bias(seq_len, seq_len, device=hidden_states.device)
+    position_bias = position_bias.to(hidden_states.dtype) + extended_mask
+    for block in blocks:
+        hidden_states = block(hidden_states, attention_mask=extended_mask, position_bias=position_bias, use_cache=False)[0]
+    return hidden_states
+
+
+class CachedPrefixDataset(Dataset):
+    """
+    View of a dataset whose items carry the cached frozen-prefix activations in
+    'prefix_hidden_states' (`[item length, d_model]`), built by `FrozenPrefixCache.wrap`.
+    """
+
+    def __init__(self, dataset, hidden_states, offsets):
+        self.dataset = dataset
+        self.hidden_states = hidden_states
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        item = dict(self.dataset[idx])
+        # Copy out of the read-only memory map
+        item['prefix_hidden_states'] = torch.from_numpy(np.array(self.hidden_states[self.offsets[idx]:self.offsets[idx + 1]]))
+        return item
+
+    def lengths(self):
+        return dataset_lengths(self.dataset)
+
+
+class FrozenPrefixCache:
+    """
+    Cache the activations of the frozen bottom of a T5 encoder, so training only runs the
+    trainable encoder layers and the decoder.
+
+    The prefix is the token embeddings and the first `num_layers` encoder blocks (by default
+    every frozen block from the bottom up); all their parameters must be frozen. `wrap`
+    runs the prefix once over a dataset in eval mode and stores the hidden states of every
+    token in a `TokenCache` under `cache_dir`, which later runs and epochs read memory-mapped.
+    Entries are keyed by the prefix depth, the storage dtype, the model config, the bytes of
+    the prefix weights and the input ids, so changing the freeze configuration or the
+    weights computes a new entry. The key of every wrapped dataset object is remembered, so
+    wrapping it again with the same prefix reads the entry without going over its items.
+    Train with `FrozenPrefixTrainer`.
+
+    The prefix runs without dropout, so with dropout enabled training differs from a
+    normal run in the frozen layers only.
+    """
+
+    def __init__(self, model, cache_dir, num_layers=None, dtype='float32', batch_size=32, max_bytes=10 * 1024 ** 3):
+        if dtype not in _DTYPES:
+            raise ValueError(f"Unsupported dtype {dtype!r}, use one of {sorted(_DTYPES)}")
+        self.model = model
+        self.encoder = model.get_encoder()
+        if not hasattr(self.encoder, 'block') or not hasattr(self.encoder, 'embed_tokens'):
+            raise ValueError(f"Frozen-prefix caching needs a T5 encoder, not {type(self.encoder).__name__}")
+        self.dtype = dtype
+        self.batch_size = batch_size
+        self.token_cache = TokenCache(cache_dir, max_bytes=max_bytes)
+        self.num_layers = self._frozen_depth() if num_layers is None else num_layers
+        if self.num_layers < 1:
+            raise ValueError("No frozen prefix to cache: freeze the embeddings and the bottom encoder blocks first")
+        if self.num_layers > len(self.encoder.block):
+            raise ValueError(f"The encoder has {len(self.encoder.block)} blocks, cannot cache {self.num_layers}")
+        if any(param.requires_grad for param in self.prefix_parameters()):
+            raise ValueError(f"The embeddings and the first {self.num_layers} encoder blocks must be frozen")
+        # (id(dataset), prefix fingerprint) -> (dataset, entry key), see wrap
+        self._keys = {}
+
+    @property
+    def covers_encoder(self):
+        """True when the whole encoder, including its final norm, is cached."""
+        return self.num_layers == len(self.encoder.block)
+
+    def _frozen_depth(self):
+        if any(param.requires_grad for param in self.encoder.embed_tokens.parameters()):
+            return 0
+        depth = 0
+        for block in self.encoder.block:
+            if any(param.requires_grad for param in block.parameters()):
+                break
+            depth += 1
+        if depth == len(self.encoder.block) and any(param.requires_grad for param in self.encoder.final_layer_norm.parameters()):
+            depth -= 1
+        return depth
+
+    def prefix_parameters(self):
+        params = list(self.encoder.embed_tokens.parameters())
+        for block in self.encoder.block[:self.num_layers]:
+            params += list(block.parameters())
+        if self.covers_encoder:
+            params += list(self.encoder.final_layer_norm.parameters())
+        return params
+
+    def _prefix_fingerprint(self):
+        # The config without the path the model was loaded from, a checkpoint of the same weights is the same prefix
+        config = {name: value for name, value in self.model.config.to_dict().items() if name != '_name_or_path'}
+        weights = [param.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes() for param in self.prefix_parameters()]
+        return TokenCache.fingerprint('frozen-prefix', self.num_layers, self.dtype, json.dumps(config, sort_keys=True, default=str), *weights)
+
+    @staticmethod
+    def _key(prefix, input_ids, attention_masks):
+        return TokenCache.fingerprint(
+            prefix, np.array([len(ids) for ids in input_ids], dtype=np.int64).tobytes(),
+            np.concatenate(input_ids).astype(np.int64).tobytes(), np.concatenate(attention_masks).astype(np.int8).tobytes(),
+        )
+
+    @torch.no_grad()
+    def _compute(self, input_ids, attention_masks):
+        collator = T5DataCollator(pad_token_id=self.model.config.pad_token_id)
+        device = next(self.encoder.parameters()).device
+        offsets = np.zeros(len(input_ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(ids) for ids in input_ids])
+        hidden_states = np.empty((offsets[-1], self.model.config.d_model), dtype=_DTYPES[self.dtype])
+
+        training = self.encoder.training
+        self.encoder.eval()
+        try:
+            for start in range(0, len(input_ids), self.batch_size):
+                stop = min(start + self.batch_size, len(input_ids))
+                batch = collator([{'input_ids': ids, 'attention_mask': mask}
+                                  for ids, mask in zip(input_ids[start:stop], attention_masks[start:stop])])
+                attention_mask = batch['attention_mask'].to(device)
+                hidden = self.encoder.embed_tokens(batch['input_ids'].to(device))
+                hidden = _run_encoder_blocks(self.encoder, hidden, attention_mask, self.encoder.block[:self.num_layers])
+                if self.covers_encoder:
+                    hidden = self.encoder.final_layer_norm(hidden)
+                hidden = hidden.float().cpu().numpy()
+                for row, idx in enumerate(range(start, stop)):
+                    hidden_states[offsets[idx]:offsets[idx + 1]] = hidden[row, :offsets[idx + 1] - offsets[idx]]
+        finally:
+            self.encoder.train(training)
+        return hidden_states, offsets
+
+    def wrap(self, dataset):
+        """
+        Return a `CachedPrefixDataset` over `dataset` (a map-style dataset of 'input_ids' and
+        'attention_mask' items), computing the prefix activations on a cache miss. The items
+        are only read the first time a dataset object is wrapped with the current prefix
+        weights, or when its entry was evicted since.
+        """
+        if isinstance(dataset, CachedPrefixDataset):
+            dataset = dataset.dataset
+        if isinstance(dataset, torch.utils.data.IterableDataset):
+            raise TypeError("Frozen-prefix caching needs a map-style dataset, streaming datasets are not supported")
+        prefix = self._prefix_fingerprint()
+        known = self._keys.get((id(dataset), prefix))
+        # The dataset is kept with its key, so the id of a dataset collected since does not match
+        if known is not None and known[0] is dataset:
+            arrays = self.token_cache.load(known[1])
+            if arrays is not None:
+                return CachedPrefixDataset(dataset, arrays['hidden_states'], arrays['offsets'])
+
+        input_ids, attention_masks = [], []
+        for idx in range(len(dataset)):
+            item = dataset[idx]
+            input_ids.append(np.asarray(item['input_ids']))
+            attention_masks.append(np.asarray(item['attention_mask']))
+
+        key = self._key(prefix, input_ids, attention_masks)
+        arrays = self.token_cache.load(key)
+        if arrays is None:
+            hidden_states, offsets = self._compute(input_ids, attention_masks)
+            arrays = self.token_cache.save(key, {'hidden_states': hidden_states, 'offsets': offsets})
+        self._keys[id(dataset), prefix] = (dataset, key)
+        return CachedPrefixDataset(dataset, arrays['hidden_states'], arrays['offsets'])
+
+
+class FrozenPrefixTrainer(Trainer):
+    """
+    Trainer for datasets wrapped by a `FrozenPrefixCache`: the encoder starts from the
+    cached 'prefix_hidden_states' and only runs its blocks above the prefix, then the
+    decoder. Batches without cached activations are passed through unchanged. With
+    `bucket_size_multiplier` the training batches are drawn from a `LengthBucketSampler`.
+    """
+
+    def __init__(self, *args, prefix_cache=None, bucket_size_multiplier=None, **kwargs):
+        if prefix_cache is None:
+            raise ValueError("FrozenPrefixTrainer needs the FrozenPrefixCache of its datasets")
+        super().__init__(*args, **kwargs)
+        self.prefix_cache = prefix_cache
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self._prefix_params = prefix_cache.prefix_parameters()
+
+    def _set_signature_columns_if_needed(self):
+        super()._set_signature_columns_if_needed()
+        # Keep the cached activations when the Trainer drops inputs the model's forward does not take
+        self._signature_columns = list(self._signature_columns) + ['prefix_hidden_states']
+
+    def _get_train_sampler(self, *args, **kwargs):
+        if self.bucket_size_multiplier is None:
+            return super()._get_train_sampler(*args, **kwargs)
+        return LengthBucketSampler(
+            dataset_lengths(self.train_dataset),
+            batch_size=self._train_batch_size,
+            bucket_size_multiplier=self.bucket_size_multiplier,
+            seed=self.args.seed,
+        )
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        if 'prefix_hidden_states' in inputs:
+            if any(param.requires_grad for param in self._prefix_params):
+                raise RuntimeError("Parameters of the cached prefix were unfrozen, the cached activations are stale")
+            inputs = dict(inputs)
+            encoder = self.accelerator.unwrap_model(model).get_encoder()
+            hidden = inputs.pop('prefix_hidden_states').to(encoder.final_layer_norm.weight.dtype)
+            inputs.pop('input_ids', None)
+            if not self.prefix_cache.covers_encoder:
+                hidden = _run_encoder_blocks(encoder, hidden, inputs['attention_mask'], encoder.block[self.prefix_cache.num_layers:])
+                hidden = encoder.final_layer_norm(hidden)
+            inputs['encoder_outputs'] = BaseModelOutput(last_hidden_state=encoder.dropout(hidden))
+        return super().compute_loss(model, inputs, return_outputs=return_outputs, **kwargs)
@@ -1,72 +1,205 @@
-import os
-import optuna
-from intellithing.hyper_tuner import HyperparameterTuner
-from transformers import (
-    AutoConfig,
-    AutoModelForSequenceClassification,
-    AutoModelForCausalLM,
-    AutoModelForSeq2SeqLM,
-    AutoModelForTokenClassification,
-    TrainingArguments,
-    Trainer,
-)
-from sklearn.model_selection import train_test_split
-
-
-class AutoTrainer(HyperparameterTuner):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.best_model = None
-
-    def auto_train(self, n_trials=10, subset_size=0.1, timeout=None):
-        # Tune hyperparameters on a subset of the training data
-        best_params = self.tune_hyperparameters(n_trials=n_trials, subset_size=subset_size, timeout=timeout)
-
-        # Load the model again, as it was trained on the subset of data during hyperparameter tuning
-        self.model = self._load_model()
-
-        # Set the best_params from tuning to the TrainingArguments
-        training_args = TrainingArguments(
-            output_dir='./results_full',
-            num_train_epochs=best_params['num_train_epochs'],
-            learning_rate=best_params['lr'],
-            per_device_train_batch_size=best_params['per_device_train_batch_size'],
-            warmup_steps=best_params['warmup_steps'],
-            weight_decay=best_params['weight_decay'],
-            adam_epsilon=best_params['adam_epsilon'],
-            gradient_accumulation_steps=best_params['gradient_accumulation_steps'],
-            evaluation_strategy="epoch",
-            logging_dir='./logs_full',
-            logging_steps=10,
-            load_best_model_at_end=True,
-            metric_for_best_model="loss",
-            greater_is_better=False,
-        )
-
-        # Initialize the Trainer with the appropriate parameters
-        trainer = Trainer(
-            model=self.model,
-            args=training_args,
-            train_dataset=self.train_dataset,  # Using the full training set
-            eval_dataset=self.val_dataset,
-        )
-
-        # Train the model on the full dataset
-        trainer.train()
-
-        # Save the best model (which is loaded automatically by Trainer if 'load_best_model_at_end' is True)
-        self.best_model = self.model
-
-        # Save the model to a directory
-        save_directory = "finetuned_model"
-        if not os.path.exists(save_directory):
-            os.makedirs(save_directory)
-        self.best_model.save_pretrained(save_directory)
-
-        return self.best_model
-
-# Usage example:
-# Assuming 'model_name', 'tokenizer', 'train_dataset', and 'val_dataset' are defined
-# auto_trainer = AutoTrainer(model_name, tokenizer, train_dataset, val_dataset)
-# best_model = auto_trainer.auto_train(n_trials=10, subset_size=0.1)  # Adjust n_trials and subset_size as necessary
-
+import os
+import shutil
+import warnings
+import optuna
+import torch
+from intellithing.gradual_unfreezing import GradualUnfreezingCallback
+from intellithing.hyper_tuner import HyperparameterTuner
+from transformers import (
+    AutoConfig,
+    AutoModelForSequenceClassification,
+    AutoModelForCausalLM,
+    AutoModelForSeq2SeqLM,
+    AutoModelForTokenClassification,
+    TrainingArguments,
+)
+from transformers.modeling_utils import load_sharded_checkpoint, load_state_dict
+from transformers.utils import SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME, WEIGHTS_INDEX_NAME, WEIGHTS_NAME
+from sklearn.model_selection import train_test_split
+
+
+class AutoTrainer(HyperparameterTuner):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.best_model = None
+
+    def auto_train(self, n_trials=10, subset_size=0.1, timeout=None, continue_from_best=False, max_train_time=None,
+                   max_memory_mb=None, gradual_unfreezing=None, **tuning_kwargs):
+        """
+        Tune the hyperparameters and train on the full training set with the best ones.
+
+        With `continue_from_best=True` the final run starts from the best trial's weights and
+        optimizer state instead of the pretrained model, with the warmup shortened by the
+        optimizer steps that trial already did. If that trial has no checkpoint (a trial
+        cache hit) it warns and starts from the pretrained model. `tuning_kwargs` (n_jobs, pruner,
+        multi_fidelity, cost_objectives, ...) are passed on to `tune_hyperparameters`.
+
+        `max_train_time` (seconds) and `max_memory_mb` restrict the final run to the
+        configurations whose estimated full training time and measured peak memory (CUDA
+        memory on a GPU, process RSS otherwise) fit: the lowest-loss trial within the budget
+        is used, and a ValueError is raised if none fits. With `batch_size_probe=True` the
+        probed batch sizes are also limited to `max_memory_mb`, measured the same way. With a
+        budget and `continue_from_best=True` every trial's checkpoint is kept until the
+        configuration is chosen, then all but the chosen one are deleted.
+
+        `gradual_unfreezing` (True, a dict of `GradualUnfreezingCallback` arguments or the
+        callback itself) trains the final run top layers first, unfreezing downwards.
+        `activation_cache` (see `tune_hyperparameters`) also applies to the final run.
+        """
+        if gradual_unfreezing and continue_from_best:
+            raise ValueError("gradual_unfreezing cannot continue from the best trial, whose optimizer state covers all layers")
+        if gradual_unfreezing and tuning_kwargs.get('activation_cache') is not None:
+            raise ValueError("gradual_unfreezing unfreezes the layers whose activations activation_cache would cache")
+        if gradual_unfreezing is True:
+            gradual_unfreezing = GradualUnfreezingCallback()
+        elif isinstance(gradual_unfreezing, dict):
+            gradual_unfreezing = GradualUnfreezingCallback(**gradual_unfreezing)
+
+        try:
+            full_size = len(self.train_dataset)
+        except TypeError:
+            # Iterable datasets without a length, the time is extrapolated from the subset instead
+            full_size = None
+
+        batch_size_probe = tuning_kwargs.get('batch_size_probe')
+        if batch_size_probe and max_memory_mb is not None:
+            tuning_kwargs['batch_size_probe'] = dict(batch_size_probe if isinstance(batch_size_probe, dict) else {})
+            tuning_kwargs['batch_size_probe'].setdefault('max_memory_mb', max_memory_mb)
+
+        # Tune hyperparameters on a subset of the training data; with a budget the lowest-loss
+        # trial may be ruled out, so the cleanup waits until a configuration is chosen
+        budget = max_train_time is not None or max_memory_mb is not None
+        best_params = self.tune_hyperparameters(n_trials=n_trials, subset_size=subset_size, timeout=timeout,
+                                                keep_best_checkpoint=continue_from_best,
+                                                keep_all_checkpoints=continue_from_best and budget, **tuning_kwargs)
+        checkpoint_step = self.best_checkpoint_step
+        checkpoint = self.best_checkpoint if continue_from_best else None
+
+        if budget:
+            selected = None
+            try:
+                selected = self._select_within_budget(full_size, subset_size, max_train_time, max_memory_mb)
+            finally:
+                if continue_from_best:
+                    self._remove_unselected_checkpoints(selected)
+            best_params = self.best_params = selected['params']
+            checkpoint = selected.get('checkpoint') if continue_from_best else None
+            checkpoint_step = selected.get('checkpoint_step', 0)
+            self.best_checkpoint, self.best_checkpoint_step = checkpoint, checkpoint_step
+
+        warmup_steps = best_params['warmup_steps']
+        if checkpoint and os.path.isdir(checkpoint):
+            self._load_weights(checkpoint)
+            for name, param in self.model.named_parameters():
+                param.requires_grad = self._initial_requires_grad.get(name, param.requires_grad)
+            warmup_steps = max(0, warmup_steps - checkpoint_step)
+        else:
+            if continue_from_best:
+                warnings.warn("The chosen trial has no checkpoint to continue from (its result came from the trial cache or "
+                              "its checkpoint was removed), training from the pretrained model instead")
+            # Reset the model to the pretrained weights, as it was trained on the subset of data during hyperparameter tuning
+            checkpoint = None
+            self._reset_model()
+
+        # Set the best_params from tuning to the TrainingArguments
+        training_args = TrainingArguments(
+            output_dir='./results_full',
+            **self._training_length(
+                self.train_dataset,
+                best_params['num_train_epochs'],
+                best_params['per_device_train_batch_size'],
+                best_params['gradient_accumulation_steps'],
+            ),
+            learning_rate=best_params['lr'],
+            per_device_train_batch_size=best_params['per_device_train_batch_size'],
+            warmup_steps=warmup_steps,
+            weight_decay=best_params['weight_decay'],
+            adam_epsilon=best_params['adam_epsilon'],
+            gradient_accumulation_steps=best_params['gradient_accumulation_steps'],
+            evaluation_strategy="epoch",
+            save_strategy="epoch",  # load_best_model_at_end needs matching save and eval strategies
+            logging_dir='./logs_full',
+            logging_steps=10,
+            load_best_model_at_end=True,
+            metric_for_best_model="loss",
+            greater_is_better=False,
+        )
+
+        # Initialize the Trainer with the appropriate parameters
+        trainer = self._build_trainer(
+            training_args,
+            train_dataset=self.train_dataset,  # Using the full training set
+            eval_dataset=self.val_dataset,
+            callbacks=[gradual_unfreezing] if gradual_unfreezing else None,
+        )
+
+        if checkpoint:
+            # The Trainer keeps an optimizer that exists already and only builds the new schedule
+            trainer.create_optimizer()
+            trainer.optimizer.load_state_dict(torch.load(os.path.join(checkpoint, 'optimizer.pt')))
+
+        # Train the model on the full dataset
+        trainer.train()
+        self._release_optimizer(trainer)
+
+        # Save the best model (which is loaded automatically by Trainer if 'load_best_model_at_end' is True)
+        self.best_model = self.model
+
+        # Save the model to a directory
+        save_directory = "finetuned_model"
+        if not os.path.exists(save_directory):
+            os.makedirs(save_directory)
+        self.best_model.save_pretrained(save_directory)
+
+        return self.best_model
+
+    def _load_weights(self, checkpoint):
+        """
+        Load the weights of a trial checkpoint into the model in place, so its parameters keep
+        their dtypes (frozen layers kept in reduced precision) and the hooks set on them.
+        """
+        for index_name in (SAFE_WEIGHTS_INDEX_NAME, WEIGHTS_INDEX_NAME):
+            if os.path.exists(os.path.join(checkpoint, index_name)):
+                load_sharded_checkpoint(self.model, checkpoint, strict=False)
+                return
+        for weights_name in (SAFE_WEIGHTS_NAME, WEIGHTS_NAME):
+            path = os.path.join(checkpoint, weights_name)
+            if os.path.exists(path):
+                # Tied weights are saved once, so only unexpected keys are an error
+                unexpected = self.model.load_state_dict(load_state_dict(path), strict=False).unexpected_keys
+                if unexpected:
+                    raise ValueError(f"{checkpoint} does not match the model, unexpected weights: {unexpected}")
+                return
+        raise FileNotFoundError(f"No model weights found in {checkpoint}")
+
+    def _remove_unselected_checkpoints(self, selected):
+        """Delete the trial directories kept for the budget selection, except the `selected` result's."""
+        for result in self.trial_results:
+            if result is not selected and 'checkpoint' in result:
+                shutil.rmtree(os.path.dirname(result['checkpoint']), ignore_errors=True)
+                del result['checkpoint']
+                result.pop('checkpoint_step', None)
+
+    def _select_within_budget(self, full_size, subset_size, max_train_time=None, max_memory_mb=None):
+        """Return the lowest-loss entry of `trial_results` that fits the time and memory budget."""
+        for result in sorted(self.trial_results, key=lambda result: result['eval_loss']):
+            if full_size is not None:
+                estimated_time = full_size * result['params']['num_train_epochs'] / result['samples_per_second']
+            else:
+                estimated_time = result['train_runtime'] / subset_size
+            result['estimated_train_time'] = estimated_time
+            if max_train_time is not None and estimated_time > max_train_time:
+                continue
+            # The memory probe_batch_sizes compares max_memory_mb against as well
+            peak_memory_mb = result['peak_cuda_mb'] if result.get('peak_cuda_mb') is not None else result['peak_rss_mb']
+            if max_memory_mb is not None and peak_memory_mb > max_memory_mb:
+                continue
+            return result
+        raise ValueError(f"None of the {len(self.trial_results)} completed trials fits the budget "
+                         f"(max_train_time={max_train_time}, max_memory_mb={max_memory_mb})")
+
+# Usage example:
+# Assuming 'model_name', 'tokenizer', 'train_dataset', and 'val_dataset' are defined
+# auto_trainer = AutoTrainer(model_name, tokenizer, train_dataset, val_dataset)
+# best_model = auto_trainer.auto_train(n_trials=10, subset_size=0.1)  # Adjust n_trials and subset_size as necessary
+
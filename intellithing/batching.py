@@ -0,0 +1,174 @@
+import numpy as np
+import torch
+from torch.utils.data import Sampler, Subset
+from transformers import Trainer
+
+
+class T5DataCollator:
+    """
+    Collate items produced with `padding=False` by padding every sequence to the longest
+    item in the batch. Labels are padded with -100 so the padding is ignored by the loss
+    function, the same way the T5 datasets mask padded labels. Fixed length items are
+    simply stacked.
+
+    Integer tensors are upcast to long while the batch is assembled, so items of datasets
+    built with `compact=True` (int16/int32 ids, uint8 masks) stay small until batch time.
+    With `pin_memory=True` batches are allocated in pinned memory for faster
+    host-to-GPU copies (ignored without CUDA).
+    """
+
+    def __init__(self, tokenizer=None, pad_token_id=None, label_pad_token_id=-100, pad_to_multiple_of=None, pin_memory=False):
+        if pad_token_id is None:
+            if tokenizer is None:
+                raise ValueError("Either tokenizer or pad_token_id should be given.")
+            pad_token_id = tokenizer.pad_token_id
+
+        self.pad_token_id = pad_token_id
+        self.label_pad_token_id = label_pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+
+    @staticmethod
+    def _batch_dtype(dtype):
+        return dtype if dtype.is_floating_point or dtype == torch.bool else torch.long
+
+    def _padding_value(self, key):
+        if key == 'labels':
+            return self.label_pad_token_id
+        if key == 'attention_mask' or key.endswith('segment_ids') or key.endswith('hidden_states'):
+            return 0
+        return self.pad_token_id
+
+    def _pad(self, sequences, padding_value):
+        max_len = max(len(sequence) for sequence in sequences)
+        if self.pad_to_multiple_of:
+            max_len = -(-max_len // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        # Trailing dimensions, e.g. the hidden size of cached activations, are kept as they are
+        batch = torch.full((len(sequences), max_len) + tuple(sequences[0].shape[1:]), padding_value, dtype=self._batch_dtype(sequences[0].dtype), pin_memory=self.pin_memory)
+        for row, sequence in enumerate(sequences):
+            batch[row, :len(sequence)] = sequence
+        return batch
+
+    def __call__(self, features):
+        batch = {}
+        for key in features[0]:
+            values = [torch.as_tensor(feature[key]) for feature in features]
+            if values[0].dim() == 0:
+                # Scalar targets such as the regression labels
+                batch[key] = torch.stack(values).to(self._batch_dtype(values[0].dtype))
+                if self.pin_memory:
+                    batch[key] = batch[key].pin_memory()
+            else:
+                batch[key] = self._pad(values, self._padding_value(key))
+        return batch
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Yield dataset indices so that consecutive runs of `batch_size` indices have similar
+    lengths. Indices are shuffled, cut into buckets of `batch_size * bucket_size_multiplier`,
+    sorted by length inside each bucket and split into batches, and the batch order is
+    shuffled again. Batches padded with `T5DataCollator` then carry little padding.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size_multiplier=50, shuffle=True, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(-self.lengths[bucket], kind='stable')]
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if not batches:
+            return iter([])
+        return iter(np.concatenate(batches).tolist())
+
+
+def dataset_lengths(dataset):
+    """
+    Source lengths of the items of `dataset`. Uses `dataset.lengths()` when available (the
+    T5 datasets) and follows `Subset` indices; otherwise counts the attention mask of
+    every item.
+    """
+    if isinstance(dataset, Subset):
+        return np.asarray(dataset_lengths(dataset.dataset))[np.asarray(dataset.indices)]
+    if hasattr(dataset, 'lengths'):
+        return np.asarray(dataset.lengths())
+    return np.array([int(torch.as_tensor(item['attention_mask']).sum()) for item in dataset])
+
+
+def packed_attention_masks(segment_ids, decoder_segment_ids):
+    """
+    Build the masks for a batch of packed examples from their segment ids (0 marks padding):
+    the encoder self-attention mask `[batch, source, source]`, the causal decoder
+    self-attention mask `[batch, target, target]` and the cross-attention mask
+    `[batch, target, source]`. Tokens only attend to tokens of their own segment.
+    """
+    encoder_mask = (segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, None, :] > 0)
+
+    target_len = decoder_segment_ids.shape[1]
+    causal = torch.ones(target_len, target_len, dtype=torch.bool, device=decoder_segment_ids.device).tril()
+    decoder_mask = (decoder_segment_ids[:, :, None] == decoder_segment_ids[:, None, :]) & (decoder_segment_ids[:, None, :] > 0) & causal
+
+    cross_mask = (decoder_segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, None, :] > 0)
+    return encoder_mask.long(), decoder_mask.long(), cross_mask.long()
+
+
+class PackedSeq2SeqTrainer(Trainer):
+    """
+    Trainer for datasets built with `packing=True`. The encoder runs with a block-diagonal
+    self-attention mask and the decoder with per-segment causal and cross-attention masks,
+    which the model's single `attention_mask` argument cannot express. Unpacked batches
+    are passed through unchanged.
+    """
+
+    def _set_signature_columns_if_needed(self):
+        super()._set_signature_columns_if_needed()
+        # Keep the segment ids when the Trainer drops inputs the model's forward does not take
+        self._signature_columns = list(self._signature_columns) + ['segment_ids', 'decoder_segment_ids']
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        if 'segment_ids' in inputs:
+            inputs = dict(inputs)
+            encoder_mask, decoder_mask, cross_mask = packed_attention_masks(inputs.pop('segment_ids'), inputs.pop('decoder_segment_ids'))
+            encoder = self.accelerator.unwrap_model(model).get_encoder()
+            inputs['encoder_outputs'] = encoder(input_ids=inputs.pop('input_ids'), attention_mask=encoder_mask, return_dict=True)
+            # With encoder_outputs given, the model only uses attention_mask for the cross-attention
+            inputs['attention_mask'] = cross_mask
+            inputs['decoder_attention_mask'] = decoder_mask
+        return super().compute_loss(model, inputs, return_outputs=return_outputs, **kwargs)
+
+
+class LengthBucketTrainer(Trainer):
+    """Trainer that draws its training batches from a `LengthBucketSampler`."""
+
+    def __init__(self, *args, bucket_size_multiplier=50, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bucket_size_multiplier = bucket_size_multiplier
+
+    def _get_train_sampler(self, *args, **kwargs):
+        return LengthBucketSampler(
+            dataset_lengths(self.train_dataset),
+            batch_size=self._train_batch_size,
+            bucket_size_multiplier=self.bucket_size_multiplier,
+            seed=self.args.seed,
+        )
@@ -0,0 +1,103 @@
+"""
+Frozen-prefix activation caching versus a plain run of a partially frozen T5 model.
+
+The embeddings and the bottom `frozen_layers` encoder blocks of a randomly initialised T5
+model are frozen and the model is trained for a few epochs once with the Trainer, which
+runs the frozen blocks for every example in every epoch, and once from the activations
+cached by `FrozenPrefixCache`. The time to build the cache is reported separately from
+the training time:
+
+    python -m intellithing.benchmarks.activation_cache_benchmark --layers 6 --frozen-layers 5 --epochs 3
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import torch
+from transformers import T5Config, T5ForConditionalGeneration, Trainer, TrainingArguments
+
+from intellithing.activation_cache import FrozenPrefixCache, FrozenPrefixTrainer
+from intellithing.batching import T5DataCollator
+from intellithing.benchmarks.dataset_benchmark import make_tokenizer, synthetic_frame
+from intellithing.layer_freezer import LayerFreezer
+from intellithing.t5customdataset import T5SummarizationDataset
+
+
+def run_benchmark(n_rows=1000, layers=6, frozen_layers=5, d_model=128, source_length=128, target_length=8, epochs=3,
+                  batch_size=32, vocab_size=1000, seed=0):
+    """Return the cache build time, training time and final train loss of both modes."""
+    torch.manual_seed(seed)
+    tokenizer = make_tokenizer(vocab_size)
+    frame = synthetic_frame(n_rows, source_length=source_length, target_length=target_length, distribution='constant',
+                            vocab_size=vocab_size, seed=seed)
+    dataset = T5SummarizationDataset(tokenizer, frame, 'text', 'target', padding=False, pretokenize=True,
+                                     source_max_len=source_length + 8, target_max_len=target_length + 8)
+    config = T5Config(vocab_size=len(tokenizer), d_model=d_model, d_kv=d_model // 4, d_ff=4 * d_model, num_layers=layers,
+                      num_heads=4, decoder_start_token_id=tokenizer.pad_token_id, pad_token_id=tokenizer.pad_token_id,
+                      eos_token_id=tokenizer.eos_token_id)
+    initial = T5ForConditionalGeneration(config)
+    initial.shared.weight.requires_grad = False
+    LayerFreezer(initial).freeze_layers(range(frozen_layers), part='encoder')
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode in ('plain', 'cached'):
+            model = copy.deepcopy(initial)
+            args = TrainingArguments(output_dir=os.path.join(tmp_dir, mode), num_train_epochs=epochs, per_device_train_batch_size=batch_size,
+                                     learning_rate=1e-3, save_strategy="no", logging_strategy="no", report_to="none",
+                                     disable_tqdm=True, seed=seed)
+            kwargs = {'model': model, 'args': args, 'data_collator': T5DataCollator(tokenizer)}
+            cache_s = 0.0
+            if mode == 'cached':
+                start = time.perf_counter()
+                prefix_cache = FrozenPrefixCache(model, os.path.join(tmp_dir, 'activations'), num_layers=frozen_layers)
+                trainer = FrozenPrefixTrainer(train_dataset=prefix_cache.wrap(dataset), prefix_cache=prefix_cache, **kwargs)
+                cache_s = time.perf_counter() - start
+            else:
+                trainer = Trainer(train_dataset=dataset, **kwargs)
+            start = time.perf_counter()
+            output = trainer.train()
+            train_s = time.perf_counter() - start
+            results.append({'mode': mode, 'cache_s': cache_s, 'train_s': train_s, 's_per_epoch': train_s / epochs,
+                            'train_loss': output.training_loss})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark frozen-prefix activation caching against a plain run")
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--layers', type=int, default=6)
+    parser.add_argument('--frozen-layers', type=int, default=5)
+    parser.add_argument('--d-model', type=int, default=128)
+    parser.add_argument('--source-length', type=int, default=128)
+    parser.add_argument('--target-length', type=int, default=8)
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--vocab-size', type=int, default=1000)
+    parser.add_argument('--output', default=None, help="write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'torch': torch.__version__, 'cpu_count': os.cpu_count()},
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': run_benchmark(args.rows, args.layers, args.frozen_layers, args.d_model, args.source_length, args.target_length,
+                                 args.epochs, args.batch_size, args.vocab_size),
+    }
+    for result in report['results']:
+        print(f"{result['mode']:<7} cache {result['cache_s']:6.1f}s  train {result['train_s']:8.1f}s  "
+              f"{result['s_per_epoch']:6.2f}s/epoch  train loss {result['train_loss']:.4f}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
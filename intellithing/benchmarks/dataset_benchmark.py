@@ -0,0 +1,279 @@
+"""
+Throughput benchmark for the T5 dataset classes.
+
+Builds synthetic DataFrames with a local word level tokenizer (no downloads) and measures,
+per dataset class: construction time, items/sec through a DataLoader, peak RSS and the
+share of padding in the produced batches. Results are written as JSON and can be compared
+with an earlier run:
+
+    python -m intellithing.benchmarks.dataset_benchmark --rows 20000 --output current.json
+    python -m intellithing.benchmarks.dataset_benchmark --rows 20000 --compare baseline.json
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+from tokenizers.processors import TemplateProcessing
+from torch.utils.data import DataLoader
+from transformers import PreTrainedTokenizerFast, default_data_collator
+
+from intellithing.batching import T5DataCollator
+from intellithing.t5customdataset import (
+    T5RegressionDataset, T5ClassificationDataset, T5QADataset,
+    T5TextGenerationDataset, T5SummarizationDataset, T5NERDataset,
+    T5TranslationDataset
+)
+
+# Dataset class and the synthetic columns passed after the DataFrame
+DATASETS = {
+    'regression': (T5RegressionDataset, ('text', 'score')),
+    'classification': (T5ClassificationDataset, ('text', 'label')),
+    'qa': (T5QADataset, ('question', 'text', 'target')),
+    'text_generation': (T5TextGenerationDataset, ('text', 'target')),
+    'summarization': (T5SummarizationDataset, ('text', 'target')),
+    'ner': (T5NERDataset, ('text', 'target')),
+    'translation': (T5TranslationDataset, ('text', 'target')),
+}
+
+# Metrics compared by compare_results, lower is better unless listed in _HIGHER_IS_BETTER
+_METRICS = ('construction_s', 'items_per_s', 'peak_rss_mb', 'padding_waste')
+_HIGHER_IS_BETTER = ('items_per_s',)
+
+
+def make_tokenizer(vocab_size=8000):
+    """A T5-like word level tokenizer (pad=0, eos=1, unk=2) over the words `w0 ... w{n}`."""
+    tokens = ["<pad>", "</s>", "<unk>", "summarize:", "ner:", "question:", "context:"]
+    tokens += [f"w{i}" for i in range(vocab_size - len(tokens))]
+    tokenizer = Tokenizer(WordLevel({token: i for i, token in enumerate(tokens)}, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = Whitespace()
+    tokenizer.post_processor = TemplateProcessing(single="$A </s>", special_tokens=[("</s>", 1)])
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="<pad>", eos_token="</s>", unk_token="<unk>",
+                                   clean_up_tokenization_spaces=False)
+
+
+def _lengths(rng, n_rows, mean_length, distribution):
+    if distribution == 'lognormal':
+        # Long tailed, like most text corpora; sigma=0.6 puts the 99th percentile near 3x the mean
+        lengths = rng.lognormal(np.log(mean_length) - 0.18, 0.6, size=n_rows)
+    elif distribution == 'uniform':
+        lengths = rng.uniform(1, 2 * mean_length, size=n_rows)
+    elif distribution == 'constant':
+        lengths = np.full(n_rows, mean_length)
+    else:
+        raise ValueError(f"Unknown length distribution: {distribution}")
+    return np.maximum(1, lengths.round().astype(int))
+
+
+def synthetic_frame(n_rows, source_length=64, target_length=16, distribution='lognormal', vocab_size=8000, num_labels=5, seed=0):
+    """
+    Build a DataFrame with the columns used by every benchmarked dataset class: `text`
+    (about `source_length` words), `question`, `target` (about `target_length` words),
+    `label` (one of `num_labels` classes) and `score`.
+    """
+    rng = np.random.default_rng(seed)
+    words = np.array([f"w{i}" for i in range(vocab_size - 7)])
+
+    def column(mean_length):
+        lengths = _lengths(rng, n_rows, mean_length, distribution)
+        flat = words[rng.integers(0, len(words), size=lengths.sum())]
+        return [" ".join(row) for row in np.split(flat, np.cumsum(lengths)[:-1])]
+
+    return pd.DataFrame({
+        'text': column(source_length),
+        'question': column(max(1, source_length // 8)),
+        'target': column(target_length),
+        'label': [f"w{i}" for i in rng.integers(0, num_labels, size=n_rows)],
+        'score': rng.random(n_rows),
+    })
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def _run_case(tokenizer, frame, name, dataset_kwargs, batch_size, num_workers, max_batches):
+    dataset_class, columns = DATASETS[name]
+    rss_before = _peak_rss_mb()
+
+    start = time.perf_counter()
+    dataset = dataset_class(tokenizer, frame, *columns, **dataset_kwargs)
+    construction_s = time.perf_counter() - start
+
+    padded = dataset_kwargs.get('padding', 'max_length') == 'max_length' and not dataset_kwargs.get('compact')
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=default_data_collator if padded else T5DataCollator(tokenizer),
+    )
+
+    items = real_tokens = positions = 0
+    start = time.perf_counter()
+    for batch_index, batch in enumerate(loader):
+        items += len(batch['input_ids'])
+        real_tokens += int(batch['attention_mask'].sum())
+        positions += batch['attention_mask'].numel()
+        if max_batches and batch_index + 1 >= max_batches:
+            break
+    iteration_s = time.perf_counter() - start
+
+    return {
+        'dataset': name,
+        'rows': len(frame),
+        'construction_s': construction_s,
+        'items_per_s': items / iteration_s if iteration_s else float('inf'),
+        'peak_rss_mb': _peak_rss_mb(),
+        'peak_rss_increase_mb': _peak_rss_mb() - rss_before,
+        'padding_waste': 1 - real_tokens / positions if positions else 0.0,
+    }
+
+
+def _run_case_in_child(connection, *args):
+    try:
+        connection.send(_run_case(*args))
+    except Exception as error:
+        connection.send(error)
+    finally:
+        connection.close()
+
+
+def run_benchmarks(datasets=tuple(DATASETS), n_rows=10000, dataset_kwargs=None, batch_size=32, num_workers=0,
+                   max_batches=None, isolate=True, frame_kwargs=None, vocab_size=8000):
+    """
+    Benchmark every dataset in `datasets` on the same synthetic DataFrame and return one
+    result dict per dataset. With `isolate=True` (and the fork start method available) each
+    case runs in a forked child, so its peak RSS is not inflated by the previous cases.
+    """
+    dataset_kwargs = dict(dataset_kwargs or {})
+    tokenizer = make_tokenizer(vocab_size)
+    frame = synthetic_frame(n_rows, vocab_size=vocab_size, **(frame_kwargs or {}))
+    isolate = isolate and 'fork' in multiprocessing.get_all_start_methods()
+
+    results = []
+    for name in datasets:
+        args = (tokenizer, frame, name, dataset_kwargs, batch_size, num_workers, max_batches)
+        if not isolate:
+            results.append(_run_case(*args))
+            continue
+
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.get_context('fork').Process(target=_run_case_in_child, args=(sender,) + args)
+        process.start()
+        sender.close()
+        result = receiver.recv()
+        process.join()
+        if isinstance(result, Exception):
+            raise result
+        results.append(result)
+    return results
+
+
+def compare_results(baseline, current, tolerance=0.1, min_seconds=0.05):
+    """
+    Compare two benchmark reports (as written by `main`) and return one entry per dataset
+    and metric with the relative change and whether it is a regression beyond `tolerance`.
+    Construction times that differ by less than `min_seconds` are not flagged, since the
+    relative change of near-zero timings is noise.
+    """
+    baseline_results = {result['dataset']: result for result in baseline['results']}
+    comparison = []
+    for result in current['results']:
+        previous = baseline_results.get(result['dataset'])
+        if previous is None:
+            continue
+        for metric in _METRICS:
+            if not previous.get(metric):
+                continue
+            change = result[metric] / previous[metric] - 1
+            worse = -change if metric in _HIGHER_IS_BETTER else change
+            if metric == 'construction_s' and abs(result[metric] - previous[metric]) < min_seconds:
+                worse = 0.0
+            comparison.append({
+                'dataset': result['dataset'],
+                'metric': metric,
+                'baseline': previous[metric],
+                'current': result[metric],
+                'change': change,
+                'regression': worse > tolerance,
+            })
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the T5 dataset classes on synthetic data")
+    parser.add_argument('--datasets', nargs='+', default=list(DATASETS), choices=list(DATASETS))
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--source-length', type=int, default=64, help="mean number of words of the source column")
+    parser.add_argument('--target-length', type=int, default=16, help="mean number of words of the target column")
+    parser.add_argument('--distribution', default='lognormal', choices=['lognormal', 'uniform', 'constant'])
+    parser.add_argument('--vocab-size', type=int, default=8000)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--num-workers', type=int, default=0)
+    parser.add_argument('--max-batches', type=int, default=None, help="stop iterating after this many batches")
+    parser.add_argument('--pretokenize', action='store_true')
+    parser.add_argument('--dynamic-padding', action='store_true', help="build the datasets with padding=False")
+    parser.add_argument('--compact', action='store_true')
+    parser.add_argument('--num-proc', type=int, default=1)
+    parser.add_argument('--label', default=None, help="name of this run, e.g. a version or commit")
+    parser.add_argument('--output', default=None, help="write the JSON report to this file")
+    parser.add_argument('--compare', default=None, help="JSON report of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    dataset_kwargs = {'pretokenize': args.pretokenize, 'compact': args.compact, 'num_proc': args.num_proc}
+    if args.dynamic_padding:
+        dataset_kwargs['padding'] = False
+    frame_kwargs = {'source_length': args.source_length, 'target_length': args.target_length, 'distribution': args.distribution}
+
+    report = {
+        'label': args.label,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'cpu_count': multiprocessing.cpu_count(),
+        },
+        'config': {
+            'rows': args.rows, 'batch_size': args.batch_size, 'num_workers': args.num_workers,
+            'max_batches': args.max_batches, 'vocab_size': args.vocab_size,
+            'dataset_kwargs': dataset_kwargs, 'frame_kwargs': frame_kwargs,
+        },
+        'results': run_benchmarks(args.datasets, args.rows, dataset_kwargs, args.batch_size, args.num_workers,
+                                  args.max_batches, frame_kwargs=frame_kwargs, vocab_size=args.vocab_size),
+    }
+
+    for result in report['results']:
+        print(f"{result['dataset']:<16} construction {result['construction_s']:8.2f}s  {result['items_per_s']:10.1f} items/s  "
+              f"peak RSS {result['peak_rss_mb']:8.1f} MB (+{result['peak_rss_increase_mb']:.1f})  padding {result['padding_waste']:.1%}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = 0
+        for entry in compare_results(baseline, report, args.tolerance):
+            flag = 'REGRESSION' if entry['regression'] else ''
+            regressions += entry['regression']
+            print(f"{entry['dataset']:<16} {entry['metric']:<15} {entry['baseline']:12.3f} -> {entry['current']:12.3f} ({entry['change']:+.1%}) {flag}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
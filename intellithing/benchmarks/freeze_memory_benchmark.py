@@ -0,0 +1,163 @@
+"""
+Memory report of freeze configurations.
+
+Trains a randomly initialised T5 model for a few steps once per freeze configuration, each
+in a forked child, and reports the bytes of trainable and frozen weights, the optimizer
+state, the peak resident memory added by building and training the model and how much of
+it every configuration saves compared to training every layer:
+
+    python -m intellithing.benchmarks.freeze_memory_benchmark --layers 6 --d-model 256 --output memory.json
+
+With `--dtype bfloat16` every configuration that freezes layers is also run with the frozen
+layers kept in bfloat16 (`LayerFreezer.freeze_layers(dtype=...)`).
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import torch
+from transformers import T5Config, T5ForConditionalGeneration, Trainer, TrainingArguments
+
+from intellithing.batching import T5DataCollator
+from intellithing.benchmarks.dataset_benchmark import make_tokenizer, synthetic_frame
+from intellithing.layer_freezer import LayerFreezer
+from intellithing.t5customdataset import T5SummarizationDataset
+from intellithing.tuner_callbacks import ResourceUsageCallback, current_rss_bytes
+
+# Configuration name -> (frozen share of the encoder blocks, frozen share of the decoder blocks, frozen embeddings)
+CONFIGURATIONS = {
+    'none': (0.0, 0.0, False),
+    'encoder_half': (0.5, 0.0, False),
+    'encoder': (1.0, 0.0, False),
+    'encoder_and_embeddings': (1.0, 0.0, True),
+    'all_but_top_decoder_layer': (1.0, None, True),
+}
+
+
+def _freeze(model, name, dtype):
+    encoder_share, decoder_share, embeddings = CONFIGURATIONS[name]
+    freezer = LayerFreezer(model)
+    encoder_layers = int(round(freezer.num_layers('encoder') * encoder_share))
+    decoder_layers = freezer.num_layers('decoder') - 1 if decoder_share is None else int(round(freezer.num_layers('decoder') * decoder_share))
+    if encoder_layers:
+        freezer.freeze_layers(range(encoder_layers), part='encoder', dtype=dtype)
+    if decoder_layers:
+        freezer.freeze_layers(range(decoder_layers), part='decoder', dtype=dtype)
+    if embeddings:
+        model.shared.weight.requires_grad = False
+    return freezer
+
+
+def _run_case(config, dataset, tokenizer, name, dtype, steps, batch_size):
+    rss_before = current_rss_bytes()
+    torch.manual_seed(0)
+    model = T5ForConditionalGeneration(config)
+    freezer = _freeze(model, name, getattr(torch, dtype) if dtype else None)
+    total = freezer.parameter_report()[-1]
+
+    resource_usage = ResourceUsageCallback()
+    with tempfile.TemporaryDirectory() as output_dir:
+        args = TrainingArguments(output_dir=output_dir, max_steps=steps, per_device_train_batch_size=batch_size,
+                                 save_strategy="no", logging_strategy="no", report_to="none", disable_tqdm=True)
+        trainer = Trainer(model=model, args=args, train_dataset=dataset, data_collator=T5DataCollator(tokenizer),
+                          callbacks=[resource_usage])
+        trainer.train()
+    optimizer_bytes = sum(value.numel() * value.element_size() for state in trainer.optimizer.state.values()
+                          for value in state.values() if torch.is_tensor(value))
+    return {
+        'configuration': name,
+        'frozen_dtype': dtype or 'float32',
+        'trainable_mb': total['trainable_bytes'] / 1024 ** 2,
+        'frozen_mb': total['frozen_bytes'] / 1024 ** 2,
+        'optimizer_state_mb': optimizer_bytes / 1024 ** 2,
+        'peak_rss_increase_mb': resource_usage.peak_rss_mb - rss_before / 1024 ** 2,
+    }
+
+
+def _run_case_in_child(connection, *args):
+    try:
+        connection.send(_run_case(*args))
+    except Exception as error:
+        connection.send(error)
+    finally:
+        connection.close()
+
+
+def run_benchmark(configurations=tuple(CONFIGURATIONS), dtypes=(None,), n_rows=256, layers=6, d_model=256, vocab_size=8000,
+                  steps=10, batch_size=8, isolate=True):
+    """
+    Return one result per configuration and frozen dtype (None keeps float32) with the
+    memory saved compared to the first result, which should be 'none'.
+    """
+    tokenizer = make_tokenizer(vocab_size)
+    frame = synthetic_frame(n_rows, source_length=64, target_length=16, distribution='constant', vocab_size=vocab_size)
+    dataset = T5SummarizationDataset(tokenizer, frame, 'text', 'target', padding=False, pretokenize=True)
+    config = T5Config(vocab_size=len(tokenizer), d_model=d_model, d_kv=d_model // 4, d_ff=4 * d_model, num_layers=layers,
+                      num_heads=4, decoder_start_token_id=tokenizer.pad_token_id, pad_token_id=tokenizer.pad_token_id,
+                      eos_token_id=tokenizer.eos_token_id)
+    isolate = isolate and 'fork' in multiprocessing.get_all_start_methods()
+
+    results = []
+    for name in configurations:
+        for dtype in dtypes:
+            if dtype and name == 'none':
+                continue
+            args = (config, dataset, tokenizer, name, dtype, steps, batch_size)
+            if not isolate:
+                results.append(_run_case(*args))
+                continue
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.get_context('fork').Process(target=_run_case_in_child, args=(sender,) + args)
+            process.start()
+            sender.close()
+            result = receiver.recv()
+            process.join()
+            if isinstance(result, Exception):
+                raise result
+            results.append(result)
+
+    baseline = results[0]['peak_rss_increase_mb']
+    for result in results:
+        result['rss_saved_mb'] = baseline - result['peak_rss_increase_mb']
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report the memory saved by freeze configurations")
+    parser.add_argument('--configurations', nargs='+', default=list(CONFIGURATIONS), choices=list(CONFIGURATIONS))
+    parser.add_argument('--dtype', default=None, choices=['bfloat16', 'float16'],
+                        help="also run every configuration with the frozen layers in this dtype")
+    parser.add_argument('--rows', type=int, default=256)
+    parser.add_argument('--layers', type=int, default=6)
+    parser.add_argument('--d-model', type=int, default=256)
+    parser.add_argument('--vocab-size', type=int, default=8000)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--output', default=None, help="write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'torch': torch.__version__, 'cpu_count': os.cpu_count()},
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': run_benchmark(args.configurations, (None, args.dtype) if args.dtype else (None,), args.rows, args.layers,
+                                 args.d_model, args.vocab_size, args.steps, args.batch_size),
+    }
+    print(f"{'configuration':<26} {'frozen':>8} {'trainable':>10} {'frozen':>8} {'optimizer':>10} {'peak RSS':>9} {'saved':>8}")
+    for result in report['results']:
+        print(f"{result['configuration']:<26} {result['frozen_dtype']:>8} {result['trainable_mb']:8.1f}MB {result['frozen_mb']:6.1f}MB "
+              f"{result['optimizer_state_mb']:8.1f}MB {result['peak_rss_increase_mb']:7.1f}MB {result['rss_saved_mb']:6.1f}MB")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
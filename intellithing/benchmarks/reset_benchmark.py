@@ -0,0 +1,94 @@
+"""
+Time to reset the tuner's model between trials against reloading it from disk.
+
+Saves a randomly initialised T5 model (t5-small sized by default, about 60M parameters)
+to a temporary directory, builds a `HyperparameterTuner` on it and times, after one
+warm-up call each, `_reset_model()` (the in-memory copy every trial starts from) and
+`_load_model()` (`from_pretrained` with the checkpoint in the page cache):
+
+    python -m intellithing.benchmarks.reset_benchmark --repeats 5 --output reset.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import torch
+from transformers import T5Config, T5ForConditionalGeneration
+
+from intellithing.hyper_tuner import HyperparameterTuner
+
+
+def _timed(function, repeats, setup=None):
+    """Call `function` once to warm up, then return the time of `repeats` calls, each after an untimed `setup()`."""
+    times = []
+    for call in range(repeats + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        if call:
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def run_benchmark(d_model=512, layers=6, num_heads=8, vocab_size=32128, repeats=5):
+    """Return the mean and median time of both methods in milliseconds and the model's parameter count."""
+    config = T5Config(vocab_size=vocab_size, d_model=d_model, d_kv=d_model // num_heads, d_ff=4 * d_model, num_layers=layers,
+                      num_heads=num_heads, decoder_start_token_id=0, pad_token_id=0, eos_token_id=1)
+    with tempfile.TemporaryDirectory() as model_dir:
+        torch.manual_seed(0)
+        model = T5ForConditionalGeneration(config)
+        num_parameters = model.num_parameters()
+        model.save_pretrained(model_dir)
+        del model
+        tuner = HyperparameterTuner(model_dir, None, None, None)
+
+        def change_weights():
+            # What a trial leaves behind
+            with torch.no_grad():
+                for param in tuner.model.parameters():
+                    param.add_(1.0)
+
+        reset_times = _timed(tuner._reset_model, repeats, setup=change_weights)
+        load_times = _timed(tuner._load_model, repeats)
+
+    results = []
+    for method, times in (('reset_model', reset_times), ('load_model', load_times)):
+        results.append({'method': method, 'parameters': num_parameters, 'mean_ms': 1000 * statistics.mean(times),
+                        'median_ms': 1000 * statistics.median(times)})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the in-memory model reset against reloading from disk")
+    parser.add_argument('--d-model', type=int, default=512)
+    parser.add_argument('--layers', type=int, default=6)
+    parser.add_argument('--num-heads', type=int, default=8)
+    parser.add_argument('--vocab-size', type=int, default=32128)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', default=None, help="write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'torch': torch.__version__, 'cpu_count': os.cpu_count()},
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': run_benchmark(args.d_model, args.layers, args.num_heads, args.vocab_size, args.repeats),
+    }
+    for result in report['results']:
+        print(f"{result['method']:<12} {result['parameters'] / 1e6:6.1f}M parameters  mean {result['mean_ms']:8.1f} ms  "
+              f"median {result['median_ms']:8.1f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
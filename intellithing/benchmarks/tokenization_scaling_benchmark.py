@@ -0,0 +1,120 @@
+"""
+Scaling of pretokenization with `num_proc` against the fast tokenizer's own parallelism.
+
+Builds a `T5QADataset` with `pretokenize=True` from a synthetic frame once per case, each
+in a forked child:
+
+- 'processes': `num_proc` worker processes, each tokenizing whole batches with the
+  tokenizer's thread pool turned off (`TOKENIZERS_PARALLELISM=false`);
+- 'rust_threads': a single process whose fast tokenizer spreads every batch over
+  `RAYON_NUM_THREADS` threads (`TOKENIZERS_PARALLELISM=true`).
+
+    python -m intellithing.benchmarks.tokenization_scaling_benchmark --rows 100000 --workers 1 2 4 8 --output scaling.json
+
+Speedups are relative to one process without tokenizer threads. On a machine with fewer
+cores than workers the extra workers can only add overhead, so check `usable_cpus` in the
+report before reading the numbers.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+import torch
+
+from intellithing.benchmarks.dataset_benchmark import make_tokenizer, synthetic_frame
+from intellithing.t5customdataset import T5QADataset
+
+MODES = ('processes', 'rust_threads')
+
+
+def _run_case(tokenizer, frame, mode, workers, tokenize_batch_size, source_max_len):
+    # Read by the tokenizers library when its thread pool first starts, which is in this process
+    os.environ['TOKENIZERS_PARALLELISM'] = 'true' if mode == 'rust_threads' else 'false'
+    os.environ['RAYON_NUM_THREADS'] = str(workers if mode == 'rust_threads' else 1)
+    start = time.perf_counter()
+    T5QADataset(tokenizer, frame, 'question', 'text', 'target', source_max_len=source_max_len, pretokenize=True,
+                padding=False, tokenize_batch_size=tokenize_batch_size, num_proc=workers if mode == 'processes' else 1)
+    return {'mode': mode, 'workers': workers, 'construction_s': time.perf_counter() - start}
+
+
+def _run_case_in_child(connection, *args):
+    try:
+        connection.send(_run_case(*args))
+    except Exception as error:
+        connection.send(error)
+    finally:
+        connection.close()
+
+
+def run_benchmark(n_rows=100000, workers=(1, 2, 4), modes=MODES, source_length=300, tokenize_batch_size=1000, source_max_len=512,
+                  vocab_size=8000):
+    """
+    Return the construction time of every mode and worker count, with the speedup over one
+    process without tokenizer threads (the first 'processes' case, which is always run).
+
+    The tokenizer's thread pool does not survive a fork, so 'rust_threads' cases need a
+    calling process that has not batch-encoded with it yet, such as the command line.
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        raise RuntimeError("The scaling benchmark needs the fork start method to run every case in a fresh process")
+    tokenizer = make_tokenizer(vocab_size)
+    # Contexts of uniformly 1 to 2 * source_length words
+    frame = synthetic_frame(n_rows, source_length=source_length, target_length=16, distribution='uniform', vocab_size=vocab_size)
+
+    cases = [('processes', 1)] + [(mode, count) for mode in modes for count in workers if (mode, count) != ('processes', 1)]
+    results = []
+    for mode, count in cases:
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.get_context('fork').Process(
+            target=_run_case_in_child, args=(sender, tokenizer, frame, mode, count, tokenize_batch_size, source_max_len))
+        process.start()
+        sender.close()
+        result = receiver.recv()
+        process.join()
+        if isinstance(result, Exception):
+            raise result
+        results.append(result)
+
+    baseline = results[0]['construction_s']
+    for result in results:
+        result['speedup'] = baseline / result['construction_s']
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare num_proc tokenization with the fast tokenizer's thread pool")
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--source-length', type=int, default=300, help="mean number of words of the contexts")
+    parser.add_argument('--tokenize-batch-size', type=int, default=1000)
+    parser.add_argument('--source-max-len', type=int, default=512)
+    parser.add_argument('--output', default=None, help="write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    usable_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'torch': torch.__version__, 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count(), 'usable_cpus': usable_cpus},
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': run_benchmark(args.rows, args.workers, args.modes, args.source_length, args.tokenize_batch_size,
+                                 args.source_max_len),
+    }
+    if max(args.workers) > usable_cpus:
+        print(f"Only {usable_cpus} usable CPUs: cases with more workers than that cannot scale")
+    for result in report['results']:
+        print(f"{result['mode']:<13} {result['workers']:>3} workers  {result['construction_s']:8.2f}s  x{result['speedup']:.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
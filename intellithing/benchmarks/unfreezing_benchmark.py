@@ -0,0 +1,116 @@
+"""
+Gradual unfreezing versus full fine-tuning of a small T5 model.
+
+A randomly initialised T5 model is first trained on a copy task (the target is the start of
+the source text) to stand in for a pretrained model. From that snapshot it is fine-tuned on
+a related task (the target is the end of the source text) once with every layer trainable
+and once with `GradualUnfreezingCallback`, and the wall-clock time and the eval loss of
+both runs are reported:
+
+    python -m intellithing.benchmarks.unfreezing_benchmark --layers 6 --epochs 6 --output unfreezing.json
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import pandas as pd
+import torch
+from transformers import T5Config, T5ForConditionalGeneration, Trainer, TrainingArguments
+
+from intellithing.batching import T5DataCollator
+from intellithing.benchmarks.dataset_benchmark import make_tokenizer, synthetic_frame
+from intellithing.gradual_unfreezing import GradualUnfreezingCallback
+from intellithing.t5customdataset import T5SummarizationDataset
+
+
+def _task_frame(n_rows, target_words, from_end, seed, vocab_size):
+    frame = synthetic_frame(n_rows, source_length=32, distribution='uniform', vocab_size=vocab_size, seed=seed)
+    words = frame['text'].str.split()
+    target = words.str[-target_words:] if from_end else words.str[:target_words]
+    return pd.DataFrame({'text': frame['text'], 'target': target.str.join(' ')})
+
+
+def _train(model, tokenizer, train_dataset, eval_dataset, epochs, learning_rate, batch_size, callbacks=None):
+    with tempfile.TemporaryDirectory() as output_dir:
+        args = TrainingArguments(
+            output_dir=output_dir, num_train_epochs=epochs, learning_rate=learning_rate,
+            per_device_train_batch_size=batch_size, per_device_eval_batch_size=batch_size,
+            save_strategy="no", logging_strategy="no", report_to="none", disable_tqdm=True,
+        )
+        trainer = Trainer(model=model, args=args, train_dataset=train_dataset, eval_dataset=eval_dataset,
+                          data_collator=T5DataCollator(tokenizer), callbacks=callbacks)
+        start = time.perf_counter()
+        trainer.train()
+        train_s = time.perf_counter() - start
+        return train_s, trainer.evaluate()['eval_loss']
+
+
+def run_benchmark(n_rows=2000, layers=6, d_model=128, pretrain_epochs=4, epochs=6, learning_rate=1e-3, batch_size=32,
+                  vocab_size=1000, unfreezing_kwargs=None, seed=0):
+    """Return the time and eval loss of full fine-tuning and of gradual unfreezing from the same snapshot."""
+    torch.manual_seed(seed)
+    tokenizer = make_tokenizer(vocab_size)
+    dataset_kwargs = {'padding': False, 'pretokenize': True, 'source_max_len': 64, 'target_max_len': 16}
+
+    def datasets(from_end):
+        train = _task_frame(n_rows, 8, from_end, seed, vocab_size)
+        evaluation = _task_frame(max(1, n_rows // 5), 8, from_end, seed + 1, vocab_size)
+        return (T5SummarizationDataset(tokenizer, train, 'text', 'target', **dataset_kwargs),
+                T5SummarizationDataset(tokenizer, evaluation, 'text', 'target', **dataset_kwargs))
+
+    config = T5Config(vocab_size=len(tokenizer), d_model=d_model, d_kv=d_model // 4, d_ff=4 * d_model, num_layers=layers,
+                      num_heads=4, decoder_start_token_id=tokenizer.pad_token_id, pad_token_id=tokenizer.pad_token_id,
+                      eos_token_id=tokenizer.eos_token_id)
+    pretrained = T5ForConditionalGeneration(config)
+    _train(pretrained, tokenizer, *datasets(False), pretrain_epochs, learning_rate, batch_size)
+
+    train_dataset, eval_dataset = datasets(True)
+    results = []
+    for mode in ('full', 'gradual'):
+        model = copy.deepcopy(pretrained)
+        callbacks = [GradualUnfreezingCallback(**(unfreezing_kwargs or {}))] if mode == 'gradual' else None
+        train_s, eval_loss = _train(model, tokenizer, train_dataset, eval_dataset, epochs, learning_rate, batch_size, callbacks)
+        results.append({'mode': mode, 'train_s': train_s, 's_per_epoch': train_s / epochs, 'eval_loss': eval_loss})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark gradual unfreezing against full fine-tuning")
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--layers', type=int, default=6)
+    parser.add_argument('--d-model', type=int, default=128)
+    parser.add_argument('--pretrain-epochs', type=int, default=4)
+    parser.add_argument('--epochs', type=int, default=6)
+    parser.add_argument('--learning-rate', type=float, default=1e-3)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--vocab-size', type=int, default=1000)
+    parser.add_argument('--initial-layers', type=int, default=2)
+    parser.add_argument('--layers-per-stage', type=int, default=4)
+    parser.add_argument('--lr-decay', type=float, default=None)
+    parser.add_argument('--output', default=None, help="write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    unfreezing_kwargs = {'initial_layers': args.initial_layers, 'layers_per_stage': args.layers_per_stage, 'lr_decay': args.lr_decay}
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'torch': torch.__version__, 'cpu_count': os.cpu_count()},
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': run_benchmark(args.rows, args.layers, args.d_model, args.pretrain_epochs, args.epochs, args.learning_rate,
+                                 args.batch_size, args.vocab_size, unfreezing_kwargs=unfreezing_kwargs),
+    }
+    for result in report['results']:
+        print(f"{result['mode']:<8} {result['train_s']:8.1f}s  {result['s_per_epoch']:6.2f}s/epoch  eval loss {result['eval_loss']:.4f}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
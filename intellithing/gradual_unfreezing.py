@@ -0,0 +1,158 @@
+from transformers import TrainerCallback
+from transformers.pytorch_utils import ALL_LAYERNORM_LAYERS
+from transformers.trainer_pt_utils import get_parameter_names
+
+from intellithing.layer_freezer import LayerFreezer
+
+
+class GradualUnfreezingCallback(TrainerCallback):
+    """
+    Train the top layers first and unfreeze the network downwards as training goes.
+
+    When the Trainer is created, every layer of `part` ('all', 'encoder', 'decoder' or the
+    path of a layer stack) is frozen except the top `initial_layers`. Every `every_n_epochs`
+    epochs (or `every_n_steps` optimizer steps) the next `layers_per_stage` layers are
+    unfrozen, top to bottom: the decoder first, then the encoder. Unfrozen parameters are
+    added to the optimizer as new parameter groups, and the learning rate scheduler is
+    extended to them, so the optimizer state of the layers trained so far is kept.
+
+    With `lr_decay` every layer trains with `learning_rate * lr_decay ** depth`, its depth
+    counted from the top of the schedule. The other parameters (embeddings, heads, final
+    norms) train from the start with `train_other=True`; by default they are unfrozen with
+    the last layers, since T5 ties its output head to the input embeddings and a trainable
+    embedding makes every backward pass run through all the frozen layers below.
+    """
+
+    def __init__(self, initial_layers=1, layers_per_stage=1, every_n_epochs=1, every_n_steps=None, part='all',
+                 lr_decay=None, train_other=False):
+        if initial_layers < 1 and not train_other:
+            raise ValueError("Nothing would be trainable at the start, use initial_layers >= 1 or train_other=True")
+        self.initial_layers = initial_layers
+        self.layers_per_stage = layers_per_stage
+        self.every_n_epochs = every_n_epochs
+        self.every_n_steps = every_n_steps
+        self.part = part
+        self.lr_decay = lr_decay
+        self.train_other = train_other
+        self.freezer = None
+        # Layer keys of LayerFreezer in unfreezing order, and how many of them are unfrozen
+        self.schedule = []
+        self.unfrozen = 0
+        self.stage = 0
+        self._other_params = []
+        self._depths = {}
+        self._lr_lambda = None
+
+    def _build_schedule(self, model):
+        self.freezer = LayerFreezer(model)
+        parts = ['decoder', 'encoder'] if self.part == 'all' else [self.part]
+        self.schedule = []
+        for part in parts:
+            if part not in self.freezer.parts:
+                continue
+            stack = self.freezer.parts[part]
+            self.schedule += [(stack, idx) for idx in reversed(range(self.freezer.num_layers(stack)))]
+        if not self.schedule:
+            raise ValueError(f"No layers to unfreeze for part {self.part!r}")
+
+        self._depths = {}
+        for depth, key in enumerate(self.schedule):
+            for param in self.freezer.layers[key]:
+                self._depths[id(param)] = depth
+        scheduled = set(self._depths)
+        self._other_params = [param for param in model.parameters() if id(param) not in scheduled]
+
+    @property
+    def num_stages(self):
+        remaining = max(0, len(self.schedule) - self.initial_layers)
+        return 1 + -(-remaining // self.layers_per_stage)
+
+    def on_init_end(self, args, state, control, model=None, **kwargs):
+        # Freeze before the Trainer builds its optimizer from the trainable parameters
+        self._build_schedule(model)
+        for key in self.schedule:
+            for param in self.freezer.layers[key]:
+                param.requires_grad = False
+        if not self.train_other:
+            for param in self._other_params:
+                param.requires_grad = False
+        self.unfrozen = 0
+        self.stage = 0
+        self._unfreeze(min(self.initial_layers, len(self.schedule)))
+
+    def _unfreeze(self, count, optimizer=None, lr_scheduler=None, args=None):
+        new_params = []
+        for key in self.schedule[self.unfrozen:self.unfrozen + count]:
+            for param in self.freezer.layers[key]:
+                if not param.requires_grad:
+                    param.requires_grad = True
+                    new_params.append(param)
+        self.unfrozen += count
+        if self.unfrozen >= len(self.schedule) and not self.train_other:
+            for param in self._other_params:
+                if not param.requires_grad:
+                    param.requires_grad = True
+                    new_params.append(param)
+        if optimizer is not None and new_params:
+            self._add_param_groups(new_params, optimizer, lr_scheduler, args)
+
+    def _lr_scale(self, param):
+        if not self.lr_decay:
+            return 1.0
+        return self.lr_decay ** self._depths.get(id(param), 0)
+
+    def _add_param_groups(self, params, optimizer, lr_scheduler, args, weight_decays=None):
+        """Add `params` to the optimizer, one group per learning rate and weight decay, and extend the scheduler."""
+        decay_names = {name for name in get_parameter_names(self.freezer.model, ALL_LAYERNORM_LAYERS) if 'bias' not in name}
+        decay_ids = {id(param) for name, param in self.freezer.model.named_parameters() if name in decay_names}
+        groups = {}
+        for param in params:
+            if weight_decays is not None:
+                weight_decay = weight_decays[id(param)]
+            else:
+                weight_decay = args.weight_decay if id(param) in decay_ids else 0.0
+            groups.setdefault((self._lr_scale(param), weight_decay), []).append(param)
+
+        scheduler = self._torch_scheduler(lr_scheduler)
+        for (scale, weight_decay), group_params in groups.items():
+            lr = args.learning_rate * scale
+            optimizer.add_param_group({'params': group_params, 'lr': lr, 'initial_lr': lr, 'weight_decay': weight_decay})
+            if scheduler is not None:
+                # Start the new group at the current point of the schedule
+                scheduler.base_lrs.append(lr)
+                scheduler.lr_lambdas.append(self._lr_lambda)
+                optimizer.param_groups[-1]['lr'] = lr * self._lr_lambda(scheduler.last_epoch)
+        if scheduler is not None:
+            scheduler._last_lr = [group['lr'] for group in optimizer.param_groups]
+
+    @staticmethod
+    def _torch_scheduler(lr_scheduler):
+        # Schedulers wrapped by accelerate keep the torch scheduler in `scheduler`; only LambdaLR can be extended
+        scheduler = getattr(lr_scheduler, 'scheduler', lr_scheduler)
+        return scheduler if hasattr(scheduler, 'lr_lambdas') else None
+
+    def on_train_begin(self, args, state, control, optimizer=None, lr_scheduler=None, **kwargs):
+        scheduler = self._torch_scheduler(lr_scheduler)
+        self._lr_lambda = scheduler.lr_lambdas[0] if scheduler is not None and scheduler.lr_lambdas else None
+        if optimizer is None or not self.lr_decay:
+            return
+        # Split the Trainer's groups by depth so every layer gets its decayed learning rate
+        weight_decays = {id(param): group['weight_decay'] for group in optimizer.param_groups for param in group['params']}
+        params = [param for group in optimizer.param_groups for param in group['params']]
+        optimizer.param_groups = []
+        if scheduler is not None:
+            scheduler.base_lrs, scheduler.lr_lambdas = [], []
+        self._add_param_groups(params, optimizer, lr_scheduler, args, weight_decays)
+
+    def _advance(self, target_stage, optimizer, lr_scheduler, args):
+        while self.stage < min(target_stage, self.num_stages - 1):
+            self.stage += 1
+            self._unfreeze(self.layers_per_stage, optimizer, lr_scheduler, args)
+
+    def on_epoch_begin(self, args, state, control, optimizer=None, lr_scheduler=None, **kwargs):
+        if self.every_n_steps is None:
+            self._advance(int(round(state.epoch or 0)) // self.every_n_epochs, optimizer, lr_scheduler, args)
+
+    def on_step_end(self, args, state, control, optimizer=None, lr_scheduler=None, **kwargs):
+        if self.every_n_steps is not None:
+            self._advance(state.global_step // self.every_n_steps, optimizer, lr_scheduler, args)
@@ -1,140 +1,902 @@
-import optuna
-
-from transformers import (
-    AutoConfig,
-    AutoModelForSequenceClassification,  # for sequence classification tasks
-    AutoModelForCausalLM,                # for causal language models (e.g., GPT-2)
-    AutoModelForSeq2SeqLM,               # for sequence-to-sequence models (e.g., T5, BART)
-    AutoModelForTokenClassification,     # for token classification tasks (e.g., NER, POS tagging)
-    AutoTokenizer,
-    DataCollatorForSeq2Seq,              # if you're working with seq2seq tasks
-    Trainer,
-    TrainingArguments,
-    default_data_collator,               # default data collator handles batching, padding, etc.
-)
-
-from sklearn.model_selection import train_test_split  # for data splitting
-
-
-class HyperparameterTuner:
-    def __init__(self, model_name, tokenizer, train_dataset, val_dataset):
-        self.model_name = model_name
-        self.tokenizer = tokenizer
-        self.train_dataset = train_dataset
-        self.val_dataset = val_dataset
-        self.best_params = None
-
-        self.config = AutoConfig.from_pretrained(model_name)
-        self.model_type = self.config.model_type
-        self.model = self._load_model()  # This method should load the model based on self.model_name and self.model_type
-
-        
-        
-    def _load_model(self):
-        """
-        Load the appropriate model based on the model_type. Additional handling for different models
-        can be added as needed.
-        """
-        config = AutoConfig.from_pretrained(self.model_name)
-        model_type = config.model_type  # Identify the type of model
-
-        # A dictionary to hold model classes for different types of tasks.
-        # This dictionary can expand as we encounter new types of tasks.
-        model_classes = {
-            "sequence_classification": AutoModelForSequenceClassification,
-            "causal_lm": AutoModelForCausalLM,
-            "seq2seq_lm": AutoModelForSeq2SeqLM,
-            "token_classification": AutoModelForTokenClassification,
-            # Add other task types here...
-        }
-
-        # Here, we handle a variety of model types. This is not exhaustive and should be expanded as needed.
-        if model_type in ["bert", "roberta", "distilbert", "electra", "xlnet", "transfo-xl", "reformer", "longformer", "deberta", "deberta-v2", "bigbird"]:
-            # The majority are sequence classification tasks. Adjust as necessary for your use case.
-            model_class = model_classes["sequence_classification"]
-
-        elif model_type == "gpt2":
-            model_class = model_classes["causal_lm"]
-
-        elif model_type in ["t5", "bart", "pegasus", "bigbird_pegasus"]:
-            model_class = model_classes["seq2seq_lm"]
-
-        elif model_type == "layoutlm":
-            model_class = model_classes["token_classification"]
-
-        # ... other specific model type handling ...
-
-        else:
-            raise ValueError(f"Unsupported model type: {model_type}. Add appropriate handling.")
-
-        # Load the model with the determined class.
-        model = model_class.from_pretrained(self.model_name, config=config)
-        return model
-
-
-    def objective(self, trial):
-        # Hyperparameter settings remain unchanged
-        lr = trial.suggest_float("lr", 1e-5, 5e-5, log=True)
-        per_device_train_batch_size = trial.suggest_categorical("per_device_train_batch_size", [2, 4, 8])
-        warmup_steps = trial.suggest_int("warmup_steps", 0, 1000)
-        weight_decay = trial.suggest_float("weight_decay", 0.0, 0.3)
-        num_train_epochs = trial.suggest_int("num_train_epochs", 1, 5)
-        adam_epsilon = trial.suggest_float("adam_epsilon", 1e-8, 1e-6)
-        gradient_accumulation_steps = trial.suggest_categorical("gradient_accumulation_steps", [1, 2, 4])
-
-
-
-        # Setting training arguments
-        training_args = TrainingArguments(
-            output_dir='./results',
-            num_train_epochs=num_train_epochs,
-            learning_rate=lr,
-            per_device_train_batch_size=per_device_train_batch_size,
-            warmup_steps=warmup_steps,
-            weight_decay=weight_decay,
-            adam_epsilon=adam_epsilon,
-            gradient_accumulation_steps=gradient_accumulation_steps,
-            evaluation_strategy="steps",
-            eval_steps=100,
-            logging_dir='./logs',
-            logging_steps=10,
-            load_best_model_at_end=True,
-            metric_for_best_model="loss",
-            greater_is_better=False,
-        )
-
-
-        trainer = Trainer(
-            model=self.model,
-            args=training_args,
-            train_dataset=self.train_dataset,
-            eval_dataset=self.val_dataset,
-        )
-
-        trainer.train()
-        evaluation = trainer.evaluate()
-
-        return evaluation['eval_loss']
-
-    def tune_hyperparameters(self, n_trials=10, subset_size=0.1, timeout=None):
-        if subset_size <= 0 or subset_size > 1:
-            raise ValueError("subset_size should be greater than 0 and less than or equal to 1")
-
-        # Subsetting the dataset for the tuning process
-        train_subset, _ = train_test_split(self.train_dataset, train_size=subset_size, shuffle=True, stratify=None)
-
-        # Adjusting the training dataset for the tuning process
-        self.train_dataset = train_subset
-
-        # Creating a study and optimizing the objective
-        study = optuna.create_study(direction="minimize")
-        study.optimize(self.objective, n_trials=n_trials, timeout=timeout)
-
-        self.best_params = study.best_params
-        return self.best_params
-
-
-# Usage example:
-# You need to ensure 'model_name', 'tokenizer', 'train_dataset', and 'val_dataset' are properly defined before this step.
-# tuner = HyperparameterTuner(model_name, tokenizer, train_dataset, val_dataset)
-# best_params = tuner.tune_hyperparameters(n_trials=10, subset_size=0.1)  # Adjust as necessary according to GPU memory available
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import optuna
+import pandas as pd
+import torch
+
+from transformers import (
+    AutoConfig,
+    AutoModelForSequenceClassification,  # for sequence classification tasks
+    AutoModelForCausalLM,                # for causal language models (e.g., GPT-2)
+    AutoModelForSeq2SeqLM,               # for sequence-to-sequence models (e.g., T5, BART)
+    AutoModelForTokenClassification,     # for token classification tasks (e.g., NER, POS tagging)
+    AutoTokenizer,
+    DataCollatorForSeq2Seq,              # if you're working with seq2seq tasks
+    Trainer,
+    TrainingArguments,
+    default_data_collator,               # default data collator handles batching, padding, etc.
+)
+
+from torch.utils.data import IterableDataset, Subset
+
+from intellithing.activation_cache import FrozenPrefixCache, FrozenPrefixTrainer
+from intellithing.batching import LengthBucketTrainer, PackedSeq2SeqTrainer, T5DataCollator
+from intellithing.token_cache import TokenCache
+from intellithing.trial_cache import TrialCache
+from intellithing.tuner_callbacks import OptunaPruningCallback, ResourceUsageCallback, StepTimerCallback, make_pruner
+
+
+class HyperparameterTuner:
+    def __init__(self, model_name, tokenizer, train_dataset, val_dataset, data_collator=None, length_bucketing=False):
+        self.model_name = model_name
+        self.tokenizer = tokenizer
+        self.train_dataset = train_dataset
+        self.val_dataset = val_dataset
+        # The trials train on this view of train_dataset, set by tune_hyperparameters(subset_size=...)
+        self.tuning_dataset = train_dataset
+        self.best_params = None
+
+        # Use T5DataCollator and length_bucketing=True with datasets built with padding=False
+        self.data_collator = data_collator
+        if data_collator is None and getattr(train_dataset, 'compact', False):
+            # Items of datasets built with compact=True (int16/int32 ids) are upcast by T5DataCollator only
+            self.data_collator = T5DataCollator(tokenizer)
+        self.length_bucketing = length_bucketing
+        # Datasets built with packing=True need the segment-aware PackedSeq2SeqTrainer
+        self.packing = getattr(train_dataset, 'packing', False)
+
+        self.config = AutoConfig.from_pretrained(model_name)
+        self.model_type = self.config.model_type
+        self.model = self._load_model()  # This method should load the model based on self.model_name and self.model_type
+        # Pretrained weights every trial starts from, see _reset_model
+        self._initial_state = self._snapshot_model(self.model)
+        self._initial_requires_grad = None
+        # Successive halving rungs of the multi-fidelity mode, see tune_hyperparameters
+        self._fidelity_fractions = None
+        self._fidelity_order = None
+        self.tuning_cost = None
+        # Set by tune_hyperparameters(keep_best_checkpoint=True)
+        self.keep_best_checkpoint = False
+        # Set by tune_hyperparameters(keep_all_checkpoints=True), see AutoTrainer.auto_train
+        self.keep_all_checkpoints = False
+        self.best_checkpoint = None
+        self.best_checkpoint_step = 0
+        # Cost attributes minimized next to the eval loss, see tune_hyperparameters(cost_objectives=...)
+        self._cost_objectives = ()
+        self.trial_results = []
+        self.pareto_front = None
+        # Batch size choices set by probe_batch_sizes, None keeps the default search space
+        self.search_space = None
+        self.batch_size_probe = None
+        # Set by tune_hyperparameters(trial_cache=...)
+        self._trial_cache = None
+        self._trial_cache_context = None
+        # FrozenPrefixCache arguments set by tune_hyperparameters(activation_cache=...)
+        self.activation_cache = None
+        # The FrozenPrefixCache shared by the trials and the final run, so datasets are only read once
+        self._prefix_cache = None
+
+        
+        
+    def _load_model(self):
+        """
+        Load the appropriate model based on the model_type. Additional handling for different models
+        can be added as needed.
+        """
+        config = AutoConfig.from_pretrained(self.model_name)
+        model_type = config.model_type  # Identify the type of model
+
+        # A dictionary to hold model classes for different types of tasks.
+        # This dictionary can expand as we encounter new types of tasks.
+        model_classes = {
+            "sequence_classification": AutoModelForSequenceClassification,
+            "causal_lm": AutoModelForCausalLM,
+            "seq2seq_lm": AutoModelForSeq2SeqLM,
+            "token_classification": AutoModelForTokenClassification,
+            # Add other task types here...
+        }
+
+        # Here, we handle a variety of model types. This is not exhaustive and should be expanded as needed.
+        if model_type in ["bert", "roberta", "distilbert", "electra", "xlnet", "transfo-xl", "reformer", "longformer", "deberta", "deberta-v2", "bigbird"]:
+            # The majority are sequence classification tasks. Adjust as necessary for your use case.
+            model_class = model_classes["sequence_classification"]
+
+        elif model_type == "gpt2":
+            model_class = model_classes["causal_lm"]
+
+        elif model_type in ["t5", "bart", "pegasus", "bigbird_pegasus"]:
+            model_class = model_classes["seq2seq_lm"]
+
+        elif model_type == "layoutlm":
+            model_class = model_classes["token_classification"]
+
+        # ... other specific model type handling ...
+
+        else:
+            raise ValueError(f"Unsupported model type: {model_type}. Add appropriate handling.")
+
+        # Load the model with the determined class.
+        model = model_class.from_pretrained(self.model_name, config=config)
+        return model
+
+    @staticmethod
+    def _tensor_key(tensor):
+        """Identify the memory a tensor views: tied parameters share it, views starting at the same address may not."""
+        return tensor.device, tensor.data_ptr(), tuple(tensor.shape), tensor.stride(), tensor.dtype
+
+    @staticmethod
+    def _snapshot_model(model):
+        """
+        Copy the model's weights and buffers to shared CPU memory. Tied parameters are copied
+        once, and forked tuning workers read the copy without duplicating it.
+        """
+        copies, state = {}, {}
+        for name, tensor in model.state_dict().items():
+            key = HyperparameterTuner._tensor_key(tensor)
+            if key not in copies:
+                copies[key] = tensor.detach().to('cpu', copy=True).share_memory_()
+            state[name] = copies[key]
+        return state
+
+    def _reset_model(self):
+        """
+        Restore the pretrained weights in place (an in-memory copy, no reload from disk), the
+        requires_grad flags recorded when tuning started (e.g. set with LayerFreezer) and
+        drop any gradients, so every trial starts from the same model.
+        """
+        # Copy in place, once per tied tensor (load_state_dict would copy tied embeddings several times)
+        restored = set()
+        with torch.no_grad():
+            for name, tensor in self.model.state_dict(keep_vars=True).items():
+                key = self._tensor_key(tensor)
+                if key not in restored:
+                    restored.add(key)
+                    tensor.copy_(self._initial_state[name])
+        if self._initial_requires_grad is not None:
+            for name, param in self.model.named_parameters():
+                param.requires_grad = self._initial_requires_grad[name]
+        self.model.zero_grad(set_to_none=True)
+        self.model.train()
+
+    @staticmethod
+    def _training_length(train_dataset, num_train_epochs, per_device_train_batch_size, gradient_accumulation_steps):
+        """
+        TrainingArguments controlling how long to train. Streaming (iterable) datasets have no
+        len(), so the Trainer needs max_steps, derived from the dataset's `num_examples`.
+        """
+        if not isinstance(train_dataset, IterableDataset):
+            return {'num_train_epochs': num_train_epochs}
+
+        num_examples = getattr(train_dataset, 'num_examples', None)
+        if not num_examples:
+            raise ValueError("Streaming datasets need num_examples (or count_examples()) to derive the number of training steps.")
+        steps_per_epoch = math.ceil(num_examples / (per_device_train_batch_size * gradient_accumulation_steps))
+        return {'num_train_epochs': num_train_epochs, 'max_steps': steps_per_epoch * num_train_epochs}
+
+    def _build_trainer(self, training_args, train_dataset, eval_dataset, callbacks=None):
+        """
+        Build the Trainer used by the tuning trials and the final training run, with the
+        configured data collator and, if enabled, length-bucketed training batches or
+        segment-aware masking of packed examples. With an activation cache the datasets are
+        wrapped with the cached frozen-prefix activations of the current model. The Trainer
+        builds its optimizer over the parameters with requires_grad only.
+        """
+        if self.activation_cache is not None:
+            if self._prefix_cache is None:
+                self._prefix_cache = FrozenPrefixCache(self.model, **self.activation_cache)
+            prefix_cache = self._prefix_cache
+            return FrozenPrefixTrainer(
+                model=self.model,
+                args=training_args,
+                train_dataset=prefix_cache.wrap(train_dataset),
+                eval_dataset=prefix_cache.wrap(eval_dataset) if eval_dataset is not None else None,
+                data_collator=self.data_collator,
+                callbacks=callbacks,
+                prefix_cache=prefix_cache,
+                bucket_size_multiplier=50 if self.length_bucketing else None,
+            )
+        if self.packing:
+            trainer_class = PackedSeq2SeqTrainer
+        elif self.length_bucketing:
+            trainer_class = LengthBucketTrainer
+        else:
+            trainer_class = Trainer
+        return trainer_class(
+            model=self.model,
+            args=training_args,
+            train_dataset=train_dataset,
+            eval_dataset=eval_dataset,
+            data_collator=self.data_collator,
+            callbacks=callbacks,
+        )
+
+    def _suggest_params(self, trial):
+        params = {
+            'lr': trial.suggest_float("lr", 1e-5, 5e-5, log=True),
+            'warmup_steps': trial.suggest_int("warmup_steps", 0, 1000),
+            'weight_decay': trial.suggest_float("weight_decay", 0.0, 0.3),
+            'num_train_epochs': trial.suggest_int("num_train_epochs", 1, 5),
+            'adam_epsilon': trial.suggest_float("adam_epsilon", 1e-8, 1e-6),
+        }
+        if self.search_space is None:
+            params['per_device_train_batch_size'] = trial.suggest_categorical("per_device_train_batch_size", [2, 4, 8])
+            params['gradient_accumulation_steps'] = trial.suggest_categorical("gradient_accumulation_steps", [1, 2, 4])
+            return params
+
+        # Probed space: only per-device sizes that divide an effective size, each with the accumulation
+        # steps that reach one, so every trial trains an effective batch size of the search space
+        effective_batch_sizes = self.search_space['effective_batch_size']
+        batch_sizes = [size for size in self.search_space['per_device_train_batch_size']
+                       if any(effective % size == 0 for effective in effective_batch_sizes)]
+        if not batch_sizes:
+            raise ValueError(f"No per-device batch size of {self.search_space['per_device_train_batch_size']} divides "
+                             f"an effective batch size of {effective_batch_sizes}")
+        batch_size = trial.suggest_categorical("per_device_train_batch_size", batch_sizes)
+        # Optuna does not allow other categorical choices for the same name, so they depend on the batch size by name
+        params['per_device_train_batch_size'] = batch_size
+        params['gradient_accumulation_steps'] = trial.suggest_categorical(
+            f"gradient_accumulation_steps_{batch_size}",
+            [effective // batch_size for effective in effective_batch_sizes if effective % batch_size == 0])
+        params['effective_batch_size'] = batch_size * params['gradient_accumulation_steps']
+        trial.set_user_attr('gradient_accumulation_steps', params['gradient_accumulation_steps'])
+        trial.set_user_attr('effective_batch_size', params['effective_batch_size'])
+        return params
+
+    @staticmethod
+    def _trial_params(trial):
+        """The trial's params, with the batch size dependent names of a probed search space resolved."""
+        params = {name: value for name, value in trial.params.items() if not name.startswith('gradient_accumulation_steps_')}
+        for name in ('gradient_accumulation_steps', 'effective_batch_size'):
+            if name not in params and name in trial.user_attrs:
+                params[name] = trial.user_attrs[name]
+        return params
+
+    def _suggested_params(self, params):
+        """`params` (as `_trial_params` returns them) under the names `_suggest_params` suggests."""
+        params = dict(params)
+        if self.search_space is not None:
+            del params['effective_batch_size']
+            params[f"gradient_accumulation_steps_{params['per_device_train_batch_size']}"] = params.pop('gradient_accumulation_steps')
+        return params
+
+    def probe_batch_sizes(self, dataset=None, max_memory_mb=None, max_batch_size=256, steps=4, slowdown=0.5,
+                          min_effective_batch_size=8, max_effective_batch_size=32):
+        """
+        Train a few steps at batch sizes 1, 2, 4, ... up to `max_batch_size` on the model and
+        `dataset` (the training data by default) and record the step throughput and the peak
+        memory (CUDA memory on a GPU, process RSS otherwise) of each. Probing stops at the
+        first size that runs out of memory, exceeds `max_memory_mb` or whose throughput drops
+        below `slowdown` times the best one (the machine starts thrashing).
+
+        The result sets `search_space`: the per-device batch sizes that fit, are not slower
+        than `slowdown` times the best and not larger than `max_effective_batch_size`, and
+        effective batch sizes (powers of two from `min_effective_batch_size` to
+        `max_effective_batch_size`) the trials reach with gradient accumulation. The report is
+        returned and kept in `batch_size_probe`.
+        """
+        dataset = self.train_dataset if dataset is None else dataset
+        # Every probe starts from the pretrained weights with the current frozen layers
+        self._initial_requires_grad = {name: param.requires_grad for name, param in self.model.named_parameters()}
+        dataset_size = None if isinstance(dataset, IterableDataset) else len(dataset)
+
+        results = []
+        batch_size = 1
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            while batch_size <= max_batch_size and (dataset_size is None or batch_size <= dataset_size):
+                self._reset_model()
+                training_args = TrainingArguments(
+                    output_dir=tmp_dir, max_steps=steps, per_device_train_batch_size=batch_size,
+                    save_strategy="no", logging_strategy="no", report_to="none",
+                )
+                resource_usage, step_timer = ResourceUsageCallback(), StepTimerCallback()
+                trainer = self._build_trainer(training_args, dataset, None, callbacks=[resource_usage, step_timer])
+                try:
+                    trainer.train()
+                except RuntimeError as error:
+                    # torch.cuda.OutOfMemoryError is a RuntimeError as well
+                    if 'out of memory' not in str(error).lower():
+                        raise
+                    if resource_usage._thread is not None:
+                        resource_usage.on_train_end(training_args, trainer.state, trainer.control)
+                    if torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+                    results.append({'batch_size': batch_size, 'samples_per_second': 0.0, 'peak_memory_mb': None, 'fits': False, 'stopped': 'out of memory'})
+                    break
+
+                # The first step includes one-off setup costs
+                timed_steps = step_timer.step_times[1:] or step_timer.step_times
+                samples_per_second = batch_size / float(np.median(timed_steps))
+                peak_memory_mb = resource_usage.peak_cuda_mb if resource_usage.peak_cuda_mb is not None else resource_usage.peak_rss_mb
+                result = {'batch_size': batch_size, 'samples_per_second': samples_per_second, 'peak_memory_mb': peak_memory_mb, 'fits': True, 'stopped': None}
+                results.append(result)
+
+                best_samples_per_second = max(r['samples_per_second'] for r in results)
+                if max_memory_mb is not None and peak_memory_mb > max_memory_mb:
+                    result.update(fits=False, stopped='memory budget')
+                    break
+                if samples_per_second < slowdown * best_samples_per_second:
+                    result['stopped'] = 'throughput dropped'
+                    break
+                batch_size *= 2
+        self._reset_model()
+
+        fitting = [result for result in results if result['fits']]
+        if not fitting:
+            raise RuntimeError(f"A batch size of 1 does not fit (max_memory_mb={max_memory_mb})")
+        best = max(fitting, key=lambda result: result['samples_per_second'])
+        choices = [result['batch_size'] for result in fitting
+                   if result['samples_per_second'] >= slowdown * best['samples_per_second'] and result['batch_size'] <= max_effective_batch_size]
+        choices = choices or [min(best['batch_size'], max_effective_batch_size)]
+        effective_batch_sizes = [2 ** exponent for exponent in range(max_effective_batch_size.bit_length())
+                                 if min_effective_batch_size <= 2 ** exponent <= max_effective_batch_size]
+        effective_batch_sizes = effective_batch_sizes or [max_effective_batch_size]
+
+        self.search_space = {'per_device_train_batch_size': choices, 'effective_batch_size': effective_batch_sizes}
+        self.batch_size_probe = {
+            'results': results,
+            'max_batch_size': max(result['batch_size'] for result in fitting),
+            'best_batch_size': best['batch_size'],
+            'search_space': self.search_space,
+        }
+        return self.batch_size_probe
+
+    @staticmethod
+    def _trial_dir(study_name, number):
+        """Output directory of a trial, `./results/<study name>/trial_<number>`, so studies never share one."""
+        # Study names of persistent studies start with the model name, which may be a path
+        study_dir = study_name.replace('/', '_').replace('\\', '_')
+        return os.path.join('./results', study_dir, f'trial_{number}')
+
+    def _train_trial(self, trial, params, train_dataset, num_train_epochs, callbacks=None):
+        """
+        Train a fresh copy of the pretrained model with `params` on `train_dataset` and return
+        the trainer. The cost is recorded in trial attributes: `samples_seen` and
+        `train_runtime` (seconds) add up over the calls of a trial, `samples_per_second` is
+        the throughput of the last call and `peak_rss_mb` the highest resident memory.
+        """
+        # Start from the pretrained weights instead of the previous trial's; the Trainer builds a fresh optimizer
+        self._reset_model()
+
+        # Setting training arguments, every trial of every study gets its own output directory so
+        # parallel workers and other studies run in the same directory don't collide
+        training_args = TrainingArguments(
+            output_dir=self._trial_dir(trial.study.study_name, trial.number),
+            **self._training_length(train_dataset, num_train_epochs, params['per_device_train_batch_size'], params['gradient_accumulation_steps']),
+            learning_rate=params['lr'],
+            per_device_train_batch_size=params['per_device_train_batch_size'],
+            warmup_steps=params['warmup_steps'],
+            weight_decay=params['weight_decay'],
+            adam_epsilon=params['adam_epsilon'],
+            gradient_accumulation_steps=params['gradient_accumulation_steps'],
+            evaluation_strategy="steps",
+            eval_steps=100,
+            logging_dir='./logs',
+            logging_steps=10,
+            # A kept checkpoint holds the last step's weights next to its optimizer state and step,
+            # so the trial is evaluated on those rather than on an earlier best evaluation
+            load_best_model_at_end=not self.keep_best_checkpoint,
+            metric_for_best_model="loss",
+            greater_is_better=False,
+        )
+
+        resource_usage = ResourceUsageCallback()
+        trainer = self._build_trainer(training_args, train_dataset, self.val_dataset, callbacks=list(callbacks or []) + [resource_usage])
+        metrics = trainer.train().metrics
+        trial.set_user_attr('train_runtime', trial.user_attrs.get('train_runtime', 0.0) + metrics['train_runtime'])
+        trial.set_user_attr('samples_per_second', metrics['train_samples_per_second'])
+        trial.set_user_attr('peak_rss_mb', max(trial.user_attrs.get('peak_rss_mb', 0.0), resource_usage.peak_rss_mb))
+        if resource_usage.peak_cuda_mb is not None:
+            trial.set_user_attr('peak_cuda_mb', max(trial.user_attrs.get('peak_cuda_mb', 0.0), resource_usage.peak_cuda_mb))
+
+        if isinstance(train_dataset, IterableDataset):
+            samples = trainer.state.global_step * training_args.train_batch_size * training_args.gradient_accumulation_steps * training_args.world_size
+        elif trainer.state.global_step >= trainer.state.max_steps:
+            samples = len(train_dataset) * num_train_epochs
+        else:
+            # Stopped early, e.g. by the pruning callback
+            samples = int(round(len(train_dataset) * (trainer.state.epoch or 0)))
+        trial.set_user_attr('samples_seen', trial.user_attrs.get('samples_seen', 0) + samples)
+
+        if self.keep_best_checkpoint:
+            # Weights and optimizer state to continue from if this trial turns out best
+            checkpoint = os.path.join(training_args.output_dir, 'final')
+            trainer.save_model(checkpoint)
+            torch.save(trainer.optimizer.state_dict(), os.path.join(checkpoint, 'optimizer.pt'))
+            trial.set_user_attr('checkpoint', os.path.abspath(checkpoint))
+            trial.set_user_attr('checkpoint_step', trainer.state.global_step)
+        self._release_optimizer(trainer)
+        return trainer
+
+    @staticmethod
+    def _release_optimizer(trainer):
+        """
+        Drop the optimizer state and the gradients of a finished run, so they are freed now
+        rather than whenever the garbage collector reaches the Trainer. The trainer can
+        still evaluate.
+        """
+        trainer.accelerator.free_memory()
+        trainer.optimizer = trainer.lr_scheduler = None
+        trainer.model.zero_grad(set_to_none=True)
+
+    def _remove_losing_checkpoints(self, study, trial):
+        """
+        Study callback deleting the output directories of the study's finished trials other
+        than the current best one, so disk use stays bounded by the best trial and running
+        trials. Directories of other studies are left alone.
+        With `keep_all_checkpoints` only pruned and failed trials are deleted.
+        """
+        if self.keep_all_checkpoints:
+            best_numbers = {completed.number for completed in study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,))}
+        else:
+            # Every trial on the Pareto front of a multi-objective study counts as a best trial
+            best_numbers = {best_trial.number for best_trial in study.best_trials}
+        finished = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED, optuna.trial.TrialState.FAIL)
+        for finished_trial in study.get_trials(deepcopy=False, states=finished):
+            if finished_trial.number not in best_numbers:
+                shutil.rmtree(self._trial_dir(study.study_name, finished_trial.number), ignore_errors=True)
+
+    def objective(self, trial):
+        params = self._suggest_params(trial)
+        cached = self._trial_cache.load(self._trial_cache_context, params) if self._trial_cache is not None else None
+        if cached is not None:
+            # A near-identical configuration was trained on the same data before
+            trial.set_user_attr('cached', True)
+            for name, value in cached['attrs'].items():
+                trial.set_user_attr(name, value)
+            eval_loss = cached['eval_loss']
+        elif self._fidelity_fractions is not None:
+            eval_loss = self._multi_fidelity_objective(trial, params)
+        elif self._cost_objectives:
+            # Optuna cannot prune multi-objective trials
+            trainer = self._train_trial(trial, params, self.tuning_dataset, params['num_train_epochs'])
+            eval_loss = trainer.evaluate()['eval_loss']
+        else:
+            # Report the intermediate evaluations so the study's pruner can stop unpromising trials early
+            pruning_callback = OptunaPruningCallback(trial)
+            trainer = self._train_trial(trial, params, self.tuning_dataset, params['num_train_epochs'], callbacks=[pruning_callback])
+            pruning_callback.raise_if_pruned()
+            eval_loss = trainer.evaluate()['eval_loss']
+
+        if self._trial_cache is not None and cached is None:
+            attrs = {name: trial.user_attrs[name] for name in ('train_runtime', 'samples_per_second', 'peak_rss_mb', 'peak_cuda_mb')
+                     if name in trial.user_attrs}
+            self._trial_cache.save(self._trial_cache_context, params, {'eval_loss': eval_loss, 'attrs': attrs})
+
+        if self._cost_objectives:
+            return (eval_loss,) + tuple(trial.user_attrs[name] for name in self._cost_objectives)
+        return eval_loss
+
+    def _multi_fidelity_objective(self, trial, params):
+        """
+        Asynchronous successive halving over the amount of training data: train on the
+        smallest nested slice of the tuning data first and report the eval loss at
+        resource `fraction / min_fraction`. The study's SuccessiveHalvingPruner only lets
+        the best `1 / reduction_factor` of the trials at every rung go on to the next,
+        larger slice, which is trained with proportionally more epochs.
+        """
+        for fraction in self._fidelity_fractions:
+            size = max(1, int(round(len(self.tuning_dataset) * fraction)))
+            train_slice = Subset(self.tuning_dataset, self._fidelity_order[:size])
+            num_train_epochs = max(1, math.ceil(params['num_train_epochs'] * fraction))
+
+            trainer = self._train_trial(trial, params, train_slice, num_train_epochs)
+            eval_loss = trainer.evaluate()['eval_loss']
+
+            trial.report(eval_loss, step=int(round(fraction / self._fidelity_fractions[0])))
+            if fraction < 1 and trial.should_prune():
+                raise optuna.TrialPruned(f"Trial {trial.number} stopped at {fraction:.0%} of the tuning data")
+        return eval_loss
+
+    @staticmethod
+    def _fidelity_schedule(min_fraction, reduction_factor):
+        """Data fractions of the successive halving rungs, e.g. [1/9, 1/3, 1] for (1/9, 3)."""
+        rungs = max(0, math.floor(round(math.log(1 / min_fraction, reduction_factor), 6)))
+        return [min(1.0, reduction_factor ** (rung - rungs)) for rung in range(rungs + 1)]
+
+    @staticmethod
+    def _dataset_fingerprint(dataset):
+        """
+        Content hash of a dataset: the DataFrame, columns and tokenization settings (max
+        lengths, padding, compact storage, packing) of the T5 datasets, the files (path, size
+        and modification time) and settings of the streaming datasets and the indices of a
+        Subset, all with the tokenizer. A dataset's own `fingerprint` string is used as is.
+        Returns None for other datasets, whose content cannot be identified.
+        """
+        if isinstance(getattr(dataset, 'fingerprint', None), str):
+            return dataset.fingerprint
+        if isinstance(dataset, Subset):
+            fingerprint = HyperparameterTuner._dataset_fingerprint(dataset.dataset)
+            return fingerprint and TokenCache.fingerprint('Subset', fingerprint, np.asarray(dataset.indices).tobytes())
+        if hasattr(dataset, 'data_frame'):
+            columns = {name: value for name, value in vars(dataset).items() if name.endswith('_column')}
+            return TokenCache.fingerprint(
+                type(dataset).__name__, TokenCache.tokenizer_fingerprint(dataset.tokenizer), dataset.data_frame, repr(sorted(columns.items())),
+                getattr(dataset, 'label_default_value', None), dataset.source_max_len, dataset.target_max_len,
+                dataset.padding, dataset.compact, dataset.packing,
+            )
+        if hasattr(dataset, 'data_files'):
+            files = [(path, os.path.getsize(path), os.path.getmtime(path)) for path in dataset.data_files]
+            return TokenCache.fingerprint(type(dataset).__name__, TokenCache.tokenizer_fingerprint(dataset.tokenizer), files,
+                                          dataset.columns, repr(sorted(dataset.dataset_kwargs.items())), dataset.sample_fraction,
+                                          dataset.sample_seed)
+        return None
+
+    @staticmethod
+    def _check_directions(study, directions):
+        """Raise if a loaded study optimizes other objectives than `directions`."""
+        loaded = [direction.name.lower() for direction in study.directions]
+        if loaded != [direction.lower() for direction in directions]:
+            raise ValueError(f"Study {study.study_name!r} optimizes {loaded}, not {list(directions)}: "
+                             f"use another study_name for other cost_objectives")
+
+    def _persistent_study(self, storage, study_name, warm_start_trials, directions=("minimize",), setup=''):
+        """
+        Create or resume the study of this model, training data and tuning `setup` (cost
+        objectives and tuning subset) in `storage`. Trials left running by an interrupted run
+        are marked failed and queued again. A new study is warm-started with the best
+        `warm_start_trials` completed trials of every earlier study of the same model, task
+        (dataset class, collator, packing and length bucketing) and setup, e.g. on an older
+        version of the data.
+        """
+        fingerprint = self._dataset_fingerprint(self.train_dataset)
+        task = repr({'dataset_class': type(self.train_dataset).__name__, 'data_collator': type(self.data_collator).__name__,
+                     'packing': self.packing, 'length_bucketing': self.length_bucketing})
+        if study_name is None:
+            if fingerprint is None:
+                raise ValueError(f"Cannot fingerprint a {type(self.train_dataset).__name__} training dataset, pass study_name "
+                                 f"or give the dataset a `fingerprint` string identifying its content")
+            study_name = f"{self.model_name}-{fingerprint[:16]}-{TokenCache.fingerprint(setup)[:8]}"
+            if self.search_space is not None:
+                # Optuna does not allow other categorical choices within a study
+                study_name += f"-{TokenCache.fingerprint(repr(sorted(self.search_space.items())))[:8]}"
+        study = optuna.create_study(directions=list(directions), storage=storage, study_name=study_name, load_if_exists=True)
+        self._check_directions(study, directions)
+
+        if study.trials:
+            if study.user_attrs.get('setup', setup) != setup:
+                raise ValueError(f"Study {study_name!r} was tuned with another setup ({study.user_attrs['setup']}), "
+                                 f"not {setup}: use another study_name")
+            for trial in study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.RUNNING,)):
+                study.tell(trial.number, state=optuna.trial.TrialState.FAIL)
+                study.enqueue_trial(trial.params)
+            return study
+
+        study.set_user_attr('model_name', self.model_name)
+        study.set_user_attr('model_type', self.model_type)
+        study.set_user_attr('dataset_fingerprint', fingerprint)
+        study.set_user_attr('setup', setup)
+        study.set_user_attr('task', task)
+        for summary in optuna.get_all_study_summaries(storage):
+            attrs = summary.user_attrs
+            if summary.study_name == study_name or attrs.get('model_name') != self.model_name or attrs.get('model_type') != self.model_type:
+                continue
+            if attrs.get('task') != task or attrs.get('setup') != setup:
+                # Trials of another task or tuning setup are no good starting points
+                continue
+            related = optuna.load_study(study_name=summary.study_name, storage=storage)
+            completed = related.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,))
+            completed = [trial for trial in completed if self._in_search_space(self._trial_params(trial))]
+            for trial in sorted(completed, key=lambda trial: trial.values[0])[:warm_start_trials]:
+                study.enqueue_trial(self._suggested_params(self._trial_params(trial)),
+                                    user_attrs={'warm_start_from': summary.study_name}, skip_if_exists=True)
+        return study
+
+    def _in_search_space(self, params):
+        """Whether the batch size params of an earlier trial are valid choices of the current search space."""
+        if self.search_space is None:
+            return params.get('per_device_train_batch_size', 2) in (2, 4, 8) and params.get('gradient_accumulation_steps', 1) in (1, 2, 4)
+        batch_size, effective_batch_size = params.get('per_device_train_batch_size'), params.get('effective_batch_size')
+        return (batch_size in self.search_space['per_device_train_batch_size']
+                and effective_batch_size in self.search_space['effective_batch_size']
+                and batch_size * params.get('gradient_accumulation_steps', 1) == effective_batch_size)
+
+    @staticmethod
+    def _stratify_labels(dataset, stratify):
+        """Return one label per item of `dataset` for `stratify`, a DataFrame column name or labels."""
+        if stratify is None:
+            return None
+        if isinstance(stratify, str):
+            frame = getattr(dataset, 'data_frame', None)
+            if frame is None or stratify not in frame.columns:
+                raise ValueError(f"stratify={stratify!r} is not a column of the training dataset's DataFrame")
+            labels = frame[stratify].to_numpy()
+        else:
+            labels = np.asarray(stratify)
+        if len(labels) != len(dataset):
+            # e.g. packed datasets, whose items span several rows
+            raise ValueError(f"stratify has {len(labels)} labels for {len(dataset)} training items")
+        return labels
+
+    @staticmethod
+    def _subset_indices(n_items, subset_size, labels=None, seed=0):
+        """
+        Draw round(`subset_size` * `n_items`) sorted indices without replacement. With `labels`
+        every label gets its proportional share (largest remainder rounding, at least one
+        index per label when the size allows it).
+        """
+        rng = np.random.default_rng(seed)
+        size = min(n_items, max(1, int(round(n_items * subset_size))))
+        if labels is None:
+            return np.sort(rng.choice(n_items, size=size, replace=False))
+
+        codes, _ = pd.factorize(np.asarray(labels), use_na_sentinel=False)
+        counts = np.bincount(codes)
+        quotas = counts * size / n_items
+        shares = np.floor(quotas).astype(int)
+        if size >= len(counts):
+            shares = np.maximum(shares, np.minimum(counts, 1))
+        # Hand out the indices still missing to the largest remainders, or take back the extra ones
+        remainder = size - shares.sum()
+        if remainder > 0:
+            open_labels = np.flatnonzero(shares < counts)
+            order = open_labels[np.argsort(-(quotas - shares)[open_labels], kind='stable')]
+            shares[order[:remainder]] += 1
+        while remainder < 0:
+            shares[np.argmax(np.where(shares > 1, shares - quotas, -np.inf))] -= 1
+            remainder += 1
+
+        by_label = np.argsort(codes, kind='stable')
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        chosen = [by_label[start + rng.choice(count, size=share, replace=False)]
+                  for start, count, share in zip(starts, counts, shares) if share]
+        return np.sort(np.concatenate(chosen))
+
+    @staticmethod
+    def _trial_result(trial):
+        result = {'number': trial.number, 'params': HyperparameterTuner._trial_params(trial), 'eval_loss': trial.values[0]}
+        for name in ('train_runtime', 'samples_per_second', 'samples_seen', 'peak_rss_mb', 'peak_cuda_mb', 'checkpoint', 'checkpoint_step'):
+            if name in trial.user_attrs:
+                result[name] = trial.user_attrs[name]
+        if 'checkpoint' in result and not os.path.isdir(result['checkpoint']):
+            # Removed with the trial's directory when another trial was better
+            del result['checkpoint']
+            result.pop('checkpoint_step', None)
+        return result
+
+    @staticmethod
+    def _worker_cpus(n_jobs):
+        """Split the CPUs this process may run on into `n_jobs` contiguous, non-overlapping groups."""
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = list(range(os.cpu_count() or 1))
+        if n_jobs >= len(cpus):
+            # More workers than cores: one core each, shared round-robin
+            return [[cpus[worker % len(cpus)]] for worker in range(n_jobs)]
+        size, extra = divmod(len(cpus), n_jobs)
+        groups, start = [], 0
+        for worker in range(n_jobs):
+            end = start + size + (worker < extra)
+            groups.append(cpus[start:end])
+            start = end
+        return groups
+
+    def _tuning_worker(self, study_name, storage, n_trials, timeout, cpus, pruner=None):
+        """Run `n_trials` trials of the shared study in a forked worker pinned to `cpus`."""
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(len(cpus))
+        # The Rust tokenizer thread pool cannot be used safely after a fork
+        os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+
+        # self.model is this worker's own copy-on-write copy of the parent's model
+        study = optuna.load_study(study_name=study_name, storage=storage, pruner=pruner)
+        study.optimize(self.objective, n_trials=n_trials, timeout=timeout, callbacks=[self._remove_losing_checkpoints])
+
+    def _optimize_in_parallel(self, study, storage, n_trials, timeout, n_jobs, pruner=None):
+        """
+        Fork `n_jobs` workers that pull trials from `study` through the shared `storage`,
+        each pinned to its own group of CPUs so they don't oversubscribe each other.
+        """
+        context = multiprocessing.get_context('fork')
+        quotas = [n_trials // n_jobs + (worker < n_trials % n_jobs) for worker in range(n_jobs)]
+        workers = [
+            context.Process(target=self._tuning_worker, args=(study.study_name, storage, quota, timeout, cpus, pruner))
+            for quota, cpus in zip(quotas, self._worker_cpus(n_jobs)) if quota
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        failed = [worker.exitcode for worker in workers if worker.exitcode != 0]
+        if failed:
+            raise RuntimeError(f"{len(failed)} tuning worker(s) failed with exit codes {failed}")
+
+    def tune_hyperparameters(self, n_trials=10, subset_size=0.1, timeout=None, n_jobs=1, storage=None, study_name=None, pruner='median',
+                             multi_fidelity=False, min_fraction=1 / 9, reduction_factor=3, seed=0, persistent=False, warm_start_trials=5,
+                             keep_best_checkpoint=False, cost_objectives=None, stratify=None, batch_size_probe=None,
+                             trial_cache=None, activation_cache=None, keep_all_checkpoints=False):
+        """
+        Search the hyperparameters with Optuna on a `subset_size` fraction of the training data.
+
+        The fraction is drawn with `seed` as a lazy `Subset` over row indices (see
+        `_subset_indices`), so no item is tokenized to pick it, and stored in
+        `tuning_dataset`; `train_dataset` is left whole. `stratify` keeps the label
+        proportions: the name of a column of the dataset's DataFrame or one label per item.
+
+        `batch_size_probe` (True or a dict of `probe_batch_sizes` arguments, e.g.
+        `{'max_memory_mb': 12000}`) probes the batch sizes the machine handles first and
+        searches those, with the gradient accumulation derived from an effective batch size.
+
+        `trial_cache`, a `TrialCache` or the path of its SQLite database, reuses the eval loss
+        and cost of configurations within its tolerance of ones trained before on the same
+        model, data, tuning setup and code version instead of training them again. Those
+        trials get the `cached` attribute and add no `samples_seen`.
+
+        `activation_cache`, a directory or a dict of `FrozenPrefixCache` arguments, runs the
+        frozen embeddings and bottom encoder blocks (e.g. frozen with LayerFreezer) once per
+        example and trains the trials and the final run from their cached activations with
+        `FrozenPrefixTrainer` (T5 models and map-style datasets, not with packing).
+
+        With `n_jobs > 1` the trials run in `n_jobs` forked worker processes (CPU training only,
+        forking after CUDA has been initialized is not supported). Workers share one study
+        through `storage`, an Optuna storage URL such as `sqlite:///tuning.db`; by default a
+        temporary SQLite database is used.
+
+        Trials report their intermediate eval loss (every `eval_steps`) to `pruner`, one of
+        'median', 'successive_halving', 'hyperband', 'none' or an Optuna pruner instance.
+        Pruned trials stop training early and are recorded with the PRUNED state.
+
+        With `multi_fidelity=True` the trials run asynchronous successive halving over the
+        amount of data instead: every configuration starts on a `min_fraction` slice of the
+        tuning data and only the best `1 / reduction_factor` are promoted to slices
+        `reduction_factor` times larger, up to the whole tuning subset (`pruner` is replaced
+        by the matching SuccessiveHalvingPruner). Slices are nested and drawn with `seed`.
+
+        Every trial records the training samples it processed in its `samples_seen`
+        attribute; the totals are kept in `tuning_cost`.
+
+        With `persistent=True` the study is stored in `storage` (`sqlite:///optuna_studies.db`
+        by default) under a name derived from the model name, a fingerprint of the training
+        data and the tuning setup (cost objectives and tuning subset), unless `study_name` is
+        given. Running the same tuning again resumes the study and only runs the trials still
+        missing from `n_trials`; resuming it with another setup raises. A new study is
+        warm-started with the best trials of earlier studies of the same model.
+
+        Every trial writes to `./results/<study name>/trial_<number>`; the directories of the
+        study's finished trials other than the best one are deleted as the study goes. With `keep_best_checkpoint=True`
+        each trial also saves the weights and optimizer state of its last step (and is
+        evaluated on those, not on an earlier best evaluation), and the best trial's
+        checkpoint is exposed as `best_checkpoint` (see `AutoTrainer.auto_train`). With
+        `keep_all_checkpoints=True` the directories of all completed trials are kept, e.g. to
+        pick another trial than the lowest-loss one afterwards.
+
+        Every trial records its cost in the `train_runtime`, `samples_per_second` and
+        `peak_rss_mb` attributes, collected with the params and eval loss of the completed
+        trials in `trial_results`. `cost_objectives`, e.g. `('train_runtime', 'peak_rss_mb')`,
+        turns the study into a multi-objective one that minimizes these attributes next to
+        the eval loss (without pruning); 'peak_cuda_mb' is only available with CUDA. Its Pareto
+        front is stored in `pareto_front` and `best_params` is the front's configuration with
+        the lowest eval loss.
+        """
+        # Check the arguments before probing or creating a persistent study
+        cost_objectives = tuple(cost_objectives or ())
+        unknown = set(cost_objectives) - {'train_runtime', 'peak_rss_mb', 'peak_cuda_mb'}
+        if unknown:
+            raise ValueError(f"Unsupported cost objectives: {sorted(unknown)}. Use 'train_runtime', 'peak_rss_mb' or 'peak_cuda_mb'.")
+        if 'peak_cuda_mb' in cost_objectives and not torch.cuda.is_available():
+            raise ValueError("The 'peak_cuda_mb' cost objective needs CUDA, it is not recorded when training on the CPU")
+        if cost_objectives and multi_fidelity:
+            raise ValueError("cost_objectives cannot be combined with multi_fidelity, Optuna does not prune multi-objective studies")
+        if subset_size <= 0 or subset_size > 1:
+            raise ValueError("subset_size should be greater than 0 and less than or equal to 1")
+        streaming = isinstance(self.train_dataset, IterableDataset)
+        if streaming and stratify is not None:
+            raise ValueError("stratify needs a map-style training dataset")
+        if streaming and multi_fidelity:
+            raise ValueError("multi_fidelity needs a map-style training dataset to draw nested slices from")
+        if activation_cache is not None:
+            if self.packing or streaming:
+                raise ValueError("activation_cache needs a map-style training dataset without packing")
+            activation_cache = dict(activation_cache) if isinstance(activation_cache, dict) else {'cache_dir': activation_cache}
+            # Fails early when there is no frozen prefix to cache
+            FrozenPrefixCache(self.model, **activation_cache)
+        labels = None if streaming else self._stratify_labels(self.train_dataset, stratify)
+        if trial_cache is not None:
+            fingerprints = [self._dataset_fingerprint(dataset) for dataset in (self.train_dataset, self.val_dataset)]
+            if None in fingerprints:
+                # Type and length alone would return the results of another dataset
+                raise ValueError("trial_cache needs datasets whose content can be fingerprinted, give other datasets a "
+                                 "`fingerprint` string identifying their content")
+
+        self.keep_best_checkpoint = keep_best_checkpoint
+        self.keep_all_checkpoints = keep_all_checkpoints
+        self._cost_objectives = cost_objectives
+        directions = ["minimize"] * (1 + len(self._cost_objectives))
+        pruner = make_pruner(pruner)
+        if batch_size_probe:
+            self.probe_batch_sizes(**(batch_size_probe if isinstance(batch_size_probe, dict) else {}))
+        stratify_key = stratify if stratify is None or isinstance(stratify, str) else TokenCache.fingerprint(np.asarray(stratify).tobytes())
+        if persistent:
+            # Fingerprint the whole training set, before the random tuning subset is drawn
+            storage = storage or "sqlite:///optuna_studies.db"
+            setup = repr({'cost_objectives': self._cost_objectives, 'subset_size': subset_size, 'seed': seed, 'stratify': stratify_key,
+                          'multi_fidelity': (min_fraction, reduction_factor) if multi_fidelity else None})
+            study = self._persistent_study(storage, study_name, warm_start_trials, directions, setup)
+            study_name = study.study_name
+        # Frozen layers are part of the setup every trial is reset to
+        self._initial_requires_grad = {name: param.requires_grad for name, param in self.model.named_parameters()}
+        for name, tensor in self.model.state_dict().items():
+            if tensor.dtype != self._initial_state[name].dtype:
+                # Layers frozen in reduced precision (LayerFreezer.freeze_layers(dtype=...)) are restored
+                # from a copy in that precision, the full precision copy is not needed anymore
+                self._initial_state[name] = tensor.detach().to('cpu', copy=True).share_memory_()
+        self.activation_cache = activation_cache
+        self._prefix_cache = None
+
+        # Subsetting the dataset for the tuning process
+        if streaming:
+            # Streaming datasets are subsampled chunk by chunk while they are read
+            self.tuning_dataset = self.train_dataset.subsample(subset_size, seed=seed) if subset_size < 1 else self.train_dataset
+        elif subset_size < 1 or stratify is not None:
+            indices = self._subset_indices(len(self.train_dataset), subset_size, labels=labels, seed=seed)
+            self.tuning_dataset = Subset(self.train_dataset, indices.tolist())
+        else:
+            self.tuning_dataset = self.train_dataset
+
+        self._fidelity_fractions = self._fidelity_order = None
+        if multi_fidelity:
+            self._fidelity_fractions = self._fidelity_schedule(min_fraction, reduction_factor)
+            self._fidelity_order = np.random.default_rng(seed).permutation(len(self.tuning_dataset)).tolist()
+            # Rung k is reached at resource reduction_factor ** k, see _multi_fidelity_objective
+            pruner = optuna.pruners.SuccessiveHalvingPruner(min_resource=1, reduction_factor=reduction_factor)
+
+        self._trial_cache = self._trial_cache_context = None
+        if trial_cache is not None:
+            self._trial_cache = trial_cache if isinstance(trial_cache, TrialCache) else TrialCache(trial_cache)
+            # Everything besides the hyperparameters that the eval loss depends on,
+            # layers frozen in reduced precision train differently from full precision ones
+            frozen = sorted(f"{name}:{param.dtype}" for name, param in self.model.named_parameters() if not param.requires_grad)
+            self._trial_cache_context = self._trial_cache.context(
+                self.model_name, self.model_type, *fingerprints,
+                repr((subset_size, seed, stratify_key, self._fidelity_fractions, self.length_bucketing, self.packing,
+                      type(self.data_collator).__name__, self.activation_cache is not None)),
+                frozen,
+            )
+
+        # Creating a study and optimizing the objective
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if n_jobs > 1 and storage is None:
+                # Parallel workers share the study through a database
+                storage = f"sqlite:///{os.path.join(tmp_dir, 'study.db')}"
+            study = optuna.create_study(directions=directions, storage=storage, study_name=study_name, load_if_exists=study_name is not None, pruner=pruner)
+            self._check_directions(study, directions)
+            if persistent:
+                # Only run the trials an interrupted run did not finish
+                finished = study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED))
+                n_trials = max(0, n_trials - len(finished))
+
+            if n_jobs > 1:
+                self._optimize_in_parallel(study, storage, n_trials, timeout, n_jobs, pruner)
+                # Reload the study to read the trials written by the workers
+                study = optuna.load_study(study_name=study.study_name, storage=storage)
+            else:
+                study.optimize(self.objective, n_trials=n_trials, timeout=timeout, callbacks=[self._remove_losing_checkpoints])
+
+            completed = study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,))
+            self.trial_results = [self._trial_result(trial) for trial in completed]
+            if self._cost_objectives:
+                self.pareto_front = [self._trial_result(trial) for trial in study.best_trials]
+            best_trial = min(study.best_trials, key=lambda trial: trial.values[0])
+
+            self.best_params = self._trial_params(best_trial)
+            self.best_checkpoint = best_trial.user_attrs.get('checkpoint')
+            self.best_checkpoint_step = best_trial.user_attrs.get('checkpoint_step', 0)
+            self.tuning_cost = {
+                'samples_seen': sum(trial.user_attrs.get('samples_seen', 0) for trial in study.trials),
+                'trials': len(study.trials),
+                'pruned_trials': sum(trial.state == optuna.trial.TrialState.PRUNED for trial in study.trials),
+            }
+        return self.best_params
+
+
+# Usage example:
+# You need to ensure 'model_name', 'tokenizer', 'train_dataset', and 'val_dataset' are properly defined before this step.
+# tuner = HyperparameterTuner(model_name, tokenizer, train_dataset, val_dataset)
+# best_params = tuner.tune_hyperparameters(n_trials=10, subset_size=0.1)  # Adjust as necessary according to GPU memory available
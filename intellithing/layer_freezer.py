@@ -1,52 +1,169 @@
+import torch
 import torch.nn as nn
 
+
+def _cast_floating(value, dtype):
+    """Cast the floating point tensors in `value` (possibly nested in tuples, lists and dicts) to `dtype`."""
+    if isinstance(value, torch.Tensor):
+        return value.to(dtype) if value.is_floating_point() else value
+    if isinstance(value, tuple) and not hasattr(value, '_fields'):
+        return tuple(_cast_floating(item, dtype) for item in value)
+    if isinstance(value, list):
+        return [_cast_floating(item, dtype) for item in value]
+    if isinstance(value, dict) and type(value) is dict:
+        return {key: _cast_floating(item, dtype) for key, item in value.items()}
+    return value
+
 class LayerFreezer:
-    def __init__(self, model, model_type):
+    """
+    Freeze and unfreeze the layers of a Hugging Face model by index.
+
+    The layer stacks are found once by walking the module tree: every outermost
+    `nn.ModuleList` of layers of one class (e.g. `encoder.block` and `decoder.block` of T5,
+    `bert.encoder.layer`, `transformer.h` of GPT-2). A stack whose path mentions the decoder
+    is the 'decoder' part, the first other one the 'encoder' part; every stack can also be
+    addressed by its path. The parameters of every layer are indexed up front, so freezing
+    and unfreezing only touch the affected tensors. Build a new LayerFreezer when the model
+    object is replaced.
+
+    Freezing drops the gradients of the frozen parameters, so their memory is released
+    right away instead of at the optimizer's next `zero_grad`. `freeze_layers(dtype=...)`
+    also keeps the frozen layers in a reduced precision such as `torch.bfloat16`.
+    """
+
+    def __init__(self, model, model_type=None):
         self.model = model
+        # Kept for compatibility, the layers are found from the module tree
         self.model_type = model_type
+        # part -> path of its layer stack, and (path, index) -> parameters of that layer
+        self.parts = {}
+        self.layers = {}
+        self.modules = {}
+        # (path, index) -> (original dtype, hook handles) of the layers kept in reduced precision
+        self._reduced = {}
+        self._build_index()
 
-    def _get_layer_name(self, idx, part='encoder'):
-        if self.model_type in ["t5", "bart"]:
-            return f"{part}.block.{idx}"
-        elif self.model_type in ["bert", "roberta", "distilbert", "electra"]:
-            return f"{part}.layer.{idx}"  # Note: these models don't have a decoder
-        elif self.model_type == "xlnet":
-            return f"transformer.layer.{idx}"
-        elif self.model_type in ["gpt2", "transformerxl"]:
-            return f"h.{idx}"  # These models don't differentiate between encoder/decoder
-        else:
-            raise ValueError(f"Unsupported model type: {self.model_type}")
-
-    def freeze_layers(self, layer_indices, part='encoder'):
-        if part == 'all':
-            parts = ['encoder', 'decoder'] if self.model_type in ["t5", "bart"] else ['encoder']
-        else:
-            parts = [part]
+    def _build_index(self):
+        stacks = []
+        for name, module in self.model.named_modules():
+            if not isinstance(module, nn.ModuleList) or len(module) == 0:
+                continue
+            if len({type(layer) for layer in module}) != 1:
+                continue
+            # Skip the lists nested in the layers of a stack, e.g. the sublayers of a T5 block
+            if any(name.startswith(f"{stack}.") for stack, _ in stacks):
+                continue
+            stacks.append((name, module))
 
-        for part in parts:
-            for idx in layer_indices:
-                layer_name = self._get_layer_name(idx, part)
-                for name, param in self.model.named_parameters():
-                    if layer_name in name:
-                        param.requires_grad = False
+        for name, module in stacks:
+            part = 'decoder' if any('decoder' in component for component in name.split('.')) else 'encoder'
+            self.parts.setdefault(part, name)
+            self.parts[name] = name
+            for idx, layer in enumerate(module):
+                self.layers[(name, idx)] = list(layer.parameters())
+                self.modules[(name, idx)] = layer
 
-    def unfreeze_layers(self, layer_indices, part='encoder'):
+    def _stacks(self, part):
         if part == 'all':
-            parts = ['encoder', 'decoder'] if self.model_type in ["t5", "bart"] else ['encoder']
-        else:
-            parts = [part]
+            return [stack for key, stack in self.parts.items() if key in ('encoder', 'decoder')]
+        if part not in self.parts:
+            raise ValueError(f"Unknown part {part!r} for {type(self.model).__name__}, use one of {sorted(self.parts) + ['all']}")
+        return [self.parts[part]]
+
+    def _get_layer_name(self, idx, part='encoder'):
+        return f"{self._stacks(part)[0]}.{idx}"
 
-        for part in parts:
+    def _set_requires_grad(self, layer_indices, part, requires_grad, dtype=None):
+        for stack in self._stacks(part):
             for idx in layer_indices:
-                layer_name = self._get_layer_name(idx, part)
-                for name, param in self.model.named_parameters():
-                    if layer_name in name:
-                        param.requires_grad = True
+                key = (stack, idx)
+                if key not in self.layers:
+                    raise ValueError(f"{stack} has no layer {idx}, it has {self.num_layers(stack)} layers")
+                if requires_grad:
+                    self._restore_precision(key)
+                for param in self.layers[key]:
+                    param.requires_grad = requires_grad
+                    if not requires_grad:
+                        param.grad = None
+                if dtype is not None and not requires_grad:
+                    self._reduce_precision(key, dtype)
+
+    def _reduce_precision(self, key, dtype):
+        """
+        Cast the weights of a frozen layer to `dtype`. Hooks cast the layer's floating point
+        inputs to `dtype` and its outputs back, so the layers around it keep their precision.
+        """
+        if key in self._reduced:
+            self._restore_precision(key)
+        layer = self.modules[key]
+        original = self.layers[key][0].dtype if self.layers[key] else torch.get_default_dtype()
+        layer.to(dtype)
+
+        def cast_inputs(module, args, kwargs):
+            return _cast_floating(args, dtype), _cast_floating(kwargs, dtype)
+
+        def cast_outputs(module, args, output):
+            return _cast_floating(output, original)
+
+        handles = (layer.register_forward_pre_hook(cast_inputs, with_kwargs=True), layer.register_forward_hook(cast_outputs))
+        self._reduced[key] = (original, handles)
+
+    def _restore_precision(self, key):
+        if key not in self._reduced:
+            return
+        original, handles = self._reduced.pop(key)
+        for handle in handles:
+            handle.remove()
+        # The weights keep the rounding of the reduced precision
+        self.modules[key].to(original)
+
+    def num_layers(self, part='encoder'):
+        """Number of layers of `part` ('encoder', 'decoder' or the path of a layer stack)."""
+        stack = self._stacks(part)[0]
+        return sum(1 for key in self.layers if key[0] == stack)
+
+    def freeze_layers(self, layer_indices, part='encoder', dtype=None):
+        """
+        Freeze the given layers of `part`. With `dtype` (e.g. `torch.bfloat16`) their weights
+        are also kept in that precision until they are unfrozen; unfreezing restores the
+        dtype, but the weights keep the rounding.
+        """
+        self._set_requires_grad(layer_indices, part, False, dtype=dtype)
+
+    def unfreeze_layers(self, layer_indices, part='encoder'):
+        self._set_requires_grad(layer_indices, part, True)
 
     def freeze_all(self):
         for param in self.model.parameters():
             param.requires_grad = False
+            param.grad = None
 
     def unfreeze_all(self):
+        for key in list(self._reduced):
+            self._restore_precision(key)
         for param in self.model.parameters():
             param.requires_grad = True
+
+    def parameter_report(self):
+        """
+        Return one entry per layer, plus 'other' (embeddings, heads, final norms) and 'total',
+        with the number of trainable and frozen parameters and their size in bytes. Tied
+        parameters are counted once, in the first entry that holds them.
+        """
+        def entry(layer, params):
+            report = {'layer': layer, 'trainable_params': 0, 'frozen_params': 0, 'trainable_bytes': 0, 'frozen_bytes': 0}
+            for param in params:
+                state = 'trainable' if param.requires_grad else 'frozen'
+                report[f'{state}_params'] += param.numel()
+                report[f'{state}_bytes'] += param.numel() * param.element_size()
+            return report
+
+        seen = set()
+        report = []
+        for (stack, idx), params in self.layers.items():
+            params = [param for param in params if id(param) not in seen]
+            seen.update(id(param) for param in params)
+            report.append(entry(f"{stack}.{idx}", params))
+        report.append(entry('other', [param for param in self.model.parameters() if id(param) not in seen]))
+        report.append(entry('total', list(self.model.parameters())))
+        return report
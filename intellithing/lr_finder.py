@@ -1,60 +1,160 @@
-from transformers import TrainerCallback
-import matplotlib.pyplot as plt
 import math
 
+import numpy as np
+from transformers import TrainerCallback
+
+
 class LearningRateFinderCallback(TrainerCallback):
-    def __init__(self, start_lr, end_lr):
+    """
+    Learning rate range test: raise the learning rate exponentially from `start_lr` to
+    `end_lr` over `num_steps` optimizer steps (by default the run's `max_steps`) and record
+    the training loss of every step.
+
+    The loss is read from the model's outputs during the training step itself, averaged
+    over gradient accumulation, and smoothed with an exponential moving average
+    (`smoothing`, bias corrected). The test stops early once the smoothed loss exceeds
+    `divergence_threshold` times the best one, or is no longer finite.
+
+    After training `lrs`, `losses` (smoothed) and `raw_losses` hold the curve and
+    `suggested_lr` the learning rate picked by `suggestion`: 'steepest' (the steepest
+    descent of the loss before its minimum) or 'valley' (two thirds down the longest
+    descending stretch). Nothing is plotted unless `plot_path` is given or `plot()` is
+    called; matplotlib is only imported then and the figure is rendered off-screen.
+    """
+
+    def __init__(self, start_lr, end_lr, num_steps=None, smoothing=0.98, divergence_threshold=4.0, suggestion='steepest',
+                 plot_path=None):
+        if suggestion not in ('steepest', 'valley'):
+            raise ValueError(f"Unknown suggestion {suggestion!r}, use 'steepest' or 'valley'")
         self.start_lr = start_lr
         self.end_lr = end_lr
+        self.num_steps = num_steps
+        self.smoothing = smoothing
+        self.divergence_threshold = divergence_threshold
+        self.suggestion = suggestion
+        self.plot_path = plot_path
         self.num_training_steps = None
-
-    def on_train_begin(self, args, state, control, **kwargs):
-        self.num_training_steps = args.max_steps
-        if self.num_training_steps is None:
-            raise ValueError("Please specify max_steps.")
         self.lrs = []
         self.losses = []
+        self.raw_losses = []
+        self.best_loss = None
+        self.diverged = False
+        self.suggested_lr = None
+        self._hook = None
+        self._step_losses = []
+        self._average = 0.0
 
+    def _lr_at(self, step):
+        progress = step / max(1, self.num_training_steps - 1)
+        return self.start_lr * (self.end_lr / self.start_lr) ** progress
 
-    def on_step_end(self, args, state, control, **kwargs):
-        # Calculate the current learning rate
-        progress = state.global_step / float(self.num_training_steps - 1)
-        lr = self.start_lr * (self.end_lr / self.start_lr) ** progress
-        
-        # Set the learning rate for this step
-        for param_group in kwargs["optimizer"].param_groups:
+    def _set_lr(self, optimizer, lr):
+        for param_group in optimizer.param_groups:
             param_group["lr"] = lr
-        
-        # Log the learning rate
-        self.lrs.append(lr)
 
-        # Check if there is any logged loss, and only then record it
-        if state.log_history:
-            if "loss" in state.log_history[-1]:
-                # Record the loss from the latest log
-                loss = state.log_history[-1]["loss"]
-                self.losses.append(loss)
-            else:
-                # If for some reason a loss was not recorded, you might append a NaN or a previous loss
-                # This part depends on how you want to handle missing loss values
-                self.losses.append(float('nan'))  # or you might repeat the previous loss
+    def _record_loss(self, module, args, output):
+        if not module.training:
+            return
+        loss = output.get('loss') if isinstance(output, dict) else getattr(output, 'loss', None)
+        if loss is not None:
+            self._step_losses.append(loss.detach().float().item())
+
+    def on_train_begin(self, args, state, control, model=None, optimizer=None, **kwargs):
+        self.num_training_steps = self.num_steps or (args.max_steps if args.max_steps > 0 else state.max_steps)
+        if not self.num_training_steps:
+            raise ValueError("Please specify num_steps or max_steps.")
+        self.lrs, self.losses, self.raw_losses = [], [], []
+        self.best_loss = None
+        self.diverged = False
+        self.suggested_lr = None
+        self._step_losses = []
+        self._average = 0.0
+        # The loss of every training forward pass, without waiting for a log entry
+        self._hook = model.register_forward_hook(self._record_loss)
+        if optimizer is not None:
+            self._set_lr(optimizer, self._lr_at(0))
 
+    def on_step_end(self, args, state, control, optimizer=None, **kwargs):
+        lr = self._lr_at(state.global_step - 1)
+        # The next step trains with the next learning rate of the range
+        self._set_lr(optimizer, self._lr_at(state.global_step))
+        if not self._step_losses:
+            # The loss was not returned by the model's forward (e.g. a custom compute_loss)
+            return
+        loss = sum(self._step_losses) / len(self._step_losses)
+        self._step_losses = []
+
+        self._average = self.smoothing * self._average + (1 - self.smoothing) * loss
+        smoothed = self._average / (1 - self.smoothing ** (len(self.losses) + 1))
+        self.lrs.append(lr)
+        self.raw_losses.append(loss)
+        self.losses.append(smoothed)
 
+        if not math.isfinite(smoothed) or (self.best_loss is not None and smoothed > self.divergence_threshold * self.best_loss):
+            self.diverged = True
+            control.should_training_stop = True
+        elif self.best_loss is None or smoothed < self.best_loss:
+            self.best_loss = smoothed
+        if state.global_step >= self.num_training_steps:
+            control.should_training_stop = True
 
     def on_train_end(self, args, state, control, **kwargs):
-        # Before plotting, we should ensure that the number of learning rates 
-        # and losses are the same. We'll trim the larger list.
-
-        # Determine the size of the smallest list between lrs and losses
-        min_size = min(len(self.lrs), len(self.losses))
-
-        # Trim the lists to be of the same size
-        self.lrs = self.lrs[:min_size]
-        self.losses = self.losses[:min_size]
-
-        # Now, you can plot without mismatch issues.
-        plt.plot(self.lrs, self.losses)
-        plt.xscale("log")
-        plt.xlabel("Learning rate")
-        plt.ylabel("Loss")
-        plt.show()
+        if self._hook is not None:
+            self._hook.remove()
+            self._hook = None
+        self.suggested_lr = self.suggest_lr()
+        if self.plot_path:
+            self.plot(self.plot_path)
+
+    def suggest_lr(self, method=None):
+        """Return the suggested learning rate of the recorded curve ('steepest' or 'valley'), or None if it is too short."""
+        method = method or self.suggestion
+        losses = np.asarray(self.losses, dtype=float)
+        finite = np.isfinite(losses)
+        if self.diverged:
+            # The last point is past the divergence threshold
+            finite[-1] = False
+        lrs, losses = np.asarray(self.lrs, dtype=float)[finite], losses[finite]
+        if len(losses) < 3:
+            return None
+
+        if method == 'steepest':
+            # The steepest descent before the minimum of the loss
+            end = int(np.argmin(losses)) + 1
+            if end < 2:
+                return None
+            slopes = np.gradient(losses[:end], np.log10(lrs[:end]))
+            return float(lrs[int(np.argmin(slopes))])
+        if method == 'valley':
+            # The longest descending stretch of the curve, as in fastai's valley suggestion
+            lengths = np.ones(len(losses), dtype=int)
+            start = end = 0
+            for i in range(1, len(losses)):
+                for j in range(i):
+                    if losses[i] < losses[j] and lengths[i] < lengths[j] + 1:
+                        lengths[i] = lengths[j] + 1
+                if lengths[i] > lengths[end]:
+                    end = i
+                    start = max(0, end - lengths[end])
+            section = (end - start) / 3
+            return float(lrs[min(len(lrs) - 1, start + int(section) + int(section / 2))])
+        raise ValueError(f"Unknown suggestion {method!r}, use 'steepest' or 'valley'")
+
+    def plot(self, path=None):
+        """Plot the smoothed loss over the learning rate, marking the suggestion, and save it to `path` if given."""
+        # Only imported when a plot is requested; a Figure without pyplot needs no display
+        from matplotlib.figure import Figure
+
+        figure = Figure()
+        axes = figure.subplots()
+        axes.plot(self.lrs, self.losses)
+        suggested_lr = self.suggested_lr if self.suggested_lr is not None else self.suggest_lr()
+        if suggested_lr is not None:
+            axes.axvline(suggested_lr, color='red', linestyle='--', label=f"suggested lr {suggested_lr:.2e}")
+            axes.legend()
+        axes.set_xscale("log")
+        axes.set_xlabel("Learning rate")
+        axes.set_ylabel("Loss (smoothed)")
+        if path:
+            figure.savefig(path)
+        return figure
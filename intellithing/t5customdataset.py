@@ -1,384 +1,874 @@
-from torch.utils.data import Dataset
-import pandas as pd
-import torch
-
-class T5RegressionDataset(Dataset):
-    def __init__(self, tokenizer, data, input_column, target_column, source_max_len=512, target_max_len=32, label_default_value=0.0):
-        self.tokenizer = tokenizer
-        self.data_frame = data
-        self.input_column = input_column
-        self.target_column = target_column
-        self.source_max_len = source_max_len
-        self.target_max_len = target_max_len
-        self.label_default_value = label_default_value
-        
-
-    def __len__(self):
-        return len(self.data_frame)
-
-    def __getitem__(self, index):
-        try:
-            # Attempt to handle text that is not in string format
-            text = self.data_frame.iloc[index][self.input_column]
-            if pd.isna(text):
-                text = "Missing data"
-            else:
-                text = str(text)  # Convert any type to string
-
-            # Handle missing or non-numeric label data dynamically
-            label = self.data_frame.iloc[index][self.target_column]
-            if pd.isna(label) or not self._is_float(label):
-                label = self.label_default_value
-            else:
-                label = float(label)
-
-            # Tokenize text
-            tokenized_input = self.tokenizer(
-                text,
-                max_length=self.source_max_len,
-                padding='max_length',
-                truncation=True,
-                return_tensors='pt'
-            )
-
-            # Prepare inputs and labels
-            input_ids = tokenized_input['input_ids'].squeeze().to(dtype=torch.long)  # Explicitly convert to torch.long here
-            attention_mask = tokenized_input['attention_mask'].squeeze().to(dtype=torch.long)  # Same for attention_mask
-
-            return {
-                'input_ids': input_ids, 
-                'attention_mask': attention_mask, 
-                'labels': torch.tensor(label, dtype=torch.float)  # Use torch.float for regression
-            }
-
-        except Exception as e:
-            raise RuntimeError(f"Error processing data at index {index}: {e}")
-
-    @staticmethod
-    def _is_float(value):
-        try:
-            float(value)
-            return True
-        except (TypeError, ValueError):
-            return False
-
-
-class T5ClassificationDataset(Dataset):
-    def __init__(self, tokenizer, data, input_column, target_column, source_max_len=512, target_max_len=32):
-        self.tokenizer = tokenizer
-        self.data_frame = data
-        self.input_column = input_column
-        self.target_column = target_column
-        self.source_max_len = source_max_len
-        self.target_max_len = target_max_len
-        
-    def __len__(self):
-        return len(self.data_frame)
-
-    def __getitem__(self, index):
-        # Extract the text and label from the DataFrame
-        text = self.data_frame.iloc[index][self.input_column]
-        text = str(text) if not pd.isna(text) else "Missing data"
-        
-        label = self.data_frame.iloc[index][self.target_column]
-        label = str(label) if not pd.isna(label) else "Missing label"
-        
-        # Tokenize the text
-        tokenized_input = self.tokenizer(
-            text,
-            max_length=self.source_max_len,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
-        
-        # Tokenize the label
-        tokenized_label = self.tokenizer(
-            label,
-            max_length=self.target_max_len,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
-        
-        # Extract the input_ids and attention_mask and squeeze to remove the batch dimension
-        input_ids = tokenized_input['input_ids'].squeeze().to(dtype=torch.long)
-        attention_mask = tokenized_input['attention_mask'].squeeze().to(dtype=torch.long)
-        
-        # Extract the label_ids and squeeze to remove the batch dimension
-        label_ids = tokenized_label['input_ids'].squeeze().to(dtype=torch.long)
-        
-        # Return a dictionary of tensors
-        return {
-            'input_ids': input_ids,
-            'attention_mask': attention_mask,
-            'labels': label_ids
-        }
-
-
-
-class T5QADataset(Dataset):
-    def __init__(self, tokenizer, data, question_column, context_column, answer_column, source_max_len=512, target_max_len=32):
-        self.tokenizer = tokenizer
-        self.data_frame = data
-        self.question_column = question_column
-        self.context_column = context_column
-        self.answer_column = answer_column
-        self.source_max_len = source_max_len
-        self.target_max_len = target_max_len
-        
-    def __len__(self):
-        return len(self.data_frame)
-
-    def __getitem__(self, index):
-        # Extract the question, context, and answer from the DataFrame
-        question = self.data_frame.iloc[index][self.question_column]
-        question = str(question) if not pd.isna(question) else "Missing question"
-        
-        context = self.data_frame.iloc[index][self.context_column]
-        context = str(context) if not pd.isna(context) else "Missing context"
-        
-        answer = self.data_frame.iloc[index][self.answer_column]
-        answer = str(answer) if not pd.isna(answer) else "Missing answer"
-        
-        # Format the input text as question followed by context
-        t5_input = f"question: {question} context: {context}"
-        
-        # Tokenize the input text
-        tokenized_input = self.tokenizer(
-            t5_input,
-            max_length=self.source_max_len,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
-        
-        # Tokenize the answer
-        tokenized_answer = self.tokenizer(
-            answer,
-            max_length=self.target_max_len,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
-        
-        # Extract the input_ids and attention_mask and squeeze to remove the batch dimension
-        input_ids = tokenized_input['input_ids'].squeeze().to(dtype=torch.long)
-        attention_mask = tokenized_input['attention_mask'].squeeze().to(dtype=torch.long)
-        
-        # Extract the answer_ids and squeeze to remove the batch dimension
-        answer_ids = tokenized_answer['input_ids'].squeeze().to(dtype=torch.long)
-        
-        # Return a dictionary of tensors
-        return {
-            'input_ids': input_ids,
-            'attention_mask': attention_mask,
-            'labels': answer_ids
-        }
-
-
-
-class T5TextGenerationDataset(Dataset):
-    def __init__(self, tokenizer, data, input_column, target_column, source_max_len=512, target_max_len=128):
-        self.tokenizer = tokenizer
-        self.data_frame = data
-        self.input_column = input_column
-        self.target_column = target_column
-        self.source_max_len = source_max_len
-        self.target_max_len = target_max_len
-        
-    def __len__(self):
-        return len(self.data_frame)
-
-    def __getitem__(self, index):
-        # Retrieve the text and the target from the dataframe
-        text = str(self.data_frame.iloc[index][self.input_column]) if not pd.isna(self.data_frame.iloc[index][self.input_column]) else "Missing text"
-        target = str(self.data_frame.iloc[index][self.target_column]) if not pd.isna(self.data_frame.iloc[index][self.target_column]) else "Missing target"
-
-        # Tokenize the text and target
-        tokenized_input = self.tokenizer(
-            text,
-            max_length=self.source_max_len,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
-
-        tokenized_target = self.tokenizer(
-            target,
-            max_length=self.target_max_len,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
-
-        input_ids = tokenized_input['input_ids'].squeeze().to(dtype=torch.long)
-        attention_mask = tokenized_input['attention_mask'].squeeze().to(dtype=torch.long)
-        target_ids = tokenized_target['input_ids'].squeeze().to(dtype=torch.long)
-
-        # Replace the padding token id's of the target by -100 so that it is ignored by the loss function
-        target_ids[target_ids == self.tokenizer.pad_token_id] = -100
-
-        return {
-            'input_ids': input_ids,
-            'attention_mask': attention_mask,
-            'labels': target_ids
-        }
-
-
-
-class T5SummarizationDataset(Dataset):
-    def __init__(self, tokenizer, data, input_column, target_column, source_max_len=512, target_max_len=150):
-        self.tokenizer = tokenizer
-        self.data_frame = data
-        self.input_column = input_column
-        self.target_column = target_column
-        self.source_max_len = source_max_len
-        self.target_max_len = target_max_len
-        
-    def __len__(self):
-        return len(self.data_frame)
-
-    def __getitem__(self, index):
-        # Retrieve the text and the summary from the dataframe
-        text = str(self.data_frame.iloc[index][self.input_column]) if not pd.isna(self.data_frame.iloc[index][self.input_column]) else "Missing text"
-        summary = str(self.data_frame.iloc[index][self.target_column]) if not pd.isna(self.data_frame.iloc[index][self.target_column]) else "Missing summary"
-
-        # Prefix the input text with "summarize: " as per T5's expected format
-        t5_input = f"summarize: {text}"
-
-        # Tokenize the text and summary
-        tokenized_input = self.tokenizer(
-            t5_input,
-            max_length=self.source_max_len,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
-
-        tokenized_target = self.tokenizer(
-            summary,
-            max_length=self.target_max_len,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
-
-        input_ids = tokenized_input['input_ids'].squeeze().to(dtype=torch.long)
-        attention_mask = tokenized_input['attention_mask'].squeeze().to(dtype=torch.long)
-        target_ids = tokenized_target['input_ids'].squeeze().to(dtype=torch.long)
-
-        # Replace the padding token id's of the target by -100 so that it is ignored by the loss function
-        target_ids[target_ids == self.tokenizer.pad_token_id] = -100
-
-        return {
-            'input_ids': input_ids,
-            'attention_mask': attention_mask,
-            'labels': target_ids
-        }
-
-
-class T5NERDataset(Dataset):
-    def __init__(self, tokenizer, data, input_column, target_column, source_max_len=128, target_max_len=128):
-        self.tokenizer = tokenizer
-        self.data_frame = data
-        self.input_column = input_column
-        self.target_column = target_column
-        self.source_max_len = source_max_len
-        self.target_max_len = target_max_len
-
-    def __len__(self):
-        return len(self.data_frame)
-
-    def __getitem__(self, index):
-        # Retrieve the text and the labeled entities
-        text = str(self.data_frame.iloc[index][self.input_column]) if not pd.isna(self.data_frame.iloc[index][self.input_column]) else "Missing text"
-        ner_tags = str(self.data_frame.iloc[index][self.target_column]) if not pd.isna(self.data_frame.iloc[index][self.target_column]) else "Missing tags"
-
-        # Prefix for NER task could be something like "ner: "
-        t5_input = f"ner: {text}"
-
-        # Tokenize the text
-        tokenized_input = self.tokenizer(
-            t5_input,
-            max_length=self.source_max_len,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
-
-        # Tokenize the tags
-        tokenized_target = self.tokenizer(
-            ner_tags,
-            max_length=self.target_max_len,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
-
-        input_ids = tokenized_input['input_ids'].squeeze().to(dtype=torch.long)
-        attention_mask = tokenized_input['attention_mask'].squeeze().to(dtype=torch.long)
-        target_ids = tokenized_target['input_ids'].squeeze().to(dtype=torch.long)
-
-        # Replace the padding token id's of the target by -100 so that it is ignored by the loss function
-        target_ids[target_ids == self.tokenizer.pad_token_id] = -100
-
-        return {
-            'input_ids': input_ids,
-            'attention_mask': attention_mask,
-            'labels': target_ids
-        }
-
-
-
-class T5TranslationDataset(Dataset):
-    def __init__(self, tokenizer, data_frame, source_text_column, target_text_column, source_max_len=512, target_max_len=512):
-        self.tokenizer = tokenizer
-        self.data_frame = data_frame
-        self.source_text = data_frame[source_text_column]
-        self.target_text = data_frame[target_text_column]
-        self.source_max_len = source_max_len
-        self.target_max_len = target_max_len
-
-    def __len__(self):
-        return len(self.data_frame)
-
-    def __getitem__(self, index):
-        source_text = str(self.source_text[index]) if pd.notna(self.source_text[index]) else "Missing data"
-        target_text = str(self.target_text[index]) if pd.notna(self.target_text[index]) else "Missing data"
-
-        # Prepare source text
-        tokenized_source = self.tokenizer(
-            source_text,
-            max_length=self.source_max_len,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
-
-        # Prepare target text
-        tokenized_target = self.tokenizer(
-            target_text,
-            max_length=self.target_max_len,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
-
-        source_ids = tokenized_source['input_ids'].squeeze()
-        source_mask = tokenized_source['attention_mask'].squeeze()
-        target_ids = tokenized_target['input_ids'].squeeze()
-        
-        # For training, T5 expects the decoder_input_ids to be the labels
-        # which are to be shifted right, so ignore the first token of the target sequence
-        labels = target_ids[1:].clone()
-        decoder_input_ids = target_ids[:-1].clone()
-        labels[labels == self.tokenizer.pad_token_id] = -100
-
-        return {
-            'input_ids': source_ids.to(dtype=torch.long),
-            'attention_mask': source_mask.to(dtype=torch.long),
-            'decoder_input_ids': decoder_input_ids.to(dtype=torch.long),
-            'labels': labels.to(dtype=torch.long)
-        }
-
+from torch.utils.data import Dataset
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+import torch
+
+from intellithing.token_cache import TokenCache
+
+# Bump when the layout of the cached arrays changes
+_CACHE_FORMAT_VERSION = 1
+
+# Tokenizer of a pretokenization worker process, set once by _init_tokenize_worker
+_worker_tokenizer = None
+
+
+def _init_tokenize_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _encode_batch(tokenizer, texts, max_len):
+    """Tokenize one batch without padding and return `(flat_ids, lengths)`."""
+    # max_len=None measures the full length, e.g. for profile_lengths
+    encoded = tokenizer(texts, max_length=max_len, truncation=max_len is not None, return_attention_mask=False)['input_ids']
+    lengths = np.fromiter((len(ids) for ids in encoded), dtype=np.int64, count=len(encoded))
+    return np.fromiter(itertools.chain.from_iterable(encoded), dtype=np.int64, count=int(lengths.sum())), lengths
+
+
+def _encode_batch_in_worker(texts, max_len):
+    return _encode_batch(_worker_tokenizer, texts, max_len)
+
+
+class T5BaseDataset(Dataset):
+    """
+    Shared storage for the T5 dataset classes.
+
+    By default every item is tokenized when it is accessed. With ``pretokenize=True``
+    the columns are formatted (missing values filled, task prefixes applied) and
+    batch-tokenized once at construction. The token ids are kept as one flat array
+    per column plus row offsets, so ``__getitem__`` only slices and pads.
+
+    ``padding='max_length'`` (the default) pads every item to the max lengths. With
+    ``padding=False`` items keep their own length and have to be batched with
+    ``intellithing.batching.T5DataCollator``, which pads to the longest item per batch.
+
+    With ``cache_dir`` set, the pretokenized arrays are saved to a memory-mapped
+    ``TokenCache`` keyed by a fingerprint of the tokenizer, the formatted columns and the
+    max lengths. Later runs and DataLoader workers open the cached arrays zero-copy
+    instead of tokenizing again.
+
+    ``packing=True`` (text generation and summarization only) concatenates consecutive
+    short examples into one source window of ``source_max_len`` tokens. Items then carry
+    ``segment_ids``/``decoder_segment_ids`` and have to be trained with
+    ``intellithing.batching.PackedSeq2SeqTrainer``, which turns the segment ids into
+    block-diagonal attention masks so packed examples cannot attend to each other.
+
+    ``num_proc > 1`` tokenizes the batches of ``tokenize_batch_size`` rows in a pool of
+    worker processes. Results are merged in input order, so the arrays are identical to
+    single-process tokenization. ``progress_callback(rows_done, rows_total)`` is called
+    after every batch of every tokenized column.
+
+    ``compact=True`` stores the token ids in int16 (vocabularies of up to 32768 tokens)
+    or int32 and returns attention masks as uint8, instead of 8 bytes per position. Batch
+    compact items with ``intellithing.batching.T5DataCollator``, which upcasts them to
+    long.
+    """
+
+    # Whether the dataset can pack several examples into one window
+    supports_packing = False
+
+    # Replace the padding token id's of the labels by -100 so they are ignored by the loss function
+    mask_label_padding = True
+
+    def __init__(self, tokenizer, data_frame, source_max_len, target_max_len, pretokenize=False, tokenize_batch_size=1000, padding='max_length',
+                 cache_dir=None, cache_max_bytes=10 * 1024 ** 3, packing=False, num_proc=1, progress_callback=None,
+                 compact=False):
+        if padding not in ('max_length', False, 'do_not_pad'):
+            raise ValueError(f"padding should be 'max_length' or False, got {padding!r}")
+        if packing and not self.supports_packing:
+            raise ValueError(f"{type(self).__name__} does not support packing")
+
+        self.tokenizer = tokenizer
+        self.data_frame = data_frame
+        self.source_max_len = source_max_len
+        self.target_max_len = target_max_len
+        self.pretokenize = pretokenize
+        self.tokenize_batch_size = tokenize_batch_size
+        self.padding = padding
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_key = None
+        self.packing = packing
+        self.num_proc = num_proc
+        self.progress_callback = progress_callback
+        self.compact = compact
+        self._id_dtype, self._mask_dtype = self._storage_dtypes(tokenizer, compact)
+        self._token_store = {}
+        self._lengths = None
+        self._pack_offsets = None
+
+        if self.cache_dir is not None or self.packing or self.compact:
+            # The cache stores, and packing and compact storage work on, pretokenized arrays
+            self.pretokenize = True
+
+        if self.pretokenize:
+            self._pretokenize()
+        if self.packing:
+            self._pack()
+
+    @staticmethod
+    def _storage_dtypes(tokenizer, compact):
+        """Return the torch dtypes of the token ids and of the attention masks."""
+        if not compact:
+            return torch.long, torch.long
+        # Signed types, labels hold -100
+        id_dtype = torch.int16 if len(tokenizer) <= torch.iinfo(torch.int16).max + 1 else torch.int32
+        return id_dtype, torch.uint8
+
+    def __len__(self):
+        if self._pack_offsets is not None:
+            return len(self._pack_offsets) - 1
+        return len(self.data_frame)
+
+    def lengths(self):
+        """
+        Return the (truncated) source length of every item as a numpy array, e.g. for
+        `intellithing.batching.LengthBucketSampler`. Without pretokenization the source
+        column is batch-tokenized once to compute them.
+        """
+        if self._lengths is None:
+            if 'input_ids' in self._token_store:
+                offsets = self._token_store['input_ids'][1]
+                if self._pack_offsets is not None:
+                    offsets = offsets[self._pack_offsets]
+            else:
+                offsets = self._tokenize_column(self._source_texts(self.data_frame), self.source_max_len)[1]
+            self._lengths = np.diff(offsets)
+        return self._lengths
+
+    def profile_lengths(self, sample_size=100000, coverage=0.99, seed=0, bins=50, pad_to_multiple_of=8):
+        """
+        Tokenize a random sample of `sample_size` rows without truncation and report per
+        column ('source', and 'target' for text targets) the length histogram, percentiles,
+        the truncation rate at the current max length, the max length that covers the
+        `coverage` quantile (rounded up to `pad_to_multiple_of`) and the estimated savings
+        of switching to it. Savings are fractions of the current cost (negative when the
+        recommendation is longer): `padded_tokens` for activations and linear-layer FLOPs with
+        `padding='max_length'`, `attention_flops` for the quadratic self-attention term and
+        `unpadded_tokens` for `padding=False`, where only truncation changes the cost.
+        """
+        frame = self.data_frame
+        if len(frame) > sample_size:
+            frame = frame.sample(n=sample_size, random_state=seed)
+
+        columns = {'source': (self._source_texts(frame), self.source_max_len)}
+        target_texts = self._target_texts(frame)
+        if target_texts is not None:
+            columns['target'] = (target_texts, self.target_max_len)
+
+        report = {}
+        for name, (texts, max_len) in columns.items():
+            lengths = np.diff(self._tokenize_column(texts, None)[1])
+            counts, edges = np.histogram(lengths, bins=bins)
+            recommended = int(np.ceil(np.quantile(lengths, coverage))) if len(lengths) else 0
+            if pad_to_multiple_of:
+                recommended = max(pad_to_multiple_of, -(-recommended // pad_to_multiple_of) * pad_to_multiple_of)
+
+            current_tokens = np.minimum(lengths, max_len).sum()
+            report[name] = {
+                'num_rows': int(len(lengths)),
+                'mean': float(lengths.mean()) if len(lengths) else 0.0,
+                'percentiles': {q: int(np.percentile(lengths, q)) if len(lengths) else 0 for q in (50, 90, 95, 99, 100)},
+                'histogram': {'counts': counts.tolist(), 'bin_edges': edges.tolist()},
+                'max_len': max_len,
+                'truncation_rate': float((lengths > max_len).mean()) if len(lengths) else 0.0,
+                'recommended_max_len': recommended,
+                'recommended_truncation_rate': float((lengths > recommended).mean()) if len(lengths) else 0.0,
+                'savings': {
+                    'padded_tokens': 1 - recommended / max_len,
+                    'attention_flops': 1 - (recommended / max_len) ** 2,
+                    'unpadded_tokens': float(1 - np.minimum(lengths, recommended).sum() / current_tokens) if current_tokens else 0.0,
+                },
+            }
+        return report
+
+    def _source_texts(self, frame):
+        raise NotImplementedError
+
+    def _target_texts(self, frame):
+        raise NotImplementedError
+
+    @staticmethod
+    def _fill_missing(column, missing_value):
+        # Vectorized equivalent of `str(value) if not pd.isna(value) else missing_value`
+        return column.where(column.notna(), missing_value).astype(str)
+
+    def _pretokenize(self):
+        source_texts = self._source_texts(self.data_frame)
+        target_texts = self._target_texts(self.data_frame)
+
+        if self.cache_dir is None:
+            arrays = self._tokenize_arrays(source_texts, target_texts)
+        else:
+            cache = TokenCache(self.cache_dir, max_bytes=self.cache_max_bytes)
+            self.cache_key = TokenCache.fingerprint(
+                _CACHE_FORMAT_VERSION,
+                type(self).__name__,
+                TokenCache.tokenizer_fingerprint(self.tokenizer),
+                self.source_max_len,
+                self.target_max_len,
+                str(self._id_dtype),
+                source_texts,
+                target_texts if target_texts is not None else b'',
+                self._fingerprint_extra(),
+            )
+            arrays = cache.load(self.cache_key)
+            if arrays is None:
+                arrays = cache.save(self.cache_key, self._tokenize_arrays(source_texts, target_texts))
+        self._set_arrays(arrays)
+
+    def _fingerprint_extra(self):
+        # Anything besides the formatted texts that changes the cached arrays
+        return b''
+
+    def _tokenize_arrays(self, source_texts, target_texts):
+        arrays = {}
+        arrays['input_ids'], arrays['input_ids_offsets'] = self._tokenize_column(source_texts, self.source_max_len)
+        if target_texts is not None:
+            arrays['labels'], arrays['labels_offsets'] = self._tokenize_column(target_texts, self.target_max_len)
+        if self.compact:
+            numpy_dtype = torch.empty(0, dtype=self._id_dtype).numpy().dtype
+            for name in ('input_ids', 'labels'):
+                if name in arrays:
+                    arrays[name] = arrays[name].astype(numpy_dtype)
+        return arrays
+
+    def _set_arrays(self, arrays):
+        for name in ('input_ids', 'labels'):
+            if name in arrays:
+                self._token_store[name] = (arrays[name], arrays[f'{name}_offsets'])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Callbacks are often lambdas or bound to a progress bar, neither of which pickles
+        state['progress_callback'] = None
+        if self.cache_key is not None:
+            # Pickled copies (e.g. spawned DataLoader workers) reopen the memory-mapped cache
+            state['_token_store'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.cache_key is not None:
+            arrays = TokenCache(self.cache_dir, max_bytes=self.cache_max_bytes).load(self.cache_key)
+            if arrays is not None:
+                self._set_arrays(arrays)
+                return
+            # The entry was evicted since pickling: tokenize the stored frame again and re-create it,
+            # in this process, which may be a DataLoader worker that cannot start a pool
+            num_proc, self.num_proc = self.num_proc, 1
+            try:
+                self._pretokenize()
+            finally:
+                self.num_proc = num_proc
+
+    def _tokenize_column(self, texts, max_len):
+        """
+        Batch-tokenize `texts` without padding and return `(flat_ids, offsets)`, where the
+        ids of row `i` are `flat_ids[offsets[i]:offsets[i + 1]]`.
+        """
+        batches = [texts[start:start + self.tokenize_batch_size] for start in range(0, len(texts), self.tokenize_batch_size)]
+
+        chunks, lengths, rows_done = [], [], 0
+        for flat_ids, batch_lengths in self._encode_batches(batches, max_len):
+            chunks.append(flat_ids)
+            lengths.append(batch_lengths)
+            rows_done += len(batch_lengths)
+            if self.progress_callback is not None:
+                self.progress_callback(rows_done, len(texts))
+
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        if lengths:
+            np.cumsum(np.concatenate(lengths), out=offsets[1:])
+        flat_ids = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64)
+        return flat_ids, offsets
+
+    def _encode_batches(self, batches, max_len):
+        """Yield the encoded batches in input order, from a process pool when `num_proc > 1`."""
+        num_proc = min(self.num_proc or 1, len(batches))
+        if num_proc <= 1:
+            for batch in batches:
+                yield _encode_batch(self.tokenizer, batch, max_len)
+            return
+
+        # Fork where available so workers inherit the tokenizer instead of unpickling it
+        method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+        with ProcessPoolExecutor(num_proc, mp_context=multiprocessing.get_context(method),
+                                 initializer=_init_tokenize_worker, initargs=(self.tokenizer,)) as executor:
+            # Executor.map returns the results in submission order
+            yield from executor.map(_encode_batch_in_worker, batches, itertools.repeat(max_len))
+
+    def _stored_sequence(self, name, index, max_len):
+        if index < 0:
+            index += len(self)
+        flat_ids, offsets = self._token_store[name]
+        # Copy the slice, the stored arrays may be read-only memory maps
+        ids = torch.tensor(flat_ids[offsets[index]:offsets[index + 1]], dtype=self._id_dtype)
+        if self.padding != 'max_length':
+            return ids, torch.ones(len(ids), dtype=self._mask_dtype)
+
+        input_ids = torch.full((max_len,), self.tokenizer.pad_token_id, dtype=self._id_dtype)
+        input_ids[:len(ids)] = ids
+        attention_mask = torch.zeros(max_len, dtype=self._mask_dtype)
+        attention_mask[:len(ids)] = 1
+        return input_ids, attention_mask
+
+    def _stored_labels(self, index):
+        labels, _ = self._stored_sequence('labels', index, self.target_max_len)
+        if self.mask_label_padding:
+            labels[labels == self.tokenizer.pad_token_id] = -100
+        return {'labels': labels}
+
+    def _pack(self):
+        """
+        Greedily group consecutive rows into packs whose source and target tokens fit
+        `source_max_len` and `target_max_len`. Pack `i` holds rows
+        `_pack_offsets[i]:_pack_offsets[i + 1]`.
+        """
+        source_lengths = np.diff(self._token_store['input_ids'][1])
+        target_lengths = np.diff(self._token_store['labels'][1])
+
+        boundaries = [0]
+        source_total = target_total = 0
+        for row, (source_length, target_length) in enumerate(zip(source_lengths, target_lengths)):
+            if row > boundaries[-1] and (source_total + source_length > self.source_max_len or target_total + target_length > self.target_max_len):
+                boundaries.append(row)
+                source_total = target_total = 0
+            source_total += source_length
+            target_total += target_length
+        if len(source_lengths):
+            boundaries.append(len(source_lengths))
+        self._pack_offsets = np.array(boundaries, dtype=np.int64)
+
+    def packing_stats(self):
+        """
+        Report how well the examples were packed. `packing_efficiency` is the share of the
+        source windows filled with real tokens (`unpacked_efficiency` is the same ratio
+        without packing), and `windows_saved` the fraction of encoder windows, and so of
+        encoder compute per epoch, saved by packing.
+        """
+        if self._pack_offsets is None:
+            raise ValueError("packing_stats() needs a dataset built with packing=True")
+
+        num_examples = len(self._token_store['input_ids'][1]) - 1
+        num_packs = len(self)
+        source_tokens = int(self._token_store['input_ids'][1][-1])
+        target_tokens = int(self._token_store['labels'][1][-1])
+        return {
+            'num_examples': num_examples,
+            'num_packs': num_packs,
+            'packing_efficiency': source_tokens / max(1, num_packs * self.source_max_len),
+            'unpacked_efficiency': source_tokens / max(1, num_examples * self.source_max_len),
+            'target_packing_efficiency': target_tokens / max(1, num_packs * self.target_max_len),
+            'windows_saved': 1 - num_packs / max(1, num_examples),
+        }
+
+    @property
+    def packing_efficiency(self):
+        return self.packing_stats()['packing_efficiency']
+
+    def _packed_item(self, index):
+        if index < 0:
+            index += len(self)
+        start, end = self._pack_offsets[index], self._pack_offsets[index + 1]
+        source_ids, source_offsets = self._token_store['input_ids']
+        target_ids, target_offsets = self._token_store['labels']
+        segments = np.arange(1, end - start + 1)
+
+        input_ids = torch.tensor(source_ids[source_offsets[start]:source_offsets[end]], dtype=self._id_dtype)
+        segment_ids = torch.from_numpy(np.repeat(segments, np.diff(source_offsets[start:end + 1]))).to(self._id_dtype)
+        target = torch.tensor(target_ids[target_offsets[start]:target_offsets[end]], dtype=self._id_dtype)
+        decoder_segment_ids = torch.from_numpy(np.repeat(segments, np.diff(target_offsets[start:end + 1]))).to(self._id_dtype)
+
+        # Shift the targets right and restart every segment from the decoder start token
+        # (the pad token for T5), so each packed example is decoded on its own
+        decoder_input_ids = torch.full_like(target, self.tokenizer.pad_token_id)
+        decoder_input_ids[1:] = target[:-1]
+        segment_starts = torch.from_numpy(target_offsets[start:end] - target_offsets[start])
+        decoder_input_ids[segment_starts[segment_starts < len(target)]] = self.tokenizer.pad_token_id
+
+        labels = target.clone()
+        labels[labels == self.tokenizer.pad_token_id] = -100
+
+        item = {
+            'input_ids': input_ids,
+            'attention_mask': torch.ones(len(input_ids), dtype=self._mask_dtype),
+            'segment_ids': segment_ids,
+            'decoder_input_ids': decoder_input_ids,
+            'decoder_segment_ids': decoder_segment_ids,
+            'labels': labels,
+        }
+        if self.padding == 'max_length':
+            padding_values = {
+                'input_ids': (self.source_max_len, self.tokenizer.pad_token_id),
+                'attention_mask': (self.source_max_len, 0),
+                'segment_ids': (self.source_max_len, 0),
+                'decoder_input_ids': (self.target_max_len, self.tokenizer.pad_token_id),
+                'decoder_segment_ids': (self.target_max_len, 0),
+                'labels': (self.target_max_len, -100),
+            }
+            for key, (max_len, value) in padding_values.items():
+                padded = torch.full((max_len,), value, dtype=item[key].dtype)
+                padded[:len(item[key])] = item[key]
+                item[key] = padded
+        return item
+
+    def _pretokenized_item(self, index):
+        if self._pack_offsets is not None:
+            return self._packed_item(index)
+
+        input_ids, attention_mask = self._stored_sequence('input_ids', index, self.source_max_len)
+        item = {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+        }
+        item.update(self._stored_labels(index))
+        return item
+
+
+class T5RegressionDataset(T5BaseDataset):
+    def __init__(self, tokenizer, data, input_column, target_column, source_max_len=512, target_max_len=32, label_default_value=0.0, **kwargs):
+        self.input_column = input_column
+        self.target_column = target_column
+        self.label_default_value = label_default_value
+        self._label_values = self._float_labels(data[target_column], label_default_value)
+        super().__init__(tokenizer, data, source_max_len, target_max_len, **kwargs)
+
+    @staticmethod
+    def _float_labels(column, default_value):
+        """
+        Convert the target column to float32 in one vectorized pass. Missing, non-numeric
+        and non-finite values are replaced by `default_value`.
+        """
+        values = pd.to_numeric(column, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        return np.where(np.isfinite(values), values, default_value).astype(np.float32)
+
+    def _source_texts(self, frame):
+        return self._fill_missing(frame[self.input_column], "Missing data").tolist()
+
+    def _target_texts(self, frame):
+        # Regression targets are numbers, not token sequences
+        return None
+
+    def _stored_labels(self, index):
+        return {'labels': torch.tensor(self._label_values[index], dtype=torch.float)}
+
+    def __getitem__(self, index):
+        if self.pretokenize:
+            return self._pretokenized_item(index)
+
+        try:
+            # Attempt to handle text that is not in string format
+            text = self.data_frame.iloc[index][self.input_column]
+            if pd.isna(text):
+                text = "Missing data"
+            else:
+                text = str(text)  # Convert any type to string
+
+            # Missing or non-numeric labels were replaced by label_default_value at construction
+            label = self._label_values[index]
+
+            # Tokenize text
+            tokenized_input = self.tokenizer(
+                text,
+                max_length=self.source_max_len,
+                padding=self.padding,
+                truncation=True,
+                return_tensors='pt'
+            )
+
+            # Prepare inputs and labels
+            input_ids = tokenized_input['input_ids'].squeeze(0).to(dtype=torch.long)  # Explicitly convert to torch.long here
+            attention_mask = tokenized_input['attention_mask'].squeeze(0).to(dtype=torch.long)  # Same for attention_mask
+
+            return {
+                'input_ids': input_ids, 
+                'attention_mask': attention_mask, 
+                'labels': torch.tensor(label, dtype=torch.float)  # Use torch.float for regression
+            }
+
+        except Exception as e:
+            raise RuntimeError(f"Error processing data at index {index}: {e}")
+
+
+class T5ClassificationDataset(T5BaseDataset):
+    # Classification labels keep their padding token id's
+    mask_label_padding = False
+
+    def __init__(self, tokenizer, data, input_column, target_column, source_max_len=512, target_max_len=32, **kwargs):
+        self.input_column = input_column
+        self.target_column = target_column
+        # Set by _intern_labels: one label index per row and the token ids of every distinct label
+        self._label_codes = None
+        self._label_table = None
+        super().__init__(tokenizer, data, source_max_len, target_max_len, **kwargs)
+        self._intern_labels()
+
+    def _source_texts(self, frame):
+        return self._fill_missing(frame[self.input_column], "Missing data").tolist()
+
+    def _target_texts(self, frame):
+        return self._fill_missing(frame[self.target_column], "Missing label").tolist()
+
+    def _tokenize_arrays(self, source_texts, target_texts):
+        # Labels are interned by _intern_labels instead of being tokenized per row
+        return super()._tokenize_arrays(source_texts, None)
+
+    def _intern_labels(self):
+        """
+        Tokenize every distinct label once. Rows only keep a compact index into the
+        resulting lookup table, which already holds the `target_max_len` padding.
+        """
+        codes, labels = pd.factorize(self._fill_missing(self.data_frame[self.target_column], "Missing label"))
+        self._label_codes = codes.astype(np.int32)
+        self._label_table = []
+        if len(labels):
+            tokenized_labels = self.tokenizer(
+                list(labels),
+                max_length=self.target_max_len,
+                padding=self.padding,
+                truncation=True,
+            )['input_ids']
+            self._label_table = [torch.tensor(label_ids, dtype=self._id_dtype) for label_ids in tokenized_labels]
+
+    def _stored_labels(self, index):
+        return {'labels': self._label_table[self._label_codes[index]].clone()}
+
+    def __getitem__(self, index):
+        if self.pretokenize:
+            return self._pretokenized_item(index)
+
+        # Extract the text from the DataFrame
+        text = self.data_frame.iloc[index][self.input_column]
+        text = str(text) if not pd.isna(text) else "Missing data"
+        
+        # Tokenize the text
+        tokenized_input = self.tokenizer(
+            text,
+            max_length=self.source_max_len,
+            padding=self.padding,
+            truncation=True,
+            return_tensors='pt'
+        )
+        
+        # Extract the input_ids and attention_mask and squeeze to remove the batch dimension
+        input_ids = tokenized_input['input_ids'].squeeze(0).to(dtype=torch.long)
+        attention_mask = tokenized_input['attention_mask'].squeeze(0).to(dtype=torch.long)
+        
+        # Return a dictionary of tensors, the label ids come from the interned label table
+        return {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'labels': self._stored_labels(index)['labels']
+        }
+
+
+
+class T5QADataset(T5BaseDataset):
+    # QA answers keep their padding token id's
+    mask_label_padding = False
+
+    def __init__(self, tokenizer, data, question_column, context_column, answer_column, source_max_len=512, target_max_len=32, **kwargs):
+        self.question_column = question_column
+        self.context_column = context_column
+        self.answer_column = answer_column
+        super().__init__(tokenizer, data, source_max_len, target_max_len, **kwargs)
+
+    def _source_texts(self, frame):
+        question = self._fill_missing(frame[self.question_column], "Missing question")
+        context = self._fill_missing(frame[self.context_column], "Missing context")
+        return ("question: " + question + " context: " + context).tolist()
+
+    def _target_texts(self, frame):
+        return self._fill_missing(frame[self.answer_column], "Missing answer").tolist()
+
+    def __getitem__(self, index):
+        if self.pretokenize:
+            return self._pretokenized_item(index)
+
+        # Extract the question, context, and answer from the DataFrame
+        question = self.data_frame.iloc[index][self.question_column]
+        question = str(question) if not pd.isna(question) else "Missing question"
+        
+        context = self.data_frame.iloc[index][self.context_column]
+        context = str(context) if not pd.isna(context) else "Missing context"
+        
+        answer = self.data_frame.iloc[index][self.answer_column]
+        answer = str(answer) if not pd.isna(answer) else "Missing answer"
+        
+        # Format the input text as question followed by context
+        t5_input = f"question: {question} context: {context}"
+        
+        # Tokenize the input text
+        tokenized_input = self.tokenizer(
+            t5_input,
+            max_length=self.source_max_len,
+            padding=self.padding,
+            truncation=True,
+            return_tensors='pt'
+        )
+        
+        # Tokenize the answer
+        tokenized_answer = self.tokenizer(
+            answer,
+            max_length=self.target_max_len,
+            padding=self.padding,
+            truncation=True,
+            return_tensors='pt'
+        )
+        
+        # Extract the input_ids and attention_mask and squeeze to remove the batch dimension
+        input_ids = tokenized_input['input_ids'].squeeze(0).to(dtype=torch.long)
+        attention_mask = tokenized_input['attention_mask'].squeeze(0).to(dtype=torch.long)
+        
+        # Extract the answer_ids and squeeze to remove the batch dimension
+        answer_ids = tokenized_answer['input_ids'].squeeze(0).to(dtype=torch.long)
+        
+        # Return a dictionary of tensors
+        return {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'labels': answer_ids
+        }
+
+
+
+class T5TextGenerationDataset(T5BaseDataset):
+    supports_packing = True
+
+    def __init__(self, tokenizer, data, input_column, target_column, source_max_len=512, target_max_len=128, **kwargs):
+        self.input_column = input_column
+        self.target_column = target_column
+        super().__init__(tokenizer, data, source_max_len, target_max_len, **kwargs)
+
+    def _source_texts(self, frame):
+        return self._fill_missing(frame[self.input_column], "Missing text").tolist()
+
+    def _target_texts(self, frame):
+        return self._fill_missing(frame[self.target_column], "Missing target").tolist()
+
+    def __getitem__(self, index):
+        if self.pretokenize:
+            return self._pretokenized_item(index)
+
+        # Retrieve the text and the target from the dataframe
+        text = str(self.data_frame.iloc[index][self.input_column]) if not pd.isna(self.data_frame.iloc[index][self.input_column]) else "Missing text"
+        target = str(self.data_frame.iloc[index][self.target_column]) if not pd.isna(self.data_frame.iloc[index][self.target_column]) else "Missing target"
+
+        # Tokenize the text and target
+        tokenized_input = self.tokenizer(
+            text,
+            max_length=self.source_max_len,
+            padding=self.padding,
+            truncation=True,
+            return_tensors='pt'
+        )
+
+        tokenized_target = self.tokenizer(
+            target,
+            max_length=self.target_max_len,
+            padding=self.padding,
+            truncation=True,
+            return_tensors='pt'
+        )
+
+        input_ids = tokenized_input['input_ids'].squeeze(0).to(dtype=torch.long)
+        attention_mask = tokenized_input['attention_mask'].squeeze(0).to(dtype=torch.long)
+        target_ids = tokenized_target['input_ids'].squeeze(0).to(dtype=torch.long)
+
+        # Replace the padding token id's of the target by -100 so that it is ignored by the loss function
+        target_ids[target_ids == self.tokenizer.pad_token_id] = -100
+
+        return {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'labels': target_ids
+        }
+
+
+
+class T5SummarizationDataset(T5BaseDataset):
+    supports_packing = True
+
+    def __init__(self, tokenizer, data, input_column, target_column, source_max_len=512, target_max_len=150, **kwargs):
+        self.input_column = input_column
+        self.target_column = target_column
+        super().__init__(tokenizer, data, source_max_len, target_max_len, **kwargs)
+
+    def _source_texts(self, frame):
+        text = self._fill_missing(frame[self.input_column], "Missing text")
+        return ("summarize: " + text).tolist()
+
+    def _target_texts(self, frame):
+        return self._fill_missing(frame[self.target_column], "Missing summary").tolist()
+
+    def __getitem__(self, index):
+        if self.pretokenize:
+            return self._pretokenized_item(index)
+
+        # Retrieve the text and the summary from the dataframe
+        text = str(self.data_frame.iloc[index][self.input_column]) if not pd.isna(self.data_frame.iloc[index][self.input_column]) else "Missing text"
+        summary = str(self.data_frame.iloc[index][self.target_column]) if not pd.isna(self.data_frame.iloc[index][self.target_column]) else "Missing summary"
+
+        # Prefix the input text with "summarize: " as per T5's expected format
+        t5_input = f"summarize: {text}"
+
+        # Tokenize the text and summary
+        tokenized_input = self.tokenizer(
+            t5_input,
+            max_length=self.source_max_len,
+            padding=self.padding,
+            truncation=True,
+            return_tensors='pt'
+        )
+
+        tokenized_target = self.tokenizer(
+            summary,
+            max_length=self.target_max_len,
+            padding=self.padding,
+            truncation=True,
+            return_tensors='pt'
+        )
+
+        input_ids = tokenized_input['input_ids'].squeeze(0).to(dtype=torch.long)
+        attention_mask = tokenized_input['attention_mask'].squeeze(0).to(dtype=torch.long)
+        target_ids = tokenized_target['input_ids'].squeeze(0).to(dtype=torch.long)
+
+        # Replace the padding token id's of the target by -100 so that it is ignored by the loss function
+        target_ids[target_ids == self.tokenizer.pad_token_id] = -100
+
+        return {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'labels': target_ids
+        }
+
+
+class T5NERDataset(T5BaseDataset):
+    def __init__(self, tokenizer, data, input_column, target_column, source_max_len=128, target_max_len=128, **kwargs):
+        self.input_column = input_column
+        self.target_column = target_column
+        super().__init__(tokenizer, data, source_max_len, target_max_len, **kwargs)
+
+    def _source_texts(self, frame):
+        text = self._fill_missing(frame[self.input_column], "Missing text")
+        return ("ner: " + text).tolist()
+
+    def _target_texts(self, frame):
+        return self._fill_missing(frame[self.target_column], "Missing tags").tolist()
+
+    def __getitem__(self, index):
+        if self.pretokenize:
+            return self._pretokenized_item(index)
+
+        # Retrieve the text and the labeled entities
+        text = str(self.data_frame.iloc[index][self.input_column]) if not pd.isna(self.data_frame.iloc[index][self.input_column]) else "Missing text"
+        ner_tags = str(self.data_frame.iloc[index][self.target_column]) if not pd.isna(self.data_frame.iloc[index][self.target_column]) else "Missing tags"
+
+        # Prefix for NER task could be something like "ner: "
+        t5_input = f"ner: {text}"
+
+        # Tokenize the text
+        tokenized_input = self.tokenizer(
+            t5_input,
+            max_length=self.source_max_len,
+            padding=self.padding,
+            truncation=True,
+            return_tensors='pt'
+        )
+
+        # Tokenize the tags
+        tokenized_target = self.tokenizer(
+            ner_tags,
+            max_length=self.target_max_len,
+            padding=self.padding,
+            truncation=True,
+            return_tensors='pt'
+        )
+
+        input_ids = tokenized_input['input_ids'].squeeze(0).to(dtype=torch.long)
+        attention_mask = tokenized_input['attention_mask'].squeeze(0).to(dtype=torch.long)
+        target_ids = tokenized_target['input_ids'].squeeze(0).to(dtype=torch.long)
+
+        # Replace the padding token id's of the target by -100 so that it is ignored by the loss function
+        target_ids[target_ids == self.tokenizer.pad_token_id] = -100
+
+        return {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'labels': target_ids
+        }
+
+
+
+class T5TranslationDataset(T5BaseDataset):
+    def __init__(self, tokenizer, data_frame, source_text_column, target_text_column, source_max_len=512, target_max_len=512, **kwargs):
+        self.source_text_column = source_text_column
+        self.target_text_column = target_text_column
+        self.source_text = data_frame[source_text_column]
+        self.target_text = data_frame[target_text_column]
+        super().__init__(tokenizer, data_frame, source_max_len, target_max_len, **kwargs)
+
+    def _source_texts(self, frame):
+        return self._fill_missing(frame[self.source_text_column], "Missing data").tolist()
+
+    def _target_texts(self, frame):
+        return self._fill_missing(frame[self.target_text_column], "Missing data").tolist()
+
+    def _stored_labels(self, index):
+        target_ids, _ = self._stored_sequence('labels', index, self.target_max_len)
+
+        # Same shift as the lazy path: decoder inputs drop the last token, labels drop the first
+        labels = target_ids[1:].clone()
+        decoder_input_ids = target_ids[:-1].clone()
+        labels[labels == self.tokenizer.pad_token_id] = -100
+        return {
+            'decoder_input_ids': decoder_input_ids,
+            'labels': labels,
+        }
+
+    def __getitem__(self, index):
+        if self.pretokenize:
+            return self._pretokenized_item(index)
+
+        source_text = str(self.source_text[index]) if pd.notna(self.source_text[index]) else "Missing data"
+        target_text = str(self.target_text[index]) if pd.notna(self.target_text[index]) else "Missing data"
+
+        # Prepare source text
+        tokenized_source = self.tokenizer(
+            source_text,
+            max_length=self.source_max_len,
+            padding=self.padding,
+            truncation=True,
+            return_tensors='pt'
+        )
+
+        # Prepare target text
+        tokenized_target = self.tokenizer(
+            target_text,
+            max_length=self.target_max_len,
+            padding=self.padding,
+            truncation=True,
+            return_tensors='pt'
+        )
+
+        source_ids = tokenized_source['input_ids'].squeeze(0)
+        source_mask = tokenized_source['attention_mask'].squeeze(0)
+        target_ids = tokenized_target['input_ids'].squeeze(0)
+        
+        # For training, T5 expects the decoder_input_ids to be the labels
+        # which are to be shifted right, so ignore the first token of the target sequence
+        labels = target_ids[1:].clone()
+        decoder_input_ids = target_ids[:-1].clone()
+        labels[labels == self.tokenizer.pad_token_id] = -100
+
+        return {
+            'input_ids': source_ids.to(dtype=torch.long),
+            'attention_mask': source_mask.to(dtype=torch.long),
+            'decoder_input_ids': decoder_input_ids.to(dtype=torch.long),
+            'labels': labels.to(dtype=torch.long)
+        }
+
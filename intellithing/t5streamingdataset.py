@@ -0,0 +1,331 @@
+import csv
+import io
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+from intellithing.t5customdataset import (
+    T5RegressionDataset, T5ClassificationDataset, T5QADataset,
+    T5TextGenerationDataset, T5SummarizationDataset, T5NERDataset,
+    T5TranslationDataset
+)
+
+_FILE_FORMATS = {
+    '.csv': 'csv',
+    '.tsv': 'csv',
+    '.json': 'json',
+    '.jsonl': 'json',
+    '.parquet': 'parquet',
+}
+
+# read_kwargs with which the rows of a chunk can be split off as raw lines and parsed on their own,
+# see T5StreamingDataset._split_lines
+_SPLITTABLE_READ_KWARGS = {
+    'csv': {'sep', 'delimiter', 'quotechar', 'escapechar', 'doublequote', 'header', 'names', 'encoding', 'dtype',
+            'usecols', 'na_values', 'keep_default_na', 'na_filter', 'converters', 'true_values', 'false_values'},
+    'json': {'encoding', 'dtype', 'convert_dates', 'keep_default_dates', 'precise_float'},
+}
+
+
+class T5StreamingDataset(IterableDataset):
+    """
+    Streaming counterpart of the T5 datasets for corpora that do not fit in memory.
+
+    The data files (CSV, JSON lines or Parquet) are read in chunks of `chunk_size` rows.
+    Every chunk is batch-tokenized by the matching map-style dataset class, so items are
+    identical to the ones it produces. With at least as many files as DataLoader workers
+    the files are dealt round-robin to the workers, otherwise the chunks of every file are;
+    a worker skips the chunks of the others without parsing them (Parquet reads only the
+    row groups of its own chunks), and no example is produced twice. With `shuffle_buffer_size > 0` items go
+    through a bounded shuffle buffer; call `set_epoch` to reshuffle between epochs.
+
+    Under the Trainer, accelerate already splits an iterable dataset between processes
+    (it dispatches batches from rank 0 or wraps the dataset in an `IterableDatasetShard`),
+    so by default every process reads the whole stream. Pass `shard_across_processes=True`
+    only when feeding a plain per-rank DataLoader in an initialized torch.distributed
+    group; chunks are then also dealt to the ranks.
+
+    Streaming datasets have no `len()`. Pass `num_examples` (or call `count_examples()`) so
+    HyperparameterTuner and AutoTrainer can derive the number of training steps.
+    """
+
+    dataset_class = None
+
+    def __init__(self, tokenizer, data_files, columns, dataset_kwargs=None, file_format=None, chunk_size=10000,
+                 shuffle_buffer_size=0, seed=0, num_examples=None, read_kwargs=None, shard_across_processes=False):
+        if isinstance(data_files, str):
+            data_files = [data_files]
+
+        self.tokenizer = tokenizer
+        self.data_files = list(data_files)
+        self.columns = tuple(columns)
+        self.dataset_kwargs = dict(dataset_kwargs or {})
+        self.file_format = file_format
+        self.chunk_size = chunk_size
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.num_examples = num_examples
+        self.read_kwargs = dict(read_kwargs or {})
+        self.shard_across_processes = shard_across_processes
+        self.sample_fraction = 1.0
+        self.sample_seed = 0
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def subsample(self, fraction, seed=0):
+        """
+        Return a view of this dataset that keeps a reproducible random `fraction` of the rows
+        of every chunk, e.g. for hyperparameter tuning on a subset. Nothing is read up front.
+        The rows are drawn with `seed`; the shuffle buffer keeps the dataset's own seed.
+        """
+        if fraction <= 0 or fraction > 1:
+            raise ValueError("fraction should be greater than 0 and less than or equal to 1")
+
+        subset = self.__class__.__new__(self.__class__)
+        subset.__dict__.update(self.__dict__)
+        subset.sample_fraction = self.sample_fraction * fraction
+        subset.sample_seed = seed
+        if self.num_examples is not None:
+            subset.num_examples = int(round(self.num_examples * fraction))
+        return subset
+
+    def count_examples(self):
+        """Count the rows of all data files (Parquet uses the file metadata) and store them in `num_examples`."""
+        total = 0
+        for path in self.data_files:
+            if self._file_format(path) == 'parquet':
+                import pyarrow.parquet as pq
+                total += pq.ParquetFile(path).metadata.num_rows
+            else:
+                total += sum(len(chunk) for _, chunk in self._read_file(path))
+        self.num_examples = int(round(total * self.sample_fraction))
+        return self.num_examples
+
+    def _file_format(self, path):
+        if self.file_format is not None:
+            return self.file_format
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in _FILE_FORMATS:
+            raise ValueError(f"Cannot infer the file format of {path}. Pass file_format='csv', 'json' or 'parquet'.")
+        return _FILE_FORMATS[extension]
+
+    def _read_file(self, path, owned=None):
+        """
+        Yield `(chunk index, chunk)` for the chunks of `chunk_size` rows of `path` that are
+        `owned(chunk index)` (all by default). The other chunks are skipped as raw lines or
+        Parquet row groups without being parsed, unless `read_kwargs` change how rows are
+        split into lines; then every chunk is parsed and the others dropped.
+        """
+        file_format = self._file_format(path)
+        if file_format == 'parquet':
+            yield from self._read_parquet(path, owned)
+            return
+        if file_format not in ('csv', 'json'):
+            raise ValueError(f"Unsupported file format: {file_format}")
+
+        kwargs = {'sep': '\t'} if file_format == 'csv' and path.endswith('.tsv') else {}
+        kwargs.update(self.read_kwargs)
+        splittable = set(kwargs) <= _SPLITTABLE_READ_KWARGS[file_format] and kwargs.get('header', 'infer') in ('infer', 0, None)
+        if owned is not None and splittable:
+            yield from self._split_lines(path, file_format, kwargs, owned)
+            return
+        if file_format == 'csv':
+            reader = pd.read_csv(path, chunksize=self.chunk_size, **kwargs)
+        else:
+            reader = pd.read_json(path, lines=True, chunksize=self.chunk_size, **kwargs)
+        with reader:
+            for index, chunk in enumerate(reader):
+                if owned is None or owned(index):
+                    yield index, chunk
+
+    def _split_lines(self, path, file_format, kwargs, owned):
+        """
+        Split a CSV or JSON lines file into chunks of raw lines and only parse the owned ones.
+        JSON lines chunks are `chunk_size` lines, as pandas reads them; CSV records are found
+        with the csv module, so quoted fields may span lines, and blank lines are not counted.
+        """
+        encoding = kwargs.pop('encoding', None)
+        with open(path, encoding=encoding, newline='' if file_format == 'csv' else None) as file:
+            if file_format == 'json':
+                for index in itertools.count():
+                    lines = list(itertools.islice(file, self.chunk_size))
+                    if not lines:
+                        return
+                    if owned(index):
+                        yield index, pd.read_json(io.StringIO(''.join(lines)), lines=True, **kwargs)
+                return
+
+            lines = []
+
+            def read_lines():
+                for line in file:
+                    lines.append(line)
+                    yield line
+
+            delimiter = kwargs.get('sep', kwargs.get('delimiter', ','))
+            records = csv.reader(read_lines(), delimiter=delimiter, quotechar=kwargs.get('quotechar', '"'),
+                                 escapechar=kwargs.get('escapechar'), doublequote=kwargs.get('doublequote', True))
+            header_lines = ''
+            # As in pandas, 'infer' reads a header row unless names are given
+            header = kwargs.get('header', 'infer')
+            if header == 0 or (header == 'infer' and kwargs.get('names') is None):
+                next(records, None)
+                header_lines = ''.join(lines)
+                lines.clear()
+
+            index, rows = 0, 0
+            for record in records:
+                rows += bool(record)
+                if rows == self.chunk_size:
+                    if owned(index):
+                        yield index, pd.read_csv(io.StringIO(header_lines + ''.join(lines)), **kwargs)
+                    index, rows = index + 1, 0
+                    lines.clear()
+            if rows and owned(index):
+                yield index, pd.read_csv(io.StringIO(header_lines + ''.join(lines)), **kwargs)
+
+    def _read_parquet(self, path, owned):
+        """Read the row ranges of the owned chunks, loading only the row groups they overlap."""
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Reading Parquet files requires pyarrow: pip install pyarrow")
+        parquet_file = pq.ParquetFile(path)
+        metadata = parquet_file.metadata
+        starts = np.cumsum([0] + [metadata.row_group(group).num_rows for group in range(metadata.num_row_groups)])
+        loaded = {}
+        for index in range(-(-metadata.num_rows // self.chunk_size)):
+            if owned is not None and not owned(index):
+                continue
+            begin, end = index * self.chunk_size, min((index + 1) * self.chunk_size, metadata.num_rows)
+            groups = range(int(np.searchsorted(starts, begin, side='right')) - 1, int(np.searchsorted(starts, end, side='left')))
+            # Keep the row groups the next chunk may share, drop the ones before
+            loaded = {group: loaded[group] if group in loaded else parquet_file.read_row_group(group, columns=list(self.columns), **self.read_kwargs)
+                      for group in groups}
+            table = pa.concat_tables([loaded[group] for group in groups]).slice(begin - starts[groups[0]], end - begin)
+            yield index, table.to_pandas()
+
+    def _shard(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        rank, world_size = 0, 1
+        if self.shard_across_processes and dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        return rank * num_workers + worker_id, world_size * num_workers
+
+    def _chunks(self):
+        """Yield the chunks that belong to this shard, subsampled and with a fresh index."""
+        shard_id, num_shards = self._shard()
+
+        # Every shard shuffles the file order with the same seed, so the assignment agrees
+        data_files = list(self.data_files)
+        if self.shuffle_buffer_size:
+            np.random.default_rng([self.seed, self.epoch]).shuffle(data_files)
+
+        for position, path in enumerate(data_files):
+            if len(data_files) >= num_shards:
+                # Whole files per shard, the others are not opened
+                if position % num_shards != shard_id:
+                    continue
+                owned = None
+            else:
+                owned = lambda chunk_index, position=position: (position + chunk_index) % num_shards == shard_id
+            # Rows are drawn per chunk of a file, so shuffling the file order keeps the same subset
+            file_index = self.data_files.index(path)
+            for file_chunk_index, chunk in self._read_file(path, owned):
+                if self.sample_fraction < 1:
+                    rng = np.random.default_rng([self.sample_seed, file_index, file_chunk_index])
+                    keep = rng.random(len(chunk)) < self.sample_fraction
+                    chunk = chunk[keep]
+                if len(chunk):
+                    yield chunk.reset_index(drop=True)
+
+    def _items(self):
+        for chunk in self._chunks():
+            dataset = self.dataset_class(self.tokenizer, chunk, *self.columns, pretokenize=True, **self.dataset_kwargs)
+            for index in range(len(dataset)):
+                yield dataset[index]
+
+    def __iter__(self):
+        items = self._items()
+        if not self.shuffle_buffer_size:
+            yield from items
+            return
+
+        shard_id, _ = self._shard()
+        rng = np.random.default_rng([self.seed, self.epoch, shard_id])
+        buffer = []
+        for item in items:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(item)
+                continue
+            position = rng.integers(len(buffer))
+            yield buffer[position]
+            buffer[position] = item
+
+        for position in rng.permutation(len(buffer)):
+            yield buffer[position]
+
+
+class T5StreamingRegressionDataset(T5StreamingDataset):
+    dataset_class = T5RegressionDataset
+
+    def __init__(self, tokenizer, data_files, input_column, target_column, source_max_len=512, target_max_len=32, label_default_value=0.0, padding='max_length', **kwargs):
+        dataset_kwargs = dict(source_max_len=source_max_len, target_max_len=target_max_len, label_default_value=label_default_value, padding=padding)
+        super().__init__(tokenizer, data_files, (input_column, target_column), dataset_kwargs, **kwargs)
+
+
+class T5StreamingClassificationDataset(T5StreamingDataset):
+    dataset_class = T5ClassificationDataset
+
+    def __init__(self, tokenizer, data_files, input_column, target_column, source_max_len=512, target_max_len=32, padding='max_length', **kwargs):
+        dataset_kwargs = dict(source_max_len=source_max_len, target_max_len=target_max_len, padding=padding)
+        super().__init__(tokenizer, data_files, (input_column, target_column), dataset_kwargs, **kwargs)
+
+
+class T5StreamingQADataset(T5StreamingDataset):
+    dataset_class = T5QADataset
+
+    def __init__(self, tokenizer, data_files, question_column, context_column, answer_column, source_max_len=512, target_max_len=32, padding='max_length', **kwargs):
+        dataset_kwargs = dict(source_max_len=source_max_len, target_max_len=target_max_len, padding=padding)
+        super().__init__(tokenizer, data_files, (question_column, context_column, answer_column), dataset_kwargs, **kwargs)
+
+
+class T5StreamingTextGenerationDataset(T5StreamingDataset):
+    dataset_class = T5TextGenerationDataset
+
+    def __init__(self, tokenizer, data_files, input_column, target_column, source_max_len=512, target_max_len=128, padding='max_length', **kwargs):
+        dataset_kwargs = dict(source_max_len=source_max_len, target_max_len=target_max_len, padding=padding)
+        super().__init__(tokenizer, data_files, (input_column, target_column), dataset_kwargs, **kwargs)
+
+
+class T5StreamingSummarizationDataset(T5StreamingDataset):
+    dataset_class = T5SummarizationDataset
+
+    def __init__(self, tokenizer, data_files, input_column, target_column, source_max_len=512, target_max_len=150, padding='max_length', **kwargs):
+        dataset_kwargs = dict(source_max_len=source_max_len, target_max_len=target_max_len, padding=padding)
+        super().__init__(tokenizer, data_files, (input_column, target_column), dataset_kwargs, **kwargs)
+
+
+class T5StreamingNERDataset(T5StreamingDataset):
+    dataset_class = T5NERDataset
+
+    def __init__(self, tokenizer, data_files, input_column, target_column, source_max_len=128, target_max_len=128, padding='max_length', **kwargs):
+        dataset_kwargs = dict(source_max_len=source_max_len, target_max_len=target_max_len, padding=padding)
+        super().__init__(tokenizer, data_files, (input_column, target_column), dataset_kwargs, **kwargs)
+
+
+class T5StreamingTranslationDataset(T5StreamingDataset):
+    dataset_class = T5TranslationDataset
+
+    def __init__(self, tokenizer, data_files, source_text_column, target_text_column, source_max_len=512, target_max_len=512, padding='max_length', **kwargs):
+        dataset_kwargs = dict(source_max_len=source_max_len, target_max_len=target_max_len, padding=padding)
+        super().__init__(tokenizer, data_files, (source_text_column, target_text_column), dataset_kwargs, **kwargs)
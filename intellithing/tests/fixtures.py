@@ -0,0 +1,79 @@
+# tests/fixtures.py
+import os
+from unittest import mock
+
+import numpy as np
+import optuna
+import pandas as pd
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+from tokenizers.processors import TemplateProcessing
+from transformers import PreTrainedTokenizerFast
+
+SPECIAL_TOKENS = ["<pad>", "</s>", "<unk>"]
+WORDS = ["summarize:", "ner:", "question:", "context:"] + [f"w{i}" for i in range(100)]
+
+
+def make_tokenizer():
+    """A small T5-like word level tokenizer (pad=0, eos=1) built locally, no downloads."""
+    vocab = {token: i for i, token in enumerate(SPECIAL_TOKENS + WORDS)}
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = Whitespace()
+    tokenizer.post_processor = TemplateProcessing(single="$A </s>", special_tokens=[("</s>", 1)])
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="<pad>", eos_token="</s>", unk_token="<unk>", clean_up_tokenization_spaces=False)
+
+
+def make_frame(n_rows=20, seed=0):
+    """A DataFrame with text columns of varying length, numeric targets and some missing values."""
+    rng = np.random.RandomState(seed)
+
+    def sentence(max_words):
+        return " ".join(f"w{i}" for i in rng.randint(0, 100, size=rng.randint(1, max_words)))
+
+    frame = pd.DataFrame({
+        "text": [sentence(30) for _ in range(n_rows)],
+        "target": [sentence(8) for _ in range(n_rows)],
+        "label": [f"w{i}" for i in rng.randint(0, 3, size=n_rows)],
+        "score": rng.rand(n_rows),
+    })
+    frame.loc[1, "text"] = None
+    frame.loc[2, "target"] = None
+    frame.loc[3, "label"] = None
+    frame.loc[4, "score"] = None
+    frame["score"] = frame["score"].astype(object)
+    frame.loc[5, "score"] = "not a number"
+    return frame
+
+
+def make_tiny_t5(directory):
+    """Save a randomly initialised two-layer T5 model matching `make_tokenizer` to `directory`."""
+    from transformers import T5Config, T5ForConditionalGeneration
+
+    config = T5Config(
+        vocab_size=len(SPECIAL_TOKENS) + len(WORDS),
+        d_model=16,
+        d_kv=8,
+        d_ff=32,
+        num_layers=2,
+        num_heads=2,
+        decoder_start_token_id=0,
+        pad_token_id=0,
+        eos_token_id=1,
+    )
+    T5ForConditionalGeneration(config).save_pretrained(directory)
+    return directory
+
+
+def run_in_directory(test_case, directory):
+    """Make `directory` the working directory until `test_case` ends, tuning trials write to ./results."""
+    cwd = os.getcwd()
+    os.chdir(directory)
+    test_case.addCleanup(os.chdir, cwd)
+
+
+def suggest_lowest_integers(test_case):
+    """Keep tuning trials short until `test_case` ends: every integer hyperparameter takes its lowest value (no warmup, one epoch)."""
+    patcher = mock.patch.object(optuna.Trial, 'suggest_int', lambda trial, name, low, high: trial.suggest_categorical(name, [low]))
+    patcher.start()
+    test_case.addCleanup(patcher.stop)
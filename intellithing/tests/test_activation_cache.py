@@ -0,0 +1,130 @@
+# tests/test_activation_cache.py
+import os
+import tempfile
+import shutil
+import unittest
+from unittest import mock
+
+import torch
+from transformers import TrainingArguments, T5ForConditionalGeneration
+
+from intellithing.activation_cache import CachedPrefixDataset, FrozenPrefixCache, FrozenPrefixTrainer
+from intellithing.batching import T5DataCollator
+from intellithing.layer_freezer import LayerFreezer
+from intellithing.t5customdataset import T5SummarizationDataset
+from intellithing.tests.fixtures import make_frame, make_tiny_t5, make_tokenizer
+
+
+class TestFrozenPrefixCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.cache_dir = os.path.join(self.tmp.name, 'activations')
+        self.tokenizer = make_tokenizer()
+        self.model = T5ForConditionalGeneration.from_pretrained(make_tiny_t5(os.path.join(self.tmp.name, 'model')))
+        self.dataset = T5SummarizationDataset(self.tokenizer, make_frame(12), 'text', 'target', padding=False, pretokenize=True)
+        self.collator = T5DataCollator(self.tokenizer)
+
+    def freeze(self, num_layers):
+        self.model.shared.weight.requires_grad = False
+        LayerFreezer(self.model).freeze_layers(range(num_layers), part='encoder')
+        if num_layers == 2:
+            for param in self.model.encoder.final_layer_norm.parameters():
+                param.requires_grad = False
+
+    def trainer(self, cache, train_dataset, eval_dataset=None):
+        args = TrainingArguments(output_dir=os.path.join(self.tmp.name, 'results'), report_to='none', save_strategy='no',
+                                 per_device_train_batch_size=4, per_device_eval_batch_size=4, num_train_epochs=1)
+        return FrozenPrefixTrainer(model=self.model, args=args, train_dataset=train_dataset, eval_dataset=eval_dataset,
+                                   data_collator=self.collator, prefix_cache=cache)
+
+    def test_detects_the_frozen_prefix(self):
+        with self.assertRaises(ValueError):
+            FrozenPrefixCache(self.model, self.cache_dir)
+        self.freeze(1)
+        self.assertEqual(FrozenPrefixCache(self.model, self.cache_dir).num_layers, 1)
+        with self.assertRaises(ValueError):
+            FrozenPrefixCache(self.model, self.cache_dir, num_layers=2)
+        self.freeze(2)
+        cache = FrozenPrefixCache(self.model, self.cache_dir)
+        self.assertEqual(cache.num_layers, 2)
+        self.assertTrue(cache.covers_encoder)
+
+    def test_cached_forward_matches_the_model(self):
+        batch = self.collator([self.dataset[idx] for idx in range(6)])
+        self.model.eval()
+        with torch.no_grad():
+            expected = self.model(**batch).loss
+
+        for num_layers in (1, 2):
+            self.freeze(num_layers)
+            cache = FrozenPrefixCache(self.model, self.cache_dir)
+            wrapped = cache.wrap(self.dataset)
+            self.assertIsInstance(wrapped, CachedPrefixDataset)
+            item = wrapped[0]
+            self.assertEqual(tuple(item['prefix_hidden_states'].shape), (len(item['input_ids']), self.model.config.d_model))
+
+            cached_batch = self.collator([wrapped[idx] for idx in range(6)])
+            trainer = self.trainer(cache, wrapped)
+            with torch.no_grad():
+                loss = trainer.compute_loss(self.model, cached_batch)
+            self.assertTrue(torch.allclose(loss, expected, atol=1e-5), (num_layers, loss, expected))
+
+    def test_entries_are_reused_and_invalidated(self):
+        self.freeze(1)
+        cache = FrozenPrefixCache(self.model, self.cache_dir)
+        cache.wrap(self.dataset)
+        cache.wrap(self.dataset)
+        self.assertEqual(len(cache.token_cache.entries()), 1)
+
+        # New weights in the prefix
+        with torch.no_grad():
+            self.model.encoder.block[0].layer[0].layer_norm.weight.mul_(2)
+        cache.wrap(self.dataset)
+        self.assertEqual(len(cache.token_cache.entries()), 2)
+
+        # Another freeze configuration
+        self.freeze(2)
+        FrozenPrefixCache(self.model, self.cache_dir).wrap(self.dataset)
+        self.assertEqual(len(cache.token_cache.entries()), 3)
+
+    def test_wrapping_again_does_not_read_the_items(self):
+        self.freeze(1)
+        cache = FrozenPrefixCache(self.model, self.cache_dir)
+        first = cache.wrap(self.dataset)
+        read_items = mock.patch.object(T5SummarizationDataset, '__getitem__', autospec=True, side_effect=T5SummarizationDataset.__getitem__)
+        with read_items as getitem:
+            second = cache.wrap(self.dataset)
+        getitem.assert_not_called()
+        self.assertTrue(torch.equal(second[3]['prefix_hidden_states'], first[3]['prefix_hidden_states']))
+
+        # An evicted entry or new prefix weights are computed from the items again
+        shutil.rmtree(os.path.join(self.cache_dir, cache.token_cache.entries()[0][0]))
+        with read_items as getitem:
+            cache.wrap(self.dataset)
+        self.assertEqual(getitem.call_count, len(self.dataset))
+        with torch.no_grad():
+            self.model.encoder.block[0].layer[0].layer_norm.weight.mul_(2)
+        with read_items as getitem:
+            cache.wrap(self.dataset)
+        self.assertEqual(getitem.call_count, len(self.dataset))
+        self.assertEqual(len(cache.token_cache.entries()), 2)
+
+    def test_trains_the_layers_above_the_prefix(self):
+        self.freeze(1)
+        cache = FrozenPrefixCache(self.model, self.cache_dir)
+        trainer = self.trainer(cache, cache.wrap(self.dataset), cache.wrap(self.dataset))
+        before = {name: param.detach().clone() for name, param in self.model.named_parameters()}
+        trainer.train()
+        self.assertIn('eval_loss', trainer.evaluate())
+        changed = {name for name, param in self.model.named_parameters() if not torch.equal(param, before[name])}
+        self.assertIn('encoder.block.1.layer.0.SelfAttention.q.weight', changed)
+        self.assertFalse(any(name.startswith('encoder.block.0.') or name == 'shared.weight' for name in changed))
+
+        self.model.encoder.block[0].layer[0].SelfAttention.q.weight.requires_grad = True
+        with self.assertRaises(RuntimeError):
+            trainer.train()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+# tests/test_autotrainer.py
+import glob
+import os
+import tempfile
+import unittest
+import warnings
+from unittest import mock
+
+import torch
+
+from intellithing.autotrainer import AutoTrainer
+from intellithing.batching import T5DataCollator
+from intellithing.gradual_unfreezing import GradualUnfreezingCallback
+from intellithing.layer_freezer import LayerFreezer
+from intellithing.t5customdataset import T5SummarizationDataset
+from intellithing.tests.fixtures import make_frame, make_tiny_t5, make_tokenizer, run_in_directory, suggest_lowest_integers
+
+
+class TestAutoTrainer(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        run_in_directory(self, self.tmp.name)
+
+        self.tokenizer = make_tokenizer()
+        self.auto_trainer = AutoTrainer(
+            make_tiny_t5(os.path.join(self.tmp.name, 'model')), self.tokenizer,
+            T5SummarizationDataset(self.tokenizer, make_frame(40), 'text', 'target', padding=False, pretokenize=True),
+            T5SummarizationDataset(self.tokenizer, make_frame(10, seed=1), 'text', 'target', padding=False, pretokenize=True),
+            data_collator=T5DataCollator(self.tokenizer),
+        )
+        suggest_lowest_integers(self)
+
+    def test_continue_from_best_trial_checkpoint(self):
+        with mock.patch('intellithing.autotrainer.torch.load', wraps=torch.load) as load, \
+                mock.patch.object(AutoTrainer, '_build_trainer', wraps=self.auto_trainer._build_trainer) as build:
+            self.auto_trainer.auto_train(n_trials=3, subset_size=0.5, continue_from_best=True)
+        # Trials keep the weights of their last step, which match the saved optimizer state and step
+        self.assertFalse(any(call.args[0].load_best_model_at_end for call in build.call_args_list[:3]))
+
+        checkpoint = self.auto_trainer.best_checkpoint
+        self.assertTrue(os.path.exists(os.path.join(checkpoint, 'optimizer.pt')))
+        load.assert_called_once_with(os.path.join(checkpoint, 'optimizer.pt'))
+        # Only the best trial's directory is kept
+        self.assertEqual(os.listdir(os.path.dirname(os.path.dirname(checkpoint))), [os.path.basename(os.path.dirname(checkpoint))])
+        self.assertTrue(os.path.isdir('finetuned_model'))
+
+    def test_warns_when_the_best_trial_has_no_checkpoint(self):
+        params = {'lr': 1e-3, 'num_train_epochs': 1, 'per_device_train_batch_size': 4, 'gradient_accumulation_steps': 1,
+                  'warmup_steps': 0, 'weight_decay': 0.0, 'adam_epsilon': 1e-8}
+
+        def cache_hit(**kwargs):
+            # A best trial whose result came from the trial cache
+            self.auto_trainer.best_params, self.auto_trainer.best_checkpoint, self.auto_trainer.best_checkpoint_step = params, None, 0
+            return params
+
+        with mock.patch.object(AutoTrainer, 'tune_hyperparameters', side_effect=cache_hit), \
+                mock.patch.object(AutoTrainer, '_reset_model', wraps=self.auto_trainer._reset_model) as reset:
+            with self.assertWarns(UserWarning):
+                self.auto_trainer.auto_train(n_trials=1, continue_from_best=True)
+        reset.assert_called_once()
+
+    def test_trains_from_the_pretrained_model_by_default(self):
+        with mock.patch.object(AutoTrainer, '_reset_model', wraps=self.auto_trainer._reset_model) as reset:
+            self.auto_trainer.auto_train(n_trials=2, subset_size=0.5)
+        # Once per trial and once before the final run
+        self.assertEqual(reset.call_count, 3)
+        self.assertIsNone(self.auto_trainer.best_checkpoint)
+        self.assertEqual(len(glob.glob(os.path.join('results', '*', 'trial_*'))), 1)
+
+
+    def test_picks_the_best_configuration_within_the_budget(self):
+        results = [
+            {'params': {'num_train_epochs': 2, 'lr': 1e-3}, 'eval_loss': 1.0, 'samples_per_second': 10.0, 'train_runtime': 1.0, 'peak_rss_mb': 900.0},
+            {'params': {'num_train_epochs': 1, 'lr': 2e-3}, 'eval_loss': 2.0, 'samples_per_second': 10.0, 'train_runtime': 1.0, 'peak_rss_mb': 500.0},
+            {'params': {'num_train_epochs': 1, 'lr': 3e-3}, 'eval_loss': 3.0, 'samples_per_second': 20.0, 'train_runtime': 1.0, 'peak_rss_mb': 400.0},
+        ]
+        self.auto_trainer.trial_results = results
+        # 100 samples for 2 epochs at 10 samples/s: 20 seconds
+        self.assertIs(self.auto_trainer._select_within_budget(100, 0.5), results[0])
+        self.assertIs(self.auto_trainer._select_within_budget(100, 0.5, max_train_time=15), results[1])
+        self.assertIs(self.auto_trainer._select_within_budget(100, 0.5, max_train_time=15, max_memory_mb=450), results[2])
+        self.assertEqual(results[2]['estimated_train_time'], 5)
+        # Without a dataset length the subset's runtime is extrapolated
+        self.assertIs(self.auto_trainer._select_within_budget(None, 0.5, max_train_time=2), results[0])
+        with self.assertRaises(ValueError):
+            self.auto_trainer._select_within_budget(100, 0.5, max_train_time=1)
+
+    def test_memory_budget_applies_to_cuda_memory_when_recorded(self):
+        results = [
+            # Trained on a GPU: 300 MB of CUDA memory next to 2000 MB of host memory
+            {'params': {'num_train_epochs': 1}, 'eval_loss': 1.0, 'samples_per_second': 10.0, 'train_runtime': 1.0,
+             'peak_rss_mb': 2000.0, 'peak_cuda_mb': 300.0},
+            {'params': {'num_train_epochs': 1}, 'eval_loss': 2.0, 'samples_per_second': 10.0, 'train_runtime': 1.0,
+             'peak_rss_mb': 200.0, 'peak_cuda_mb': 900.0},
+        ]
+        self.auto_trainer.trial_results = results
+        self.assertIs(self.auto_trainer._select_within_budget(100, 0.5, max_memory_mb=500), results[0])
+        with self.assertRaises(ValueError):
+            self.auto_trainer._select_within_budget(100, 0.5, max_memory_mb=250)
+
+    def test_continues_from_the_trial_chosen_within_the_budget(self):
+        def highest_loss(*args, **kwargs):
+            # A budget that rules out every trial but the worst one
+            return max(self.auto_trainer.trial_results, key=lambda result: result['eval_loss'])
+
+        with mock.patch.object(AutoTrainer, '_select_within_budget', side_effect=highest_loss), \
+                mock.patch('intellithing.autotrainer.torch.load', wraps=torch.load) as load, \
+                warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.auto_trainer.auto_train(n_trials=3, subset_size=0.5, continue_from_best=True, max_train_time=3600)
+        self.assertFalse([warning for warning in caught if 'no checkpoint' in str(warning.message)])
+
+        chosen = highest_loss()
+        checkpoint = chosen['checkpoint']
+        load.assert_called_once_with(os.path.join(checkpoint, 'optimizer.pt'))
+        self.assertEqual(self.auto_trainer.best_checkpoint, checkpoint)
+        # The other trials' checkpoints are deleted once the configuration is chosen
+        self.assertEqual(os.listdir(os.path.dirname(os.path.dirname(checkpoint))), [os.path.basename(os.path.dirname(checkpoint))])
+        self.assertEqual([result for result in self.auto_trainer.trial_results if 'checkpoint' in result], [chosen])
+
+    def test_auto_train_within_a_time_budget(self):
+        self.auto_trainer.auto_train(n_trials=2, subset_size=0.5, max_train_time=3600)
+        self.assertIn(self.auto_trainer.best_params, [result['params'] for result in self.auto_trainer.trial_results])
+        with self.assertRaises(ValueError):
+            self.auto_trainer.auto_train(n_trials=1, subset_size=0.5, max_memory_mb=1)
+
+
+    def test_gradual_unfreezing_final_run(self):
+        callback = GradualUnfreezingCallback(initial_layers=1, layers_per_stage=4)
+        self.auto_trainer.auto_train(n_trials=1, subset_size=0.5, gradual_unfreezing=callback)
+        self.assertEqual(callback.stage, 0)
+        # One epoch: only the top decoder layer was trained
+        trainable = {name for name, param in self.auto_trainer.model.named_parameters() if param.requires_grad}
+        self.assertTrue(trainable and all(name.startswith('decoder.block.1.') for name in trainable))
+        with self.assertRaises(ValueError):
+            self.auto_trainer.auto_train(n_trials=1, continue_from_best=True, gradual_unfreezing=True)
+
+    def test_trains_from_cached_prefix_activations(self):
+        model = self.auto_trainer.model
+        model.shared.weight.requires_grad = False
+        LayerFreezer(model).freeze_layers([0], part='encoder')
+        frozen = model.encoder.block[0].layer[0].SelfAttention.q.weight.detach().clone()
+        cache_dir = os.path.join(self.tmp.name, 'activations')
+        self.auto_trainer.auto_train(n_trials=2, subset_size=0.5, continue_from_best=True, activation_cache=cache_dir)
+        self.assertTrue(torch.equal(self.auto_trainer.model.encoder.block[0].layer[0].SelfAttention.q.weight, frozen))
+        # The tuning subset, the full training set and the validation set
+        self.assertEqual(len(os.listdir(cache_dir)), 3)
+        with self.assertRaises(ValueError):
+            self.auto_trainer.auto_train(n_trials=1, activation_cache=cache_dir, gradual_unfreezing=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
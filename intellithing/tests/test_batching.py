@@ -0,0 +1,107 @@
+# tests/test_batching.py
+import unittest
+
+import numpy as np
+import torch
+
+from transformers import T5ForConditionalGeneration
+
+from intellithing.batching import LengthBucketSampler, T5DataCollator, packed_attention_masks
+from intellithing.t5customdataset import T5NERDataset, T5SummarizationDataset, T5TranslationDataset
+from intellithing.tests.fixtures import make_frame, make_tiny_t5, make_tokenizer
+
+
+class TestT5DataCollator(unittest.TestCase):
+    def setUp(self):
+        self.tokenizer = make_tokenizer()
+        self.frame = make_frame()
+
+    def test_pads_to_longest_item(self):
+        dataset = T5NERDataset(self.tokenizer, self.frame, 'text', 'target', padding=False, pretokenize=True)
+        features = [dataset[i] for i in range(4)]
+        batch = T5DataCollator(self.tokenizer)(features)
+
+        longest = max(len(feature['input_ids']) for feature in features)
+        self.assertEqual(tuple(batch['input_ids'].shape), (4, longest))
+        for row, feature in enumerate(features):
+            length = len(feature['input_ids'])
+            self.assertTrue(torch.equal(batch['input_ids'][row, :length], feature['input_ids']))
+            self.assertTrue((batch['input_ids'][row, length:] == self.tokenizer.pad_token_id).all())
+            self.assertEqual(int(batch['attention_mask'][row].sum()), length)
+            labels = batch['labels'][row]
+            self.assertTrue((labels[len(feature['labels']):] == -100).all())
+
+    def test_pad_to_multiple_of_and_decoder_inputs(self):
+        dataset = T5TranslationDataset(self.tokenizer, self.frame, 'text', 'target', padding=False, pretokenize=True)
+        batch = T5DataCollator(self.tokenizer, pad_to_multiple_of=8)([dataset[i] for i in range(3)])
+        self.assertEqual(batch['input_ids'].shape[1] % 8, 0)
+        self.assertEqual(batch['decoder_input_ids'].shape, batch['labels'].shape)
+
+    def test_upcasts_compact_items(self):
+        for padding in ('max_length', False):
+            full = T5TranslationDataset(self.tokenizer, self.frame, 'text', 'target', padding=padding, pretokenize=True)
+            compact = T5TranslationDataset(self.tokenizer, self.frame, 'text', 'target', padding=padding, compact=True)
+            self.assertEqual(compact[0]['input_ids'].dtype, torch.int16)
+            self.assertEqual(compact[0]['attention_mask'].dtype, torch.uint8)
+            self.assertEqual(compact._token_store['input_ids'][0].dtype, np.int16)
+
+            collator = T5DataCollator(self.tokenizer)
+            expected = collator([full[i] for i in range(5)])
+            actual = collator([compact[i] for i in range(5)])
+            for key in expected:
+                self.assertEqual(actual[key].dtype, torch.long, key)
+                self.assertTrue(torch.equal(expected[key], actual[key]), key)
+
+
+class TestLengthBucketSampler(unittest.TestCase):
+    def test_yields_every_index_once_in_similar_length_batches(self):
+        lengths = np.random.RandomState(0).randint(1, 500, size=1000)
+        sampler = LengthBucketSampler(lengths, batch_size=10, bucket_size_multiplier=100)
+        indices = list(sampler)
+        self.assertEqual(sorted(indices), list(range(1000)))
+
+        batches = np.array(indices).reshape(-1, 10)
+        spread = (lengths[batches].max(axis=1) - lengths[batches].min(axis=1)).mean()
+        self.assertLess(spread, 20)
+
+    def test_epochs_change_the_order(self):
+        sampler = LengthBucketSampler(np.arange(100), batch_size=4, bucket_size_multiplier=5, seed=1)
+        first = list(sampler)
+        sampler.set_epoch(1)
+        self.assertNotEqual(first, list(sampler))
+
+
+class TestPacking(unittest.TestCase):
+    def test_packed_loss_matches_unpacked_loss(self):
+        import tempfile
+        tokenizer = make_tokenizer()
+        frame = make_frame(12)
+        with tempfile.TemporaryDirectory() as model_dir:
+            torch.manual_seed(0)
+            model = T5ForConditionalGeneration.from_pretrained(make_tiny_t5(model_dir)).eval()
+
+        packed = T5SummarizationDataset(tokenizer, frame, 'text', 'target', source_max_len=64, target_max_len=16, packing=True, padding=False)
+        unpacked = T5SummarizationDataset(tokenizer, frame, 'text', 'target', source_max_len=64, target_max_len=16, pretokenize=True, padding=False)
+        collator = T5DataCollator(tokenizer)
+
+        with torch.no_grad():
+            batch = collator([packed[i] for i in range(len(packed))])
+            encoder_mask, decoder_mask, cross_mask = packed_attention_masks(batch['segment_ids'], batch['decoder_segment_ids'])
+            encoder_outputs = model.get_encoder()(input_ids=batch['input_ids'], attention_mask=encoder_mask)
+            packed_logits = model(
+                encoder_outputs=encoder_outputs, attention_mask=cross_mask,
+                decoder_input_ids=batch['decoder_input_ids'], decoder_attention_mask=decoder_mask,
+            ).logits
+            packed_tokens = packed_logits[batch['labels'] != -100]
+
+            unpacked_tokens = []
+            for index in range(len(unpacked)):
+                item = collator([unpacked[index]])
+                logits = model(**item).logits
+                unpacked_tokens.append(logits[item['labels'] != -100])
+
+        self.assertTrue(torch.allclose(packed_tokens, torch.cat(unpacked_tokens), atol=1e-5))
+
+
+if __name__ == '__main__':
+    unittest.main()
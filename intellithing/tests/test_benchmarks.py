@@ -0,0 +1,114 @@
+# tests/test_benchmarks.py
+import json
+import os
+import tempfile
+import unittest
+
+from intellithing.benchmarks.dataset_benchmark import compare_results, main, run_benchmarks, synthetic_frame
+from intellithing.benchmarks.activation_cache_benchmark import run_benchmark as run_activation_cache_benchmark
+from intellithing.benchmarks.freeze_memory_benchmark import run_benchmark as run_freeze_memory_benchmark
+from intellithing.benchmarks.padding_benchmark import run_benchmark as run_padding_benchmark
+from intellithing.benchmarks.reset_benchmark import run_benchmark as run_reset_benchmark
+from intellithing.benchmarks.tokenization_scaling_benchmark import run_benchmark as run_tokenization_scaling_benchmark
+from intellithing.benchmarks.unfreezing_benchmark import run_benchmark as run_unfreezing_benchmark
+
+
+class TestDatasetBenchmark(unittest.TestCase):
+    def test_synthetic_frame_follows_the_length_distribution(self):
+        frame = synthetic_frame(500, source_length=40, target_length=10, distribution='constant')
+        self.assertEqual(len(frame), 500)
+        self.assertTrue((frame['text'].str.split().str.len() == 40).all())
+        self.assertTrue((frame['target'].str.split().str.len() == 10).all())
+
+    def test_run_benchmarks_reports_every_metric(self):
+        results = run_benchmarks(['regression', 'summarization'], n_rows=64, dataset_kwargs={'pretokenize': True, 'padding': False},
+                                 batch_size=8, max_batches=2, isolate=False)
+        self.assertEqual([result['dataset'] for result in results], ['regression', 'summarization'])
+        for result in results:
+            self.assertGreater(result['items_per_s'], 0)
+            self.assertGreater(result['peak_rss_mb'], 0)
+            self.assertGreaterEqual(result['padding_waste'], 0)
+            self.assertLess(result['padding_waste'], 1)
+
+    def test_main_writes_and_compares_reports(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'report.json')
+            self.assertEqual(main(['--datasets', 'ner', '--rows', '32', '--max-batches', '1', '--output', output]), 0)
+            with open(output) as file:
+                report = json.load(file)
+            self.assertEqual(report['results'][0]['dataset'], 'ner')
+
+            slower = json.loads(json.dumps(report))
+            slower['results'][0]['items_per_s'] /= 2
+            comparison = {entry['metric']: entry for entry in compare_results(report, slower)}
+            self.assertTrue(comparison['items_per_s']['regression'])
+            self.assertFalse(comparison['peak_rss_mb']['regression'])
+
+
+
+class TestUnfreezingBenchmark(unittest.TestCase):
+    def test_compares_full_and_gradual_fine_tuning(self):
+        results = run_unfreezing_benchmark(n_rows=16, layers=2, d_model=16, pretrain_epochs=1, epochs=2, batch_size=8, vocab_size=100,
+                                           unfreezing_kwargs={'initial_layers': 1, 'layers_per_stage': 2})
+        self.assertEqual([result['mode'] for result in results], ['full', 'gradual'])
+        for result in results:
+            self.assertGreater(result['train_s'], 0)
+            self.assertGreater(result['eval_loss'], 0)
+
+
+class TestActivationCacheBenchmark(unittest.TestCase):
+    def test_compares_plain_and_cached_training(self):
+        results = run_activation_cache_benchmark(n_rows=16, layers=2, frozen_layers=1, d_model=16, source_length=8, target_length=4,
+                                                 epochs=1, batch_size=8, vocab_size=100)
+        self.assertEqual([result['mode'] for result in results], ['plain', 'cached'])
+        self.assertGreater(results[1]['cache_s'], 0)
+        for result in results:
+            self.assertGreater(result['train_s'], 0)
+
+
+class TestFreezeMemoryBenchmark(unittest.TestCase):
+    def test_reports_every_configuration(self):
+        results = run_freeze_memory_benchmark(['none', 'encoder'], dtypes=(None, 'bfloat16'), n_rows=16, layers=2, d_model=16,
+                                              vocab_size=100, steps=1, batch_size=8, isolate=False)
+        self.assertEqual([(result['configuration'], result['frozen_dtype']) for result in results],
+                         [('none', 'float32'), ('encoder', 'float32'), ('encoder', 'bfloat16')])
+        self.assertEqual(results[0]['frozen_mb'], 0)
+        self.assertEqual(results[0]['rss_saved_mb'], 0)
+        self.assertLess(results[1]['optimizer_state_mb'], results[0]['optimizer_state_mb'])
+        self.assertAlmostEqual(results[2]['frozen_mb'], results[1]['frozen_mb'] / 2)
+
+
+class TestTokenizationScalingBenchmark(unittest.TestCase):
+    def test_reports_the_speedup_of_worker_processes(self):
+        # Only worker processes: the test process has used the tokenizer's thread pool, which forked children cannot restart
+        results = run_tokenization_scaling_benchmark(n_rows=32, workers=(1, 2), modes=('processes',), source_length=8,
+                                                     tokenize_batch_size=8, vocab_size=100)
+        self.assertEqual([(result['mode'], result['workers']) for result in results], [('processes', 1), ('processes', 2)])
+        self.assertEqual(results[0]['speedup'], 1.0)
+        for result in results:
+            self.assertGreater(result['construction_s'], 0)
+
+
+class TestPaddingBenchmark(unittest.TestCase):
+    def test_dynamic_padding_trains_fewer_padded_positions(self):
+        results = run_padding_benchmark(n_rows=32, layers=1, d_model=16, source_length=8, target_length=4, source_max_len=32,
+                                        target_max_len=16, batch_size=8, vocab_size=100)
+        self.assertEqual([result['mode'] for result in results], ['max_length', 'dynamic', 'bucketed'])
+        self.assertEqual(len({result['mean_source_tokens'] for result in results}), 1)
+        self.assertGreater(results[0]['padding_waste'], results[1]['padding_waste'])
+        self.assertGreaterEqual(results[1]['padding_waste'], results[2]['padding_waste'])
+        for result in results:
+            self.assertGreater(result['source_tokens_per_s'], 0)
+
+
+class TestResetBenchmark(unittest.TestCase):
+    def test_times_reset_and_reload(self):
+        results = run_reset_benchmark(d_model=16, layers=1, num_heads=2, vocab_size=100, repeats=2)
+        self.assertEqual([result['method'] for result in results], ['reset_model', 'load_model'])
+        for result in results:
+            self.assertGreater(result['mean_ms'], 0)
+            self.assertGreater(result['parameters'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
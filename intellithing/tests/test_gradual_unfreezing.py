@@ -0,0 +1,69 @@
+# tests/test_gradual_unfreezing.py
+import os
+import tempfile
+import unittest
+
+from transformers import Trainer, TrainerCallback, TrainingArguments, T5ForConditionalGeneration
+
+from intellithing.batching import T5DataCollator
+from intellithing.gradual_unfreezing import GradualUnfreezingCallback
+from intellithing.t5customdataset import T5SummarizationDataset
+from intellithing.tests.fixtures import make_frame, make_tiny_t5, make_tokenizer
+
+
+class RecordStages(TrainerCallback):
+    def __init__(self, unfreezing):
+        self.unfreezing = unfreezing
+        self.stages = []
+
+    def on_epoch_begin(self, args, state, control, model=None, optimizer=None, **kwargs):
+        optimized = {id(param) for group in optimizer.param_groups for param in group['params']}
+        trainable = {id(param) for param in model.parameters() if param.requires_grad}
+        self.stages.append((self.unfreezing.stage, trainable == optimized, sorted({group['lr'] for group in optimizer.param_groups})))
+
+
+class TestGradualUnfreezingCallback(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.tokenizer = make_tokenizer()
+        self.model = T5ForConditionalGeneration.from_pretrained(make_tiny_t5(os.path.join(self.tmp.name, 'model')))
+        self.dataset = T5SummarizationDataset(self.tokenizer, make_frame(16), 'text', 'target', padding=False, pretokenize=True)
+
+    def trainer(self, callback, **kwargs):
+        args = TrainingArguments(output_dir=os.path.join(self.tmp.name, 'results'), report_to='none', save_strategy='no',
+                                 per_device_train_batch_size=8, learning_rate=1e-3, **kwargs)
+        recorder = RecordStages(callback)
+        trainer = Trainer(model=self.model, args=args, train_dataset=self.dataset, data_collator=T5DataCollator(self.tokenizer),
+                          callbacks=[callback, recorder])
+        return trainer, recorder
+
+    def test_starts_with_the_top_layer_and_unfreezes_downwards(self):
+        callback = GradualUnfreezingCallback(initial_layers=1, layers_per_stage=1)
+        trainer, recorder = self.trainer(callback, num_train_epochs=5)
+        self.assertEqual(callback.schedule, [('decoder.block', 1), ('decoder.block', 0), ('encoder.block', 1), ('encoder.block', 0)])
+        trainable = {name for name, param in self.model.named_parameters() if param.requires_grad}
+        self.assertTrue(trainable)
+        self.assertTrue(all(name.startswith('decoder.block.1.') for name in trainable))
+        # The Trainer's optimizer only holds the top layer
+        trainer.create_optimizer()
+        self.assertEqual(sum(len(group['params']) for group in trainer.optimizer.param_groups), len(trainable))
+
+        trainer.train()
+        self.assertEqual([stage for stage, _, _ in recorder.stages], [0, 1, 2, 3, 3])
+        self.assertTrue(all(in_sync for _, in_sync, _ in recorder.stages))
+        self.assertTrue(all(param.requires_grad for param in self.model.parameters()))
+
+    def test_step_schedule_with_learning_rate_decay(self):
+        callback = GradualUnfreezingCallback(initial_layers=2, layers_per_stage=2, every_n_steps=2, lr_decay=0.5)
+        trainer, recorder = self.trainer(callback, max_steps=6, lr_scheduler_type='constant')
+        trainer.train()
+        self.assertEqual(callback.stage, 1)
+        # Depths 0 to 3 of the schedule, and the embeddings and final norms at the top rate
+        self.assertEqual(sorted({group['lr'] for group in trainer.optimizer.param_groups}), [1.25e-4, 2.5e-4, 5e-4, 1e-3])
+        self.assertEqual(recorder.stages[0][2], [5e-4, 1e-3])
+        self.assertTrue(all(param.requires_grad for param in self.model.parameters()))
+
+
+if __name__ == '__main__':
+    unittest.main()
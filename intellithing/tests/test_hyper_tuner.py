@@ -0,0 +1,344 @@
+# tests/test_hyper_tuner.py
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import optuna
+import torch
+
+from transformers import TrainingArguments
+
+from intellithing.batching import LengthBucketTrainer, PackedSeq2SeqTrainer, T5DataCollator
+from intellithing.hyper_tuner import HyperparameterTuner
+from intellithing.layer_freezer import LayerFreezer
+from intellithing.t5customdataset import T5SummarizationDataset
+from intellithing.tuner_callbacks import ResourceUsageCallback
+from intellithing.tests.fixtures import make_frame, make_tiny_t5, make_tokenizer, run_in_directory, suggest_lowest_integers
+
+
+class TestHyperparameterTuner(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        run_in_directory(self, self.tmp.name)
+        suggest_lowest_integers(self)
+        self.model_dir = make_tiny_t5(os.path.join(self.tmp.name, 'model'))
+        self.tokenizer = make_tokenizer()
+        self.train_dataset = T5SummarizationDataset(self.tokenizer, make_frame(40), 'text', 'target', padding=False, pretokenize=True)
+        self.val_dataset = T5SummarizationDataset(self.tokenizer, make_frame(10, seed=1), 'text', 'target', padding=False, pretokenize=True)
+
+    def training_args(self, **kwargs):
+        return TrainingArguments(output_dir=os.path.join(self.tmp.name, 'results'), report_to='none', **kwargs)
+
+    def test_dynamic_padding_with_length_buckets(self):
+        tuner = HyperparameterTuner(
+            self.model_dir, self.tokenizer, self.train_dataset, self.val_dataset,
+            data_collator=T5DataCollator(self.tokenizer), length_bucketing=True,
+        )
+        trainer = tuner._build_trainer(self.training_args(max_steps=3, per_device_train_batch_size=4), tuner.train_dataset, tuner.val_dataset)
+        self.assertIsInstance(trainer, LengthBucketTrainer)
+
+        batch = next(iter(trainer.get_train_dataloader()))
+        lengths = batch['attention_mask'].sum(dim=1)
+        self.assertEqual(batch['input_ids'].shape[1], int(lengths.max()))
+        self.assertLess(batch['input_ids'].shape[1], self.train_dataset.source_max_len)
+
+        trainer.train()
+        self.assertIn('eval_loss', trainer.evaluate())
+
+    def test_packed_datasets_train_with_segment_masks(self):
+        train_dataset = T5SummarizationDataset(self.tokenizer, make_frame(40), 'text', 'target', source_max_len=64, target_max_len=16, packing=True)
+        val_dataset = T5SummarizationDataset(self.tokenizer, make_frame(10, seed=1), 'text', 'target', source_max_len=64, target_max_len=16, packing=True)
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, train_dataset, val_dataset)
+        trainer = tuner._build_trainer(self.training_args(max_steps=3, per_device_train_batch_size=4), tuner.train_dataset, tuner.val_dataset)
+        self.assertIsInstance(trainer, PackedSeq2SeqTrainer)
+
+        batch = next(iter(trainer.get_train_dataloader()))
+        self.assertIn('segment_ids', batch)
+        trainer.train()
+        self.assertIn('eval_loss', trainer.evaluate())
+
+    def test_compact_datasets_default_to_the_upcasting_collator(self):
+        train_dataset = T5SummarizationDataset(self.tokenizer, make_frame(40), 'text', 'target', source_max_len=32, target_max_len=8, compact=True)
+        val_dataset = T5SummarizationDataset(self.tokenizer, make_frame(10, seed=1), 'text', 'target', source_max_len=32, target_max_len=8, compact=True)
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, train_dataset, val_dataset)
+        self.assertIsInstance(tuner.data_collator, T5DataCollator)
+
+        trainer = tuner._build_trainer(self.training_args(max_steps=2, per_device_train_batch_size=4), tuner.train_dataset, tuner.val_dataset)
+        batch = next(iter(trainer.get_train_dataloader()))
+        self.assertEqual(batch['input_ids'].dtype, torch.long)
+        trainer.train()
+        self.assertIn('eval_loss', trainer.evaluate())
+
+    def test_parallel_tuning_shares_one_study(self):
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, self.train_dataset, self.val_dataset, data_collator=T5DataCollator(self.tokenizer))
+        storage = f"sqlite:///{os.path.join(self.tmp.name, 'study.db')}"
+        best_params = tuner.tune_hyperparameters(n_trials=3, subset_size=0.5, n_jobs=2, storage=storage, study_name='parallel')
+
+        study = optuna.load_study(study_name='parallel', storage=storage)
+        self.assertEqual(len(study.trials), 3)
+        self.assertTrue(all(trial.state == optuna.trial.TrialState.COMPLETE for trial in study.trials))
+        self.assertEqual(best_params, study.best_params)
+
+    def test_multi_fidelity_tuning_promotes_trials_to_larger_slices(self):
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, self.train_dataset, self.val_dataset, data_collator=T5DataCollator(self.tokenizer))
+        storage = f"sqlite:///{os.path.join(self.tmp.name, 'study.db')}"
+        best_params = tuner.tune_hyperparameters(n_trials=6, subset_size=0.5, storage=storage, study_name='asha',
+                                                 multi_fidelity=True, min_fraction=1 / 3, reduction_factor=3)
+
+        study = optuna.load_study(study_name='asha', storage=storage)
+        completed = [trial for trial in study.trials if trial.state == optuna.trial.TrialState.COMPLETE]
+        pruned = [trial for trial in study.trials if trial.state == optuna.trial.TrialState.PRUNED]
+        self.assertTrue(completed)
+        self.assertEqual(len(completed) + len(pruned), 6)
+        self.assertEqual(best_params, study.best_params)
+        for trial in completed:
+            self.assertEqual(sorted(trial.intermediate_values), [1, 3])
+            # A third of the 20 tuning rows, then all of them, for one epoch each
+            self.assertEqual(trial.user_attrs['samples_seen'], 7 + 20)
+        for trial in pruned:
+            self.assertEqual(sorted(trial.intermediate_values), [1])
+            self.assertEqual(trial.user_attrs['samples_seen'], 7)
+        self.assertEqual(tuner.tuning_cost['samples_seen'], 27 * len(completed) + 7 * len(pruned))
+        self.assertEqual(HyperparameterTuner._fidelity_schedule(0.1, 3), [1 / 9, 1 / 3, 1.0])
+
+    def test_persistent_studies_resume_and_warm_start(self):
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, self.train_dataset, self.val_dataset, data_collator=T5DataCollator(self.tokenizer))
+        storage = f"sqlite:///{os.path.join(self.tmp.name, 'studies.db')}"
+        tuner.tune_hyperparameters(n_trials=2, subset_size=0.5, storage=storage, persistent=True)
+        study_name = optuna.get_all_study_summaries(storage)[0].study_name
+        # A trial interrupted by a crash
+        interrupted = optuna.load_study(study_name=study_name, storage=storage).ask({'lr': optuna.distributions.FloatDistribution(1e-5, 5e-5, log=True)})
+
+        tuner.tune_hyperparameters(n_trials=3, subset_size=0.5, storage=storage, persistent=True)
+        study = optuna.load_study(study_name=study_name, storage=storage)
+        states = [trial.state for trial in study.trials]
+        self.assertEqual(states.count(optuna.trial.TrialState.COMPLETE), 3)
+        self.assertEqual(study.trials[interrupted.number].state, optuna.trial.TrialState.FAIL)
+        self.assertEqual(study.trials[-1].params['lr'], interrupted.params['lr'])
+
+        tuner.train_dataset = T5SummarizationDataset(self.tokenizer, make_frame(40, seed=2), 'text', 'target', padding=False, pretokenize=True)
+        tuner.tune_hyperparameters(n_trials=1, subset_size=0.5, storage=storage, persistent=True)
+
+        refreshed = [summary for summary in optuna.get_all_study_summaries(storage) if summary.study_name != study_name]
+        self.assertEqual(len(refreshed), 1)
+        warm_trials = optuna.load_study(study_name=refreshed[0].study_name, storage=storage).trials
+        self.assertEqual(warm_trials[0].user_attrs['warm_start_from'], study_name)
+        self.assertEqual(warm_trials[0].params, study.best_params)
+
+        # A study is only resumed with the objectives and tuning subset it was created with
+        with self.assertRaises(ValueError):
+            tuner.tune_hyperparameters(n_trials=1, subset_size=0.5, storage=storage, persistent=True, study_name=study_name,
+                                       cost_objectives=('train_runtime',))
+        with self.assertRaises(ValueError):
+            tuner.tune_hyperparameters(n_trials=1, subset_size=0.25, storage=storage, persistent=True, study_name=study_name)
+
+    def test_warm_start_only_from_studies_of_the_same_task_and_setup(self):
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, self.train_dataset, self.val_dataset, data_collator=T5DataCollator(self.tokenizer))
+        storage = f"sqlite:///{os.path.join(self.tmp.name, 'studies.db')}"
+        tuner.tune_hyperparameters(n_trials=1, subset_size=0.5, storage=storage, persistent=True)
+
+        def warm_started(**kwargs):
+            # A data refresh, tuned with another task or setup
+            tuner.train_dataset = T5SummarizationDataset(self.tokenizer, make_frame(40, seed=len(optuna.get_all_study_summaries(storage)) + 2),
+                                                         'text', 'target', padding=False, pretokenize=True)
+            names = {summary.study_name for summary in optuna.get_all_study_summaries(storage)}
+            tuner.tune_hyperparameters(n_trials=1, storage=storage, persistent=True, **kwargs)
+            new_name, = {summary.study_name for summary in optuna.get_all_study_summaries(storage)} - names
+            return 'warm_start_from' in optuna.load_study(study_name=new_name, storage=storage).trials[0].user_attrs
+
+        self.assertFalse(warm_started(subset_size=0.25))
+        tuner.length_bucketing = True
+        self.assertFalse(warm_started(subset_size=0.5))
+        tuner.length_bucketing = False
+        self.assertTrue(warm_started(subset_size=0.5))
+
+    def test_studies_in_the_same_directory_keep_their_own_checkpoints(self):
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, self.train_dataset, self.val_dataset, data_collator=T5DataCollator(self.tokenizer))
+        tuner.tune_hyperparameters(n_trials=2, subset_size=0.5, keep_best_checkpoint=True)
+        first = tuner.best_checkpoint
+        tuner.tune_hyperparameters(n_trials=2, subset_size=0.5, keep_best_checkpoint=True)
+        second = tuner.best_checkpoint
+
+        # Both studies start at trial 0, their directories still differ and neither cleanup removes the other's
+        self.assertNotEqual(os.path.dirname(os.path.dirname(first)), os.path.dirname(os.path.dirname(second)))
+        self.assertTrue(os.path.isdir(first) and os.path.isdir(second))
+
+    def test_multi_objective_tuning_returns_the_pareto_front(self):
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, self.train_dataset, self.val_dataset, data_collator=T5DataCollator(self.tokenizer))
+        best_params = tuner.tune_hyperparameters(n_trials=3, subset_size=0.5, cost_objectives=('train_runtime', 'peak_rss_mb'))
+
+        self.assertEqual(len(tuner.trial_results), 3)
+        for result in tuner.trial_results:
+            self.assertGreater(result['train_runtime'], 0)
+            self.assertGreater(result['samples_per_second'], 0)
+            self.assertGreater(result['peak_rss_mb'], 0)
+        front = tuner.pareto_front
+        self.assertTrue(front)
+        # No configuration on the front is dominated by another completed trial
+        costs = lambda result: (result['eval_loss'], result['train_runtime'], result['peak_rss_mb'])
+        for result in front:
+            self.assertFalse(any(all(a <= b for a, b in zip(costs(other), costs(result))) and costs(other) != costs(result)
+                                 for other in tuner.trial_results))
+        self.assertEqual(best_params, min(front, key=lambda result: result['eval_loss'])['params'])
+
+        with self.assertRaises(ValueError):
+            tuner.tune_hyperparameters(n_trials=1, cost_objectives=('train_runtime',), multi_fidelity=True)
+        with self.assertRaises(ValueError):
+            tuner.tune_hyperparameters(n_trials=1, cost_objectives=('disk',))
+        with mock.patch('torch.cuda.is_available', return_value=False), self.assertRaises(ValueError):
+            tuner.tune_hyperparameters(n_trials=1, cost_objectives=('peak_cuda_mb',))
+
+    def test_tuning_subset_is_a_lazy_view(self):
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, self.train_dataset, self.val_dataset, data_collator=T5DataCollator(self.tokenizer))
+        with mock.patch.object(HyperparameterTuner, 'objective', return_value=1.0), \
+                mock.patch.object(T5SummarizationDataset, '__getitem__', side_effect=AssertionError("item materialized")):
+            tuner.tune_hyperparameters(n_trials=1, subset_size=0.25, seed=3)
+        self.assertIs(tuner.train_dataset, self.train_dataset)
+        self.assertIsInstance(tuner.tuning_dataset, torch.utils.data.Subset)
+        self.assertEqual(len(tuner.tuning_dataset), 10)
+        self.assertEqual(tuner.tuning_dataset.indices, HyperparameterTuner._subset_indices(40, 0.25, seed=3).tolist())
+
+    def test_stratified_subset_indices(self):
+        labels = ['a'] * 60 + ['b'] * 30 + ['c'] * 9 + ['d']
+        indices = HyperparameterTuner._subset_indices(100, 0.2, labels=labels, seed=0)
+        self.assertEqual(len(indices), 20)
+        self.assertEqual(len(set(indices.tolist())), 20)
+        chosen = [labels[index] for index in indices]
+        # Proportional shares, and the rare label is kept
+        self.assertEqual([chosen.count(label) for label in 'abcd'], [12, 6, 1, 1])
+        self.assertTrue((HyperparameterTuner._subset_indices(100, 0.2, labels=labels, seed=0) == indices).all())
+        self.assertFalse((HyperparameterTuner._subset_indices(100, 0.2, labels=labels, seed=1) == indices).all())
+
+        frame_labels = HyperparameterTuner._stratify_labels(self.train_dataset, 'target')
+        self.assertEqual(len(frame_labels), len(self.train_dataset))
+        with self.assertRaises(ValueError):
+            HyperparameterTuner._stratify_labels(self.train_dataset, 'no_such_column')
+        with self.assertRaises(ValueError):
+            HyperparameterTuner._stratify_labels(self.train_dataset, labels)
+
+    def test_batch_size_probe_sets_the_search_space(self):
+        class BatchSizeMemory(ResourceUsageCallback):
+            # 100 MB per example, independent of the machine
+            def on_train_end(self, args, state, control, **kwargs):
+                super().on_train_end(args, state, control, **kwargs)
+                self.peak_rss_mb = 100.0 * args.per_device_train_batch_size
+
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, self.train_dataset, self.val_dataset, data_collator=T5DataCollator(self.tokenizer))
+        with mock.patch('intellithing.hyper_tuner.ResourceUsageCallback', BatchSizeMemory):
+            best_params = tuner.tune_hyperparameters(n_trials=2, subset_size=0.5,
+                                                     batch_size_probe={'max_memory_mb': 1000, 'slowdown': 0.0, 'steps': 2})
+
+        probe = tuner.batch_size_probe
+        self.assertEqual([result['batch_size'] for result in probe['results']], [1, 2, 4, 8, 16])
+        self.assertEqual(probe['results'][-1]['stopped'], 'memory budget')
+        self.assertEqual(probe['max_batch_size'], 8)
+        self.assertEqual(tuner.search_space, {'per_device_train_batch_size': [1, 2, 4, 8], 'effective_batch_size': [8, 16, 32]})
+        self.assertIn(best_params['per_device_train_batch_size'], [1, 2, 4, 8])
+        self.assertEqual(best_params['per_device_train_batch_size'] * best_params['gradient_accumulation_steps'], best_params['effective_batch_size'])
+
+    def test_arguments_are_checked_before_probing_or_storing_a_study(self):
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, self.train_dataset, self.val_dataset, data_collator=T5DataCollator(self.tokenizer))
+        storage = f"sqlite:///{os.path.join(self.tmp.name, 'studies.db')}"
+        with mock.patch.object(HyperparameterTuner, 'probe_batch_sizes') as probe:
+            for kwargs in ({'subset_size': 0}, {'subset_size': 1.5}, {'stratify': 'no_such_column'}, {'cost_objectives': ('disk',)}):
+                with self.subTest(**kwargs), self.assertRaises(ValueError):
+                    tuner.tune_hyperparameters(n_trials=1, storage=storage, persistent=True, batch_size_probe=True, **kwargs)
+        probe.assert_not_called()
+        self.assertEqual(optuna.get_all_study_summaries(storage), [])
+
+    def test_probed_trials_train_their_effective_batch_size(self):
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, self.train_dataset, self.val_dataset)
+        tuner.search_space = {'per_device_train_batch_size': [1, 2, 4, 8, 16, 64], 'effective_batch_size': [8, 16, 24, 32]}
+        study = optuna.create_study(sampler=optuna.samplers.RandomSampler(seed=0))
+        study.optimize(lambda trial: len(tuner._suggest_params(trial)), n_trials=60)
+
+        # Every trial trains: 64 divides no effective size and the others only reach their multiples
+        self.assertEqual(len(study.get_trials(states=(optuna.trial.TrialState.COMPLETE,))), 60)
+        pairs = set()
+        for trial in study.trials:
+            params = tuner._trial_params(trial)
+            self.assertEqual(params['per_device_train_batch_size'] * params['gradient_accumulation_steps'], params['effective_batch_size'])
+            self.assertIn(params['effective_batch_size'], tuner.search_space['effective_batch_size'])
+            self.assertTrue(tuner._in_search_space(params))
+            self.assertEqual(tuner._suggested_params(params), trial.params)
+            pairs.add((params['per_device_train_batch_size'], params['effective_batch_size']))
+        self.assertIn((16, 32), pairs)
+        self.assertIn((8, 24), pairs)
+        self.assertNotIn(64, [batch_size for batch_size, _ in pairs])
+
+    def test_reset_model_restores_weights_and_frozen_layers(self):
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, self.train_dataset, self.val_dataset)
+        LayerFreezer(tuner.model, 't5').freeze_layers([0])
+        tuner._initial_requires_grad = {name: param.requires_grad for name, param in tuner.model.named_parameters()}
+
+        with torch.no_grad():
+            for param in tuner.model.parameters():
+                param.add_(1.0)
+        LayerFreezer(tuner.model, 't5').freeze_all()
+        tuner.model.shared.weight.grad = torch.ones_like(tuner.model.shared.weight)
+        tuner._reset_model()
+
+        pretrained = tuner._load_model().state_dict()
+        for name, tensor in tuner.model.state_dict().items():
+            self.assertTrue(torch.equal(tensor, pretrained[name]), name)
+        self.assertTrue(tuner.model.shared.weight.requires_grad)
+        self.assertFalse(any(param.requires_grad for name, param in tuner.model.named_parameters() if 'encoder.block.0.' in name))
+        self.assertTrue(tuner.model.decoder.block[0].layer[0].SelfAttention.q.weight.requires_grad)
+        self.assertIsNone(tuner.model.shared.weight.grad)
+
+    def test_snapshot_keeps_views_of_the_same_address_apart(self):
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, self.train_dataset, self.val_dataset)
+        weight = tuner.model.lm_head.weight
+        # A buffer starting at the same address as the weight, with another shape
+        tuner.model.register_buffer('weight_row', weight.detach()[0])
+        tuner._initial_state = tuner._snapshot_model(tuner.model)
+        self.assertIs(tuner._initial_state['lm_head.weight'], tuner._initial_state['shared.weight'])
+        self.assertEqual(tuner._initial_state['weight_row'].shape, weight[0].shape)
+
+        with torch.no_grad():
+            weight.add_(1.0)
+        tuner._reset_model()
+        self.assertTrue(torch.equal(weight, tuner._initial_state['lm_head.weight']))
+        self.assertTrue(torch.equal(tuner.model.weight_row, tuner._initial_state['lm_head.weight'][0]))
+
+    def test_trials_release_the_optimizer_of_frozen_and_finished_runs(self):
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, self.train_dataset, self.val_dataset,
+                                    data_collator=T5DataCollator(self.tokenizer))
+        LayerFreezer(tuner.model, 't5').freeze_layers([0, 1], part='encoder', dtype=torch.bfloat16)
+        tuner._initial_requires_grad = {name: param.requires_grad for name, param in tuner.model.named_parameters()}
+        trainer = tuner._build_trainer(self.training_args(max_steps=2, per_device_train_batch_size=4), tuner.train_dataset, tuner.val_dataset)
+        trainer.create_optimizer()
+        optimized = {id(param) for group in trainer.optimizer.param_groups for param in group['params']}
+        self.assertEqual(optimized, {id(param) for param in tuner.model.parameters() if param.requires_grad})
+
+        trainer.train()
+        self.assertTrue(all(param.grad is None for param in tuner.model.encoder.block.parameters()))
+        self.assertEqual(len(trainer.optimizer.state), len(optimized))
+        tuner._release_optimizer(trainer)
+        self.assertIsNone(trainer.optimizer)
+        self.assertTrue(all(param.grad is None for param in tuner.model.parameters()))
+        self.assertIn('eval_loss', trainer.evaluate())
+
+    def test_reduced_precision_layers_are_snapshot_in_their_dtype(self):
+        tuner = HyperparameterTuner(self.model_dir, self.tokenizer, self.train_dataset, self.val_dataset,
+                                    data_collator=T5DataCollator(self.tokenizer))
+        LayerFreezer(tuner.model, 't5').freeze_layers([0], part='encoder', dtype=torch.bfloat16)
+        tuner.tune_hyperparameters(n_trials=1, subset_size=0.5)
+        name = 'encoder.block.0.layer.0.SelfAttention.q.weight'
+        self.assertEqual(tuner._initial_state[name].dtype, torch.bfloat16)
+        self.assertEqual(tuner._initial_state['encoder.block.1.layer.0.SelfAttention.q.weight'].dtype, torch.float32)
+        tuner._reset_model()
+        self.assertTrue(torch.equal(tuner.model.state_dict()[name], tuner._initial_state[name]))
+
+    def test_worker_cpus_do_not_overlap(self):
+        with mock.patch('os.sched_getaffinity', return_value=set(range(10)), create=True):
+            groups = HyperparameterTuner._worker_cpus(3)
+            self.assertEqual([len(group) for group in groups], [4, 3, 3])
+            self.assertEqual(sorted(sum(groups, [])), list(range(10)))
+            self.assertEqual(HyperparameterTuner._worker_cpus(12)[10:], [[0], [1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# tests/test_layer_freezer.py
+import unittest
+
+import torch
+from transformers import BertConfig, BertForSequenceClassification, GPT2Config, GPT2LMHeadModel, T5Config, T5ForConditionalGeneration
+
+from intellithing.layer_freezer import LayerFreezer
+
+
+def tiny_t5(num_layers=12):
+    return T5ForConditionalGeneration(T5Config(vocab_size=32, d_model=8, d_kv=4, d_ff=16, num_layers=num_layers, num_heads=2))
+
+
+class TestLayerFreezer(unittest.TestCase):
+    def test_finds_the_layer_stacks_from_the_module_tree(self):
+        self.assertEqual(LayerFreezer(tiny_t5(2), 't5').parts, {
+            'encoder': 'encoder.block', 'encoder.block': 'encoder.block',
+            'decoder': 'decoder.block', 'decoder.block': 'decoder.block',
+        })
+        gpt2 = LayerFreezer(GPT2LMHeadModel(GPT2Config(vocab_size=32, n_embd=8, n_layer=3, n_head=2)))
+        self.assertEqual(gpt2.parts['encoder'], 'transformer.h')
+        self.assertEqual(gpt2.num_layers(), 3)
+        bert = LayerFreezer(BertForSequenceClassification(BertConfig(vocab_size=32, hidden_size=8, num_hidden_layers=2, num_attention_heads=2, intermediate_size=16)))
+        self.assertEqual(bert.parts['encoder'], 'bert.encoder.layer')
+        with self.assertRaises(ValueError):
+            bert.freeze_layers([0], part='decoder')
+
+    def test_layer_indices_match_exactly(self):
+        model = tiny_t5()
+        freezer = LayerFreezer(model, 't5')
+        freezer.freeze_layers([1], part='all')
+        frozen = {name for name, param in model.named_parameters() if not param.requires_grad}
+        self.assertTrue(frozen)
+        # encoder.block.1 must not match encoder.block.10 and .11
+        self.assertTrue(all(name.startswith(('encoder.block.1.', 'decoder.block.1.')) for name in frozen))
+        self.assertTrue(any(name.startswith('decoder.block.1.') for name in frozen))
+
+        freezer.unfreeze_layers([1], part='decoder')
+        self.assertTrue(all(param.requires_grad for name, param in model.named_parameters() if name.startswith('decoder.')))
+        with self.assertRaises(ValueError):
+            freezer.freeze_layers([12])
+
+    def test_parameter_report(self):
+        model = tiny_t5(2)
+        freezer = LayerFreezer(model, 't5')
+        freezer.freeze_layers([0])
+        report = {entry['layer']: entry for entry in freezer.parameter_report()}
+
+        self.assertEqual(list(report), ['encoder.block.0', 'encoder.block.1', 'decoder.block.0', 'decoder.block.1', 'other', 'total'])
+        self.assertEqual(report['encoder.block.0']['trainable_params'], 0)
+        self.assertEqual(report['encoder.block.0']['frozen_params'], sum(param.numel() for param in model.encoder.block[0].parameters()))
+        self.assertEqual(report['encoder.block.0']['frozen_bytes'], 4 * report['encoder.block.0']['frozen_params'])
+        total = report['total']
+        self.assertEqual(total['trainable_params'] + total['frozen_params'], sum(param.numel() for param in model.parameters()))
+        self.assertEqual(sum(entry['frozen_params'] for name, entry in report.items() if name != 'total'), total['frozen_params'])
+        self.assertEqual(sum(entry['trainable_bytes'] for name, entry in report.items() if name != 'total'), total['trainable_bytes'])
+
+    def test_freezing_releases_gradients(self):
+        model = tiny_t5(2)
+        freezer = LayerFreezer(model, 't5')
+        for param in model.parameters():
+            param.grad = torch.ones_like(param)
+        freezer.freeze_layers([0])
+        self.assertTrue(all(param.grad is None for param in model.encoder.block[0].parameters()))
+        self.assertTrue(all(param.grad is not None for param in model.encoder.block[1].parameters()))
+        freezer.freeze_all()
+        self.assertTrue(all(param.grad is None for param in model.parameters()))
+
+    def test_frozen_layers_in_reduced_precision(self):
+        model = tiny_t5(2)
+        model.config.decoder_start_token_id = 0
+        model.eval()
+        input_ids = torch.tensor([[3, 4, 5, 1]])
+        labels = torch.tensor([[6, 7, 1]])
+        expected = model(input_ids=input_ids, labels=labels).loss
+
+        freezer = LayerFreezer(model, 't5')
+        freezer.freeze_layers([0], part='all', dtype=torch.bfloat16)
+        self.assertEqual(model.encoder.block[0].layer[0].SelfAttention.q.weight.dtype, torch.bfloat16)
+        self.assertEqual(model.encoder.block[1].layer[0].SelfAttention.q.weight.dtype, torch.float32)
+        report = {entry['layer']: entry for entry in freezer.parameter_report()}
+        self.assertEqual(report['encoder.block.0']['frozen_bytes'], 2 * report['encoder.block.0']['frozen_params'])
+
+        # The layers around keep their precision and the trainable ones still get gradients
+        loss = model(input_ids=input_ids, labels=labels).loss
+        self.assertEqual(loss.dtype, torch.float32)
+        self.assertAlmostEqual(loss.item(), expected.item(), delta=0.05)
+        loss.backward()
+        self.assertIsNotNone(model.encoder.block[1].layer[0].SelfAttention.q.weight.grad)
+        self.assertIsNotNone(model.shared.weight.grad)
+
+        freezer.unfreeze_layers([0], part='encoder')
+        self.assertEqual(model.encoder.block[0].layer[0].SelfAttention.q.weight.dtype, torch.float32)
+        self.assertEqual(model.decoder.block[0].layer[0].SelfAttention.q.weight.dtype, torch.bfloat16)
+        freezer.unfreeze_all()
+        self.assertTrue(all(param.dtype == torch.float32 for param in model.parameters()))
+        self.assertEqual(model(input_ids=input_ids, labels=labels).loss.dtype, torch.float32)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# tests/test_lr_finder.py
+import importlib.util
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from transformers import Trainer, TrainingArguments, T5ForConditionalGeneration
+
+from intellithing import lr_finder
+from intellithing.batching import T5DataCollator
+from intellithing.lr_finder import LearningRateFinderCallback
+from intellithing.t5customdataset import T5SummarizationDataset
+from intellithing.tests.fixtures import make_frame, make_tiny_t5, make_tokenizer
+
+
+class TestLearningRateFinderCallback(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.tokenizer = make_tokenizer()
+        self.model = T5ForConditionalGeneration.from_pretrained(make_tiny_t5(os.path.join(self.tmp.name, 'model')))
+        self.dataset = T5SummarizationDataset(self.tokenizer, make_frame(32), 'text', 'target', padding=False, pretokenize=True)
+
+    def run_finder(self, finder, **kwargs):
+        args = TrainingArguments(output_dir=os.path.join(self.tmp.name, 'results'), report_to='none', save_strategy='no',
+                                 per_device_train_batch_size=4, logging_steps=1000, **kwargs)
+        trainer = Trainer(model=self.model, args=args, train_dataset=self.dataset, data_collator=T5DataCollator(self.tokenizer),
+                          callbacks=[finder])
+        trainer.train()
+        return trainer
+
+    def test_records_the_loss_of_every_step_without_logs(self):
+        finder = LearningRateFinderCallback(1e-5, 1e-2, divergence_threshold=100)
+        self.run_finder(finder, num_train_epochs=2, gradient_accumulation_steps=2)
+        # 32 items, 4 per batch, 2 batches per step: 4 steps per epoch
+        self.assertEqual(finder.num_training_steps, 8)
+        self.assertEqual(len(finder.lrs), 8)
+        self.assertAlmostEqual(finder.lrs[0], 1e-5)
+        self.assertAlmostEqual(finder.lrs[-1], 1e-2)
+        self.assertTrue(np.all(np.diff(finder.lrs) > 0))
+        self.assertTrue(np.all(np.isfinite(finder.raw_losses)))
+        self.assertAlmostEqual(finder.losses[0], finder.raw_losses[0], places=5)
+        self.assertIsNone(finder._hook)
+
+    def test_stops_once_the_loss_diverges(self):
+        finder = LearningRateFinderCallback(1e-4, 1e4, divergence_threshold=1.5, smoothing=0.5)
+        trainer = self.run_finder(finder, max_steps=40, num_train_epochs=100)
+        self.assertTrue(finder.diverged)
+        self.assertLess(trainer.state.global_step, 40)
+        self.assertEqual(len(finder.lrs), trainer.state.global_step)
+        self.assertIsNotNone(finder.suggested_lr)
+        self.assertLess(finder.suggested_lr, finder.lrs[-1])
+
+    def test_suggestions(self):
+        finder = LearningRateFinderCallback(1e-6, 1, suggestion='valley')
+        finder.lrs = list(np.logspace(-6, 0, 61))
+        # Flat, a descent between 1e-4 and 1e-2, then divergence
+        log_lrs = np.log10(finder.lrs)
+        finder.losses = list(np.where(log_lrs < -4, 5.0, np.where(log_lrs < -2, 5.0 - 1.5 * (log_lrs + 4), 2.0 + 4 * (log_lrs + 2))))
+        steepest = finder.suggest_lr('steepest')
+        self.assertTrue(1e-4 <= steepest <= 1e-2, steepest)
+        valley = finder.suggest_lr()
+        self.assertTrue(1e-4 <= valley <= 1e-2, valley)
+        finder.lrs, finder.losses = finder.lrs[:2], finder.losses[:2]
+        self.assertIsNone(finder.suggest_lr())
+        with self.assertRaises(ValueError):
+            LearningRateFinderCallback(1e-6, 1, suggestion='minimum')
+
+    def test_matplotlib_is_only_imported_for_plots(self):
+        # Load the module again with every matplotlib import failing
+        spec = importlib.util.spec_from_file_location('headless_lr_finder', lr_finder.__file__)
+        module = importlib.util.module_from_spec(spec)
+        with mock.patch.dict(sys.modules, {'matplotlib': None, 'matplotlib.figure': None, 'matplotlib.pyplot': None}):
+            spec.loader.exec_module(module)
+            finder = module.LearningRateFinderCallback(1e-5, 1e-2)
+            self.run_finder(finder, max_steps=4)
+            self.assertEqual(len(finder.lrs), 4)
+            with self.assertRaises(ImportError):
+                finder.plot()
+
+    @unittest.skipUnless(importlib.util.find_spec('matplotlib'), "matplotlib is not installed")
+    def test_saves_the_plot(self):
+        path = os.path.join(self.tmp.name, 'lr_finder.png')
+        finder = LearningRateFinderCallback(1e-5, 1e-1, plot_path=path)
+        self.run_finder(finder, max_steps=5)
+        self.assertTrue(os.path.getsize(path) > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+# tests/test_t5customdataset.py
+import pickle
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+
+from intellithing.t5customdataset import (
+    T5RegressionDataset, T5ClassificationDataset, T5QADataset,
+    T5TextGenerationDataset, T5SummarizationDataset, T5NERDataset,
+    T5TranslationDataset
+)
+from intellithing.tests.fixtures import make_frame, make_tokenizer
+
+
+def build_datasets(tokenizer, frame, **kwargs):
+    return [
+        T5RegressionDataset(tokenizer, frame, 'text', 'score', source_max_len=24, target_max_len=8, **kwargs),
+        T5ClassificationDataset(tokenizer, frame, 'text', 'label', source_max_len=24, target_max_len=8, **kwargs),
+        T5QADataset(tokenizer, frame, 'label', 'text', 'target', source_max_len=24, target_max_len=8, **kwargs),
+        T5TextGenerationDataset(tokenizer, frame, 'text', 'target', source_max_len=24, target_max_len=8, **kwargs),
+        T5SummarizationDataset(tokenizer, frame, 'text', 'target', source_max_len=24, target_max_len=8, **kwargs),
+        T5NERDataset(tokenizer, frame, 'text', 'target', source_max_len=24, target_max_len=8, **kwargs),
+        T5TranslationDataset(tokenizer, frame, 'text', 'target', source_max_len=24, target_max_len=8, **kwargs),
+    ]
+
+
+class TestT5CustomDataset(unittest.TestCase):
+    def setUp(self):
+        self.tokenizer = make_tokenizer()
+        self.frame = make_frame()
+
+    def assertItemsEqual(self, expected, actual):
+        self.assertEqual(set(expected), set(actual))
+        for key in expected:
+            self.assertEqual(expected[key].dtype, actual[key].dtype, key)
+            self.assertTrue(torch.equal(expected[key], actual[key]), key)
+
+    def test_pretokenized_items_match_lazy_items(self):
+        lazy_datasets = build_datasets(self.tokenizer, self.frame)
+        eager_datasets = build_datasets(self.tokenizer, self.frame, pretokenize=True, tokenize_batch_size=7)
+
+        for lazy, eager in zip(lazy_datasets, eager_datasets):
+            self.assertEqual(len(lazy), len(eager))
+            for index in range(len(lazy)):
+                with self.subTest(dataset=type(lazy).__name__, index=index):
+                    self.assertItemsEqual(lazy[index], eager[index])
+
+    def test_unpadded_items_match_lazy_items(self):
+        lazy_datasets = build_datasets(self.tokenizer, self.frame, padding=False)
+        eager_datasets = build_datasets(self.tokenizer, self.frame, padding=False, pretokenize=True)
+
+        for lazy, eager in zip(lazy_datasets, eager_datasets):
+            for index in range(len(lazy)):
+                with self.subTest(dataset=type(lazy).__name__, index=index):
+                    self.assertItemsEqual(lazy[index], eager[index])
+                    self.assertEqual(len(eager[index]['input_ids']), eager.lengths()[index])
+                    self.assertTrue(bool(eager[index]['attention_mask'].all()))
+
+    def test_parallel_pretokenization_keeps_the_row_order(self):
+        progress = []
+        serial = T5QADataset(self.tokenizer, self.frame, 'label', 'text', 'target', pretokenize=True, tokenize_batch_size=3)
+        parallel = T5QADataset(self.tokenizer, self.frame, 'label', 'text', 'target', pretokenize=True, tokenize_batch_size=3,
+                               num_proc=2, progress_callback=lambda done, total: progress.append((done, total)))
+
+        for name in ('input_ids', 'labels'):
+            for expected, actual in zip(serial._token_store[name], parallel._token_store[name]):
+                self.assertTrue(np.array_equal(expected, actual), name)
+        self.assertEqual(progress[-1], (len(self.frame), len(self.frame)))
+        self.assertEqual(len(progress), 2 * -(-len(self.frame) // 3))
+        self.assertIsNone(pickle.loads(pickle.dumps(parallel)).progress_callback)
+
+    def test_lengths_without_pretokenization(self):
+        for lazy, eager in zip(build_datasets(self.tokenizer, self.frame), build_datasets(self.tokenizer, self.frame, pretokenize=True)):
+            self.assertEqual(lazy.lengths().tolist(), eager.lengths().tolist())
+            self.assertEqual(lazy.lengths()[0], int(lazy[0]['attention_mask'].sum()))
+
+    def test_profile_lengths_recommends_max_lengths(self):
+        dataset = T5SummarizationDataset(self.tokenizer, self.frame, 'text', 'target', source_max_len=8, target_max_len=64)
+        report = dataset.profile_lengths(coverage=0.9, pad_to_multiple_of=None)
+        full = [len(self.tokenizer(text)['input_ids']) for text in dataset._source_texts(self.frame)]
+
+        source = report['source']
+        self.assertEqual(source['num_rows'], len(self.frame))
+        self.assertEqual(source['percentiles'][100], max(full))
+        self.assertEqual(sum(source['histogram']['counts']), len(self.frame))
+        self.assertAlmostEqual(source['truncation_rate'], np.mean(np.array(full) > 8))
+        self.assertEqual(source['recommended_max_len'], int(np.ceil(np.quantile(full, 0.9))))
+        self.assertLessEqual(source['recommended_truncation_rate'], 0.1)
+        self.assertLess(source['savings']['padded_tokens'], 0)
+        self.assertGreater(report['target']['savings']['attention_flops'], 0)
+
+        sampled = dataset.profile_lengths(sample_size=5)
+        self.assertEqual(sampled['source']['num_rows'], 5)
+        self.assertEqual(sampled['source']['recommended_max_len'] % 8, 0)
+        self.assertNotIn('target', T5RegressionDataset(self.tokenizer, self.frame, 'text', 'score').profile_lengths())
+
+    def test_token_cache_is_reused_across_constructions(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first = build_datasets(self.tokenizer, self.frame, cache_dir=cache_dir)
+            with mock.patch('intellithing.t5customdataset.T5BaseDataset._tokenize_column', side_effect=AssertionError('cache miss')):
+                second = build_datasets(self.tokenizer, self.frame, cache_dir=cache_dir)
+                unpickled = [pickle.loads(pickle.dumps(dataset)) for dataset in second]
+            lazy_datasets = build_datasets(self.tokenizer, self.frame)
+
+            for lazy, cached, restored in zip(lazy_datasets, second, unpickled):
+                self.assertIsInstance(cached._token_store['input_ids'][0], np.memmap)
+                for index in range(len(lazy)):
+                    with self.subTest(dataset=type(lazy).__name__, index=index):
+                        self.assertItemsEqual(lazy[index], cached[index])
+                        self.assertItemsEqual(lazy[index], restored[index])
+            self.assertEqual(len({dataset.cache_key for dataset in first}), len(first))
+
+            # Entries evicted after pickling are tokenized again from the stored frame
+            pickled = [pickle.dumps(dataset) for dataset in second]
+            shutil.rmtree(cache_dir)
+            for lazy, restored in zip(lazy_datasets, map(pickle.loads, pickled)):
+                self.assertIsInstance(restored._token_store['input_ids'][0], np.memmap)
+                for index in range(len(lazy)):
+                    with self.subTest(dataset=type(lazy).__name__, index=index, evicted=True):
+                        self.assertItemsEqual(lazy[index], restored[index])
+
+    def test_token_cache_key_changes_with_content_and_max_length(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            base = T5NERDataset(self.tokenizer, self.frame, 'text', 'target', cache_dir=cache_dir)
+            shorter = T5NERDataset(self.tokenizer, self.frame, 'text', 'target', source_max_len=16, cache_dir=cache_dir)
+            edited_frame = self.frame.copy()
+            edited_frame.loc[0, 'text'] = 'w1 w2'
+            edited = T5NERDataset(self.tokenizer, edited_frame, 'text', 'target', cache_dir=cache_dir)
+            self.assertEqual(len({base.cache_key, shorter.cache_key, edited.cache_key}), 3)
+            expected = self.tokenizer('ner: w1 w2')['input_ids']
+            self.assertEqual(edited[0]['input_ids'][:len(expected)].tolist(), expected)
+
+    def test_packing_groups_rows_within_the_max_lengths(self):
+        dataset = T5SummarizationDataset(self.tokenizer, self.frame, 'text', 'target', source_max_len=64, target_max_len=16, packing=True)
+        unpacked = T5SummarizationDataset(self.tokenizer, self.frame, 'text', 'target', source_max_len=64, target_max_len=16, pretokenize=True, padding=False)
+        self.assertLess(len(dataset), len(self.frame))
+
+        rows = 0
+        for index in range(len(dataset)):
+            item = dataset[index]
+            self.assertEqual(len(item['input_ids']), 64)
+            self.assertEqual(len(item['labels']), 16)
+            segments = int(item['segment_ids'].max())
+            for segment in range(1, segments + 1):
+                row = unpacked[rows]
+                source = item['input_ids'][item['segment_ids'] == segment]
+                target = item['labels'][item['decoder_segment_ids'] == segment]
+                decoder_inputs = item['decoder_input_ids'][item['decoder_segment_ids'] == segment]
+                self.assertTrue(torch.equal(source, row['input_ids']))
+                self.assertTrue(torch.equal(target, row['labels']))
+                self.assertEqual(decoder_inputs[0].item(), self.tokenizer.pad_token_id)
+                self.assertTrue(torch.equal(decoder_inputs[1:], row['labels'][:-1]))
+                rows += 1
+            self.assertTrue((item['labels'][item['decoder_segment_ids'] == 0] == -100).all())
+        self.assertEqual(rows, len(self.frame))
+
+        stats = dataset.packing_stats()
+        self.assertEqual(stats['num_packs'], len(dataset))
+        self.assertGreater(stats['packing_efficiency'], stats['unpacked_efficiency'])
+        self.assertEqual(dataset.packing_efficiency, stats['packing_efficiency'])
+
+    def test_classification_labels_are_interned(self):
+        for pretokenize in (False, True):
+            dataset = T5ClassificationDataset(self.tokenizer, self.frame, 'text', 'label', target_max_len=8, pretokenize=pretokenize)
+            labels = self.frame['label'].fillna('Missing label').astype(str)
+            self.assertEqual(len(dataset._label_table), labels.nunique())
+            for index, label in enumerate(labels):
+                expected = self.tokenizer(label, max_length=8, padding='max_length', truncation=True)['input_ids']
+                self.assertEqual(dataset[index]['labels'].tolist(), expected)
+            # Items must not share storage with the lookup table
+            dataset[0]['labels'][0] = -1
+            self.assertNotEqual(dataset[0]['labels'][0].item(), -1)
+
+    def test_regression_labels_fall_back_to_the_default_value(self):
+        frame = self.frame.head(4).copy()
+        frame['score'] = ['1.5', 'not a number', float('nan'), 'inf']
+        dataset = T5RegressionDataset(self.tokenizer, frame, 'text', 'score', label_default_value=-1.0)
+        self.assertEqual([dataset[index]['labels'].item() for index in range(4)], [1.5, -1.0, -1.0, -1.0])
+
+    def test_packing_is_only_supported_for_generation_tasks(self):
+        with self.assertRaises(ValueError):
+            T5NERDataset(self.tokenizer, self.frame, 'text', 'target', packing=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# tests/test_t5streamingdataset.py
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+
+from intellithing.hyper_tuner import HyperparameterTuner
+from intellithing.t5customdataset import T5SummarizationDataset
+from intellithing.t5streamingdataset import T5StreamingSummarizationDataset
+from intellithing.tests.fixtures import make_frame, make_tokenizer
+
+
+class TestT5StreamingDataset(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.tokenizer = make_tokenizer()
+        self.frame = make_frame(50)
+        self.frame['row'] = range(len(self.frame))
+
+        self.csv_path = os.path.join(self.tmp.name, 'part-0.csv')
+        self.jsonl_path = os.path.join(self.tmp.name, 'part-1.jsonl')
+        self.frame.iloc[:30].to_csv(self.csv_path, index=False)
+        self.frame.iloc[30:].to_json(self.jsonl_path, orient='records', lines=True)
+
+    def streaming_dataset(self, **kwargs):
+        return T5StreamingSummarizationDataset(
+            self.tokenizer, [self.csv_path, self.jsonl_path], 'text', 'target',
+            source_max_len=24, target_max_len=8, chunk_size=7, **kwargs
+        )
+
+    def test_items_match_map_style_dataset(self):
+        expected = T5SummarizationDataset(self.tokenizer, self.frame, 'text', 'target', source_max_len=24, target_max_len=8)
+        items = list(self.streaming_dataset())
+        self.assertEqual(len(items), len(expected))
+        for index, item in enumerate(items):
+            for key in item:
+                self.assertTrue(torch.equal(item[key], expected[index][key]), (index, key))
+
+    def test_workers_split_the_stream_without_duplicates(self):
+        dataset = self.streaming_dataset(shuffle_buffer_size=5)
+        loader = DataLoader(dataset, batch_size=None, num_workers=2)
+        rows = sorted(tuple(item['input_ids'].tolist()) for item in loader)
+        expected = sorted(tuple(item['input_ids'].tolist()) for item in self.streaming_dataset())
+        self.assertEqual(rows, expected)
+
+    def test_rank_sharding_is_opt_in(self):
+        expected = [item['input_ids'].tolist() for item in self.streaming_dataset()]
+        # Rank 1 of 2 in an initialized process group
+        with mock.patch('torch.distributed.is_available', return_value=True), \
+                mock.patch('torch.distributed.is_initialized', return_value=True), \
+                mock.patch('torch.distributed.get_rank', return_value=1), \
+                mock.patch('torch.distributed.get_world_size', return_value=2):
+            # The Trainer's accelerate shards the stream itself, every process reads all of it
+            self.assertEqual([item['input_ids'].tolist() for item in self.streaming_dataset()], expected)
+
+            sharded = [item['input_ids'].tolist() for item in self.streaming_dataset(shard_across_processes=True)]
+        # As many files as ranks: rank 1 reads the second file only
+        self.assertEqual(sharded, expected[30:])
+
+    def test_chunks_of_other_shards_are_not_parsed(self):
+        frame = self.frame.copy()
+        # A quoted field spanning lines still counts as one CSV row
+        frame.loc[8, 'text'] = 'w1 w2\nw3'
+        paths = {'csv': os.path.join(self.tmp.name, 'all.csv'), 'jsonl': os.path.join(self.tmp.name, 'all.jsonl')}
+        frame.to_csv(paths['csv'], index=False)
+        frame.to_json(paths['jsonl'], orient='records', lines=True)
+        try:
+            import pyarrow  # noqa: F401
+            paths['parquet'] = os.path.join(self.tmp.name, 'all.parquet')
+            frame[['text', 'target']].to_parquet(paths['parquet'], row_group_size=10)
+        except ImportError:
+            pass
+
+        for file_format, path in paths.items():
+            with self.subTest(file_format=file_format):
+                def dataset():
+                    return T5StreamingSummarizationDataset(self.tokenizer, path, 'text', 'target', source_max_len=24, target_max_len=8, chunk_size=7)
+                expected = [item['input_ids'].tolist() for item in dataset()]
+                shards = []
+                for shard in range(3):
+                    with mock.patch.object(T5StreamingSummarizationDataset, '_shard', return_value=(shard, 3)), \
+                            mock.patch('intellithing.t5streamingdataset.pd.read_csv', wraps=pd.read_csv) as read_csv, \
+                            mock.patch('intellithing.t5streamingdataset.pd.read_json', wraps=pd.read_json) as read_json:
+                        shards.append([item['input_ids'].tolist() for item in dataset()])
+                    if file_format != 'parquet':
+                        # One parse per owned chunk: chunks shard, shard + 3, ... of the 8 chunks of 7 rows
+                        self.assertEqual(read_csv.call_count + read_json.call_count, len(range(shard, 8, 3)))
+                    self.assertEqual(shards[-1], sum((expected[start:start + 7] for start in range(7 * shard, 50, 21)), []))
+                self.assertEqual(sorted(sum(shards, [])), sorted(expected))
+
+    def test_shuffle_buffer_changes_order_per_epoch(self):
+        dataset = self.streaming_dataset(shuffle_buffer_size=10, seed=3)
+        first = [item['input_ids'].tolist() for item in dataset]
+        dataset.set_epoch(1)
+        second = [item['input_ids'].tolist() for item in dataset]
+        self.assertNotEqual(first, second)
+        self.assertEqual(sorted(first), sorted(second))
+
+    def test_subsample_and_training_length(self):
+        dataset = self.streaming_dataset()
+        self.assertEqual(dataset.count_examples(), 50)
+        subset = dataset.subsample(0.5, seed=1)
+        self.assertEqual(subset.num_examples, 25)
+        self.assertEqual([item['input_ids'].tolist() for item in subset], [item['input_ids'].tolist() for item in subset])
+        self.assertLess(len(list(subset)), 50)
+        # The subsample seed picks the rows, the dataset's seed still drives the shuffle buffer
+        shuffled = self.streaming_dataset(shuffle_buffer_size=10, seed=3)
+        self.assertEqual(shuffled.subsample(0.5, seed=1).seed, 3)
+        self.assertEqual(sorted(item['input_ids'].tolist() for item in shuffled.subsample(0.5, seed=1)),
+                         sorted(item['input_ids'].tolist() for item in subset))
+        self.assertNotEqual(sorted(item['input_ids'].tolist() for item in dataset.subsample(0.5, seed=2)),
+                            sorted(item['input_ids'].tolist() for item in subset))
+
+        self.assertEqual(HyperparameterTuner._training_length(subset, 2, 4, 2), {'num_train_epochs': 2, 'max_steps': 8})
+        with self.assertRaises(ValueError):
+            HyperparameterTuner._training_length(self.streaming_dataset(), 2, 4, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+# tests/test_token_cache.py
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from intellithing.token_cache import TokenCache
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_save_and_load_memory_maps(self):
+        cache = TokenCache(self.tmp.name)
+        self.assertIsNone(cache.load('missing'))
+        arrays = cache.save('key', {'ids': np.arange(10), 'offsets': np.array([0, 4, 10])})
+        self.assertIsInstance(arrays['ids'], np.memmap)
+        self.assertEqual(cache.load('key')['offsets'].tolist(), [0, 4, 10])
+
+    def test_evicts_least_recently_used_entries_over_the_size_cap(self):
+        cache = TokenCache(self.tmp.name, max_bytes=3000)
+        for key in ('a', 'b'):
+            cache.save(key, {'ids': np.zeros(128)})
+            time.sleep(0.01)
+        cache.load('a')
+        cache.save('c', {'ids': np.zeros(128)})
+
+        self.assertEqual(sorted(key for key, _, _ in cache.entries()), ['a', 'c'])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'b')))
+
+    def test_evicts_expired_entries(self):
+        cache = TokenCache(self.tmp.name, max_age=60)
+        cache.save('old', {'ids': np.zeros(4)})
+        meta_path = os.path.join(self.tmp.name, 'old', 'meta.json')
+        os.utime(meta_path, (time.time() - 120, time.time() - 120))
+        cache.save('new', {'ids': np.zeros(4)})
+        self.assertEqual([key for key, _, _ in cache.entries()], ['new'])
+
+    def test_fingerprint_depends_on_content(self):
+        self.assertEqual(TokenCache.fingerprint(['a', 'b'], 1), TokenCache.fingerprint(['a', 'b'], 1))
+        self.assertNotEqual(TokenCache.fingerprint(['a', 'b'], 1), TokenCache.fingerprint(['a', 'c'], 1))
+        self.assertNotEqual(TokenCache.fingerprint(['a', 'b'], 1), TokenCache.fingerprint(['a', 'b'], 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
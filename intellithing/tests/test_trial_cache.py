@@ -0,0 +1,118 @@
+# tests/test_trial_cache.py
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import optuna
+
+from intellithing.batching import T5DataCollator
+from intellithing.hyper_tuner import HyperparameterTuner
+from intellithing.t5customdataset import T5SummarizationDataset
+from intellithing.tests.fixtures import make_frame, make_tiny_t5, make_tokenizer, run_in_directory, suggest_lowest_integers
+from intellithing.trial_cache import TrialCache
+
+
+class TestTrialCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'trials.db')
+
+    def test_near_identical_configurations_hit(self):
+        cache = TrialCache(self.path, rtol=0.01, code_version='1')
+        context = cache.context('t5-small', 'data')
+        cache.save(context, {'lr': 3e-5, 'per_device_train_batch_size': 4}, {'eval_loss': 1.5, 'attrs': {}})
+        cache.save(context, {'lr': 3.02e-5, 'per_device_train_batch_size': 4}, {'eval_loss': 1.2, 'attrs': {}})
+
+        # The closest configuration within the tolerance wins
+        self.assertEqual(cache.load(context, {'lr': 3.019e-5, 'per_device_train_batch_size': 4})['eval_loss'], 1.2)
+        self.assertEqual(cache.load(context, {'lr': 2.99e-5, 'per_device_train_batch_size': 4})['eval_loss'], 1.5)
+        self.assertIsNone(cache.load(context, {'lr': 3.5e-5, 'per_device_train_batch_size': 4}))
+        self.assertIsNone(cache.load(context, {'lr': 3e-5, 'per_device_train_batch_size': 8}))
+        self.assertIsNone(cache.load(cache.context('t5-small', 'other data'), {'lr': 3e-5, 'per_device_train_batch_size': 4}))
+        # Other code versions do not share results
+        other_version = TrialCache(self.path, code_version='2')
+        self.assertIsNone(other_version.load(other_version.context('t5-small', 'data'), {'lr': 3e-5, 'per_device_train_batch_size': 4}))
+
+    def test_wide_range_integers_have_an_absolute_tolerance(self):
+        cache = TrialCache(self.path, code_version='1')
+        context = cache.context('t5-small', 'data')
+        cache.save(context, {'lr': 3e-5, 'warmup_steps': 400, 'num_train_epochs': 2}, {'eval_loss': 1.5, 'attrs': {}})
+        cache.save(context, {'lr': 3e-5, 'warmup_steps': 410, 'num_train_epochs': 2}, {'eval_loss': 1.2, 'attrs': {}})
+
+        self.assertEqual(cache.load(context, {'lr': 3e-5, 'warmup_steps': 403, 'num_train_epochs': 2})['eval_loss'], 1.5)
+        self.assertEqual(cache.load(context, {'lr': 3e-5, 'warmup_steps': 407, 'num_train_epochs': 2})['eval_loss'], 1.2)
+        self.assertIsNone(cache.load(context, {'lr': 3e-5, 'warmup_steps': 389, 'num_train_epochs': 2}))
+        # Other integers still have to be equal
+        self.assertIsNone(cache.load(context, {'lr': 3e-5, 'warmup_steps': 400, 'num_train_epochs': 3}))
+        exact = TrialCache(self.path, code_version='1', atol={})
+        self.assertIsNone(exact.load(context, {'lr': 3e-5, 'warmup_steps': 403, 'num_train_epochs': 2}))
+
+    def test_evicts_least_recently_used_and_expired_entries(self):
+        cache = TrialCache(self.path, max_entries=2, code_version='1')
+        with mock.patch('intellithing.trial_cache.time.time', side_effect=[1.0, 2.0, 3.0, 4.0, 5.0, 6.0]):
+            cache.save('context', {'lr': 1.0}, {'eval_loss': 1.0, 'attrs': {}})
+            cache.save('context', {'lr': 2.0}, {'eval_loss': 2.0, 'attrs': {}})
+            cache.load('context', {'lr': 1.0})
+            cache.save('context', {'lr': 3.0}, {'eval_loss': 3.0, 'attrs': {}})
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.load('context', {'lr': 2.0}))
+        self.assertIsNotNone(cache.load('context', {'lr': 1.0}))
+
+        expiring = TrialCache(self.path, max_age=60, code_version='1')
+        with mock.patch('intellithing.trial_cache.time.time', return_value=time.time() + 120):
+            expiring.evict()
+        self.assertEqual(len(expiring), 0)
+
+    def test_tuning_reuses_cached_trials(self):
+        tokenizer = make_tokenizer()
+        tuner = HyperparameterTuner(
+            make_tiny_t5(os.path.join(self.tmp.name, 'model')), tokenizer,
+            T5SummarizationDataset(tokenizer, make_frame(40), 'text', 'target', padding=False, pretokenize=True),
+            T5SummarizationDataset(tokenizer, make_frame(10, seed=1), 'text', 'target', padding=False, pretokenize=True),
+            data_collator=T5DataCollator(tokenizer),
+        )
+        run_in_directory(self, self.tmp.name)
+        suggest_lowest_integers(self)
+        # Every configuration of the fixed search space counts as the same one
+        cache = TrialCache(self.path, rtol=10.0)
+
+        suggest_categorical = optuna.Trial.suggest_categorical
+        with mock.patch.object(optuna.Trial, 'suggest_categorical', lambda trial, name, choices: suggest_categorical(trial, name, choices[:1])):
+            first = tuner.tune_hyperparameters(n_trials=1, subset_size=0.5, trial_cache=cache)
+            with mock.patch.object(HyperparameterTuner, '_train_trial', side_effect=AssertionError("trained again")):
+                second = tuner.tune_hyperparameters(n_trials=2, subset_size=0.5, trial_cache=cache)
+                self.assertEqual(tuner.tuning_cost['samples_seen'], 0)
+                self.assertEqual(tuner.trial_results[0]['eval_loss'], tuner.trial_results[1]['eval_loss'])
+                # Another tuning subset is another context
+                with self.assertRaises(AssertionError):
+                    tuner.tune_hyperparameters(n_trials=1, subset_size=0.25, trial_cache=cache)
+        self.assertEqual(second.keys(), first.keys())
+        self.assertEqual(len(cache), 1)
+
+    def test_tuning_needs_content_fingerprints(self):
+        tokenizer = make_tokenizer()
+        frame = make_frame(40)
+        dataset = T5SummarizationDataset(tokenizer, frame, 'text', 'target', padding=False, pretokenize=True)
+        fingerprint = HyperparameterTuner._dataset_fingerprint(dataset)
+        self.assertEqual(fingerprint, HyperparameterTuner._dataset_fingerprint(
+            T5SummarizationDataset(tokenizer, frame, 'text', 'target', padding=False, pretokenize=True)))
+        for kwargs in ({'padding': 'max_length'}, {'padding': False, 'compact': True}, {'padding': False, 'source_max_len': 32}):
+            other = T5SummarizationDataset(tokenizer, frame, 'text', 'target', pretokenize=True, **kwargs)
+            self.assertNotEqual(HyperparameterTuner._dataset_fingerprint(other), fingerprint, kwargs)
+
+        # Same type and length, other content
+        items = [dataset[index] for index in range(len(dataset))]
+        self.assertIsNone(HyperparameterTuner._dataset_fingerprint(items))
+        tuner = HyperparameterTuner(make_tiny_t5(os.path.join(self.tmp.name, 'model')), tokenizer, items, items[:10],
+                                    data_collator=T5DataCollator(tokenizer))
+        with self.assertRaises(ValueError):
+            tuner.tune_hyperparameters(n_trials=1, trial_cache=self.path)
+        with self.assertRaises(ValueError):
+            tuner.tune_hyperparameters(n_trials=1, persistent=True, storage=f"sqlite:///{self.path}")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# tests/test_tuner_callbacks.py
+import os
+import tempfile
+import unittest
+
+import optuna
+from transformers import TrainingArguments
+
+from intellithing.batching import T5DataCollator
+from intellithing.hyper_tuner import HyperparameterTuner
+from intellithing.t5customdataset import T5SummarizationDataset
+from intellithing.tests.fixtures import make_frame, make_tiny_t5, make_tokenizer
+from intellithing.tuner_callbacks import OptunaPruningCallback, ResourceUsageCallback, current_rss_bytes, make_pruner
+
+
+class TestOptunaPruningCallback(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.tokenizer = make_tokenizer()
+        self.tuner = HyperparameterTuner(
+            make_tiny_t5(os.path.join(self.tmp.name, 'model')), self.tokenizer,
+            T5SummarizationDataset(self.tokenizer, make_frame(40), 'text', 'target', padding=False, pretokenize=True),
+            T5SummarizationDataset(self.tokenizer, make_frame(10, seed=1), 'text', 'target', padding=False, pretokenize=True),
+            data_collator=T5DataCollator(self.tokenizer),
+        )
+
+    def train(self, pruner):
+        study = optuna.create_study(pruner=pruner)
+        trial = study.ask()
+        callback = OptunaPruningCallback(trial)
+        args = TrainingArguments(
+            output_dir=os.path.join(self.tmp.name, 'results'), report_to='none', max_steps=6,
+            per_device_train_batch_size=4, evaluation_strategy='steps', eval_steps=2,
+        )
+        trainer = self.tuner._build_trainer(args, self.tuner.train_dataset, self.tuner.val_dataset, callbacks=[callback])
+        trainer.train()
+        return callback, trainer
+
+    def test_stops_training_when_the_pruner_prunes(self):
+        callback, trainer = self.train(optuna.pruners.ThresholdPruner(upper=0.0))
+        self.assertTrue(callback.pruned)
+        self.assertEqual(trainer.state.global_step, 2)
+        with self.assertRaises(optuna.TrialPruned):
+            callback.raise_if_pruned()
+
+    def test_reports_every_evaluation(self):
+        callback, trainer = self.train(make_pruner('none'))
+        self.assertFalse(callback.pruned)
+        self.assertEqual(trainer.state.global_step, 6)
+        self.assertEqual(sorted(callback.trial.study.trials[0].intermediate_values), [2, 4, 6])
+        callback.raise_if_pruned()
+
+    def test_resource_usage_callback_records_the_peak_rss(self):
+        callback = ResourceUsageCallback(interval=0.01)
+        args = TrainingArguments(output_dir=os.path.join(self.tmp.name, 'results'), report_to='none', max_steps=2, per_device_train_batch_size=4)
+        self.tuner._build_trainer(args, self.tuner.train_dataset, self.tuner.val_dataset, callbacks=[callback]).train()
+        self.assertGreater(callback.peak_rss_mb, 0)
+        self.assertLessEqual(callback.peak_rss_mb, current_rss_bytes() / 1024 ** 2 * 2)
+        self.assertFalse(callback._thread.is_alive())
+
+    def test_make_pruner(self):
+        self.assertIsInstance(make_pruner('hyperband'), optuna.pruners.HyperbandPruner)
+        self.assertIsNone(make_pruner(None))
+        with self.assertRaises(ValueError):
+            make_pruner('sometimes')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+
+class TokenCache:
+    """
+    On-disk cache of tokenized arrays, keyed by a fingerprint.
+
+    Every entry is a directory named after its key holding one `.npy` file per array.
+    Entries are opened with `np.load(mmap_mode='r')`, so later runs read them zero-copy and
+    DataLoader workers share the same page cache instead of holding private copies.
+    The cache is bounded by `max_bytes`; the least recently used entries (and entries
+    older than `max_age`, in seconds) are evicted whenever a new entry is saved.
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024 ** 3, max_age=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(*parts):
+        """
+        Hash `parts` into a cache key. Parts can be strings, numbers, bytes, lists of strings
+        or pandas objects; lists and pandas objects are hashed by content.
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, (list, pd.Series, pd.DataFrame)):
+                part = pd.util.hash_pandas_object(pd.Series(part) if isinstance(part, list) else part, index=False).values.tobytes()
+            elif not isinstance(part, bytes):
+                part = repr(part).encode()
+            digest.update(len(part).to_bytes(8, 'little'))
+            digest.update(part)
+        return digest.hexdigest()
+
+    @staticmethod
+    def tokenizer_fingerprint(tokenizer):
+        backend = getattr(tokenizer, 'backend_tokenizer', None)
+        if backend is not None:
+            # The serialized fast tokenizer covers the vocabulary, normalizer and post-processor.
+            # Truncation and padding are call-time settings left over from the last call, and
+            # vocabularies are serialized from hash maps, so drop the former and sort the keys.
+            state = json.loads(backend.to_str())
+            state.pop('truncation', None)
+            state.pop('padding', None)
+            state = json.dumps(state, sort_keys=True)
+        else:
+            state = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+        return TokenCache.fingerprint(type(tokenizer).__name__, state)
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key):
+        """Return a dict of read-only memory-mapped arrays for `key`, or None on a cache miss."""
+        path = self._entry_path(key)
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+
+        with open(meta_path) as file:
+            names = json.load(file)['arrays']
+        # Mark the entry as recently used for the eviction order
+        os.utime(meta_path)
+        return {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in names}
+
+    def save(self, key, arrays):
+        """Write `arrays` under `key`, evict old entries and return the memory-mapped copy."""
+        path = self._entry_path(key)
+        tmp_path = f'{path}.tmp-{uuid.uuid4().hex}'
+        os.makedirs(tmp_path)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_path, f'{name}.npy'), np.ascontiguousarray(array))
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as file:
+                json.dump({'arrays': list(arrays), 'created': time.time()}, file)
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process finished writing the same entry first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.exists(os.path.join(path, 'meta.json')):
+                raise
+
+        self.evict(keep=(key,))
+        return self.load(key)
+
+    def entries(self):
+        """Return `(key, size_in_bytes, last_used)` for every complete entry, oldest first."""
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            meta_path = os.path.join(self._entry_path(key), 'meta.json')
+            if '.tmp-' in key or not os.path.exists(meta_path):
+                continue
+            path = self._entry_path(key)
+            size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+            entries.append((key, size, os.path.getmtime(meta_path)))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self, keep=()):
+        """Remove entries older than `max_age` and then the least recently used ones until the cache fits `max_bytes`."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for key, size, last_used in entries:
+            if key in keep:
+                continue
+            expired = self.max_age is not None and now - last_used > self.max_age
+            if expired or total > self.max_bytes:
+                shutil.rmtree(self._entry_path(key), ignore_errors=True)
+                total -= size
@@ -0,0 +1,145 @@
+import json
+import math
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from importlib import metadata
+
+import torch
+import transformers
+
+from intellithing.token_cache import TokenCache
+
+
+def default_code_version():
+    """Version of intellithing, transformers and torch; results of other versions are not reused."""
+    try:
+        version = metadata.version('intellithing')
+    except metadata.PackageNotFoundError:
+        version = 'dev'
+    return f"intellithing-{version}/transformers-{transformers.__version__}/torch-{torch.__version__}"
+
+
+class TrialCache:
+    """
+    Persistent cache of tuning trial results in a SQLite database.
+
+    Entries are keyed by a context fingerprint (model name, dataset fingerprints, tuning setup
+    and `code_version`) and the trial's hyperparameters. Two configurations are the same
+    when their categorical and integer values are equal and their float values differ by
+    at most `rtol` relative to the larger one, so a cache hit can be a near-identical
+    configuration sampled in an earlier run. `atol` maps param names to an absolute
+    tolerance instead, e.g. for wide-range integers such as `warmup_steps` (0 to 1000),
+    which by default may differ by 10. Float values are stored rounded to
+    `significant_digits`.
+
+    Entries older than `max_age` (seconds) and then the least recently used ones beyond
+    `max_entries` are evicted whenever a result is saved.
+    """
+
+    def __init__(self, path, rtol=0.01, significant_digits=6, max_entries=10000, max_age=None, code_version=None, atol=None):
+        self.path = path
+        self.rtol = rtol
+        self.atol = {'warmup_steps': 10} if atol is None else dict(atol)
+        self.significant_digits = significant_digits
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.code_version = code_version or default_code_version()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS trials ("
+                "id INTEGER PRIMARY KEY, context TEXT NOT NULL, params TEXT NOT NULL, result TEXT NOT NULL, "
+                "created REAL NOT NULL, last_used REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0, "
+                "UNIQUE (context, params))"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS trials_context ON trials (context)")
+
+    @contextmanager
+    def _connect(self):
+        # A connection per call, so forked tuning workers never share one
+        connection = sqlite3.connect(self.path, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def context(self, *parts):
+        """Fingerprint of everything besides the hyperparameters that the results depend on."""
+        return TokenCache.fingerprint(self.code_version, *parts)
+
+    def _round(self, value):
+        if isinstance(value, float) and math.isfinite(value) and value != 0:
+            return round(value, self.significant_digits - 1 - int(math.floor(math.log10(abs(value)))))
+        return value
+
+    def _normalize(self, params):
+        return json.dumps({name: self._round(value) for name, value in params.items()}, sort_keys=True)
+
+    def _matches(self, cached, params):
+        if cached.keys() != params.keys():
+            return False
+        for name, value in params.items():
+            other = cached[name]
+            if name in self.atol:
+                if not isinstance(other, (int, float)) or not isinstance(value, (int, float)) or abs(value - other) > self.atol[name]:
+                    return False
+            elif isinstance(value, float) or isinstance(other, float):
+                if not isinstance(other, (int, float)) or not isinstance(value, (int, float)):
+                    return False
+                if abs(value - other) > self.rtol * max(abs(value), abs(other)):
+                    return False
+            elif value != other:
+                return False
+        return True
+
+    def load(self, context, params):
+        """Return the result dict of the closest cached configuration within `rtol` and `atol` of `params`, or None."""
+        normalized = json.loads(self._normalize(params))
+        with self._connect() as connection:
+            rows = connection.execute("SELECT id, params, result FROM trials WHERE context = ?", (context,)).fetchall()
+            best_id, best_result, best_distance = None, None, None
+            for row_id, cached_params, result in rows:
+                cached_params = json.loads(cached_params)
+                if not self._matches(cached_params, normalized):
+                    continue
+                distance = sum(abs(value - cached_params[name]) / max(abs(value), abs(cached_params[name]), 1e-300)
+                               for name, value in normalized.items() if isinstance(value, float) and name not in self.atol)
+                distance += sum(abs(normalized[name] - cached_params[name]) / max(self.atol[name], 1e-300)
+                                for name in normalized if name in self.atol)
+                if best_distance is None or distance < best_distance:
+                    best_id, best_result, best_distance = row_id, result, distance
+            if best_id is None:
+                return None
+            # Mark the entry as recently used for the eviction order
+            connection.execute("UPDATE trials SET last_used = ?, hits = hits + 1 WHERE id = ?", (time.time(), best_id))
+        return json.loads(best_result)
+
+    def save(self, context, params, result):
+        """Store the `result` dict (eval loss and trial attributes) of `params` and evict old entries."""
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO trials (context, params, result, created, last_used) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (context, params) DO UPDATE SET result = excluded.result, created = excluded.created, last_used = excluded.last_used",
+                (context, self._normalize(params), json.dumps(result), now, now),
+            )
+        self.evict()
+
+    def __len__(self):
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM trials").fetchone()[0]
+
+    def evict(self):
+        """Remove entries older than `max_age` and then the least recently used ones beyond `max_entries`."""
+        with self._connect() as connection:
+            if self.max_age is not None:
+                connection.execute("DELETE FROM trials WHERE last_used < ?", (time.time() - self.max_age,))
+            if self.max_entries is not None:
+                connection.execute(
+                    "DELETE FROM trials WHERE id IN (SELECT id FROM trials ORDER BY last_used DESC, id DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
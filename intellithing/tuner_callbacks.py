@@ -0,0 +1,112 @@
+import os
+import sys
+import threading
+import time
+
+import optuna
+import torch
+from transformers import TrainerCallback
+
+
+_PRUNERS = {
+    'median': optuna.pruners.MedianPruner,
+    'successive_halving': optuna.pruners.SuccessiveHalvingPruner,
+    'hyperband': optuna.pruners.HyperbandPruner,
+    'none': optuna.pruners.NopPruner,
+}
+
+
+def make_pruner(pruner):
+    """Return an Optuna pruner for a name ('median', 'successive_halving', 'hyperband', 'none') or pass a pruner through."""
+    if pruner is None or isinstance(pruner, optuna.pruners.BasePruner):
+        return pruner
+    if pruner not in _PRUNERS:
+        raise ValueError(f"Unknown pruner: {pruner}. Use one of {sorted(_PRUNERS)} or an optuna pruner.")
+    return _PRUNERS[pruner]()
+
+
+class OptunaPruningCallback(TrainerCallback):
+    """
+    Report every intermediate evaluation to an Optuna trial and stop training as soon as
+    the study's pruner asks for it. The Trainer finishes the step cleanly; the objective
+    then raises `optuna.TrialPruned` (see `raise_if_pruned`) so the trial is recorded as pruned.
+    """
+
+    def __init__(self, trial, monitor='eval_loss'):
+        self.trial = trial
+        self.monitor = monitor
+        self.pruned = False
+        self.pruned_step = None
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        if not metrics or self.monitor not in metrics:
+            return
+        self.trial.report(metrics[self.monitor], step=state.global_step)
+        if self.trial.should_prune():
+            self.pruned = True
+            self.pruned_step = state.global_step
+            control.should_training_stop = True
+
+    def raise_if_pruned(self):
+        if self.pruned:
+            raise optuna.TrialPruned(f"Trial {self.trial.number} pruned at step {self.pruned_step}")
+
+
+def current_rss_bytes():
+    """Resident set size of this process, or its peak where the current value is not available."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class ResourceUsageCallback(TrainerCallback):
+    """
+    Track the peak resident memory of the process while training, sampled every
+    `interval` seconds on a background thread, and the peak CUDA memory when training
+    on a GPU. The results are in `peak_rss_mb` and `peak_cuda_mb` after training.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_rss_mb = None
+        self.peak_cuda_mb = None
+        self._stop = None
+        self._thread = None
+
+    def _sample(self):
+        peak = current_rss_bytes()
+        while not self._stop.wait(self.interval):
+            peak = max(peak, current_rss_bytes())
+        self.peak_rss_mb = max(peak, current_rss_bytes()) / 1024 ** 2
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self._stop.set()
+        self._thread.join()
+        if torch.cuda.is_available():
+            self.peak_cuda_mb = torch.cuda.max_memory_allocated() / 1024 ** 2
+
+
+class StepTimerCallback(TrainerCallback):
+    """Record the wall-clock duration of every optimizer step in `step_times` (seconds)."""
+
+    def __init__(self):
+        self.step_times = []
+        self._start = None
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self._start = time.perf_counter()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.step_times.append(time.perf_counter() - self._start)
@@ -6,7 +6,6 @@ setup(
     packages=find_packages(),
     install_requires=[
         "transformers",
-        "matplotlib",
         "optuna",
         "scikit-learn",
         "torch",
@@ -18,6 +17,10 @@ setup(
         "PyPDF2",
         "sqlalchemy"
     ],
+    extras_require={
+        # Only needed to plot the learning rate finder's curve
+        'plot': ["matplotlib"],
+    },
     entry_points={
         'console_scripts': [
             'intellithing=intellithing.main:main',